@@ -0,0 +1,26 @@
+"""
+Runs all benchmarks in a directory
+
+Each bench_*.py module should provide a main() function that prints its
+results with benchutil.report().
+"""
+
+import sys
+
+import test_all
+
+def find_bench_modules(pathdir):
+    for ename in test_all.listdir(pathdir):
+        if ename.startswith("bench_") and ename != "bench_all.py" \
+                and (ename.endswith(".py") or ename.endswith(".mpy")):
+            yield ename.replace(".py", "").replace(".mpy", "")
+
+def main(pathdirs=[]):
+    pathdirs = test_all.massage_args(pathdirs)
+    for pathdir in pathdirs:
+        for modname in find_bench_modules(pathdir):
+            mod = __import__(modname)
+            mod.main()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,106 @@
+"""
+Benchmark local queries on compacted readings against the TSV files
+
+Writes three months of half-hourly readings as 100 KiB TSV files, compacts
+all but the last into the per-month archives (see co2unit_archive), and
+compares the mean CO2 over the last 24 hours and the last 30 days from the
+TSV files alone (newest first, stopping at the first file that starts
+before the range) with the archives plus the open TSV file.
+"""
+
+import os
+
+import co2unit_archive
+import fileutil
+import timeutil
+
+import benchutil
+
+DAYS = 91
+FILE_SIZE = 100 * 1024
+
+def make_readings(readings_dir):
+    start = timeutil.mktime((2019, 5, 1, 0, 0, 0, 0, 0))
+    index = 0
+    f = None
+    size = FILE_SIZE
+    for n in range(DAYS * 48):
+        if size >= FILE_SIZE:
+            if f:
+                f.close()
+            f = open("%s/readings-%04d.tsv" % (readings_dir, index), "wt")
+            index += 1
+            size = 0
+        tt = timeutil.localtime(start + n * 30 * 60 + 10)
+        noise = (n * 7919) % 13
+        row = ["co2unit-30aea42a50bc", "varanger-03",
+                "{:04}-{:02}-{:02}".format(tt[0], tt[1], tt[2]),
+                "{:02}:{:02}:{:02}".format(tt[3], tt[4], tt[5]),
+                23.4375 + (noise - 6) * 0.0625, 0]
+        row += [680 + noise + i for i in range(10)]
+        row += [400 + noise, 31000 + noise * 3, 29000 + noise * 5, 150, 2310 + noise]
+        line = "\t".join([str(i) for i in row]) + "\n"
+        f.write(line)
+        size += len(line)
+    f.close()
+    return start + DAYS * 86400
+
+def tsv_mean(readings_dir, since):
+    """ The query without archives """
+    s = co2unit_archive.Summary()
+    fnames = sorted(os.listdir(readings_dir))
+    for fname in reversed(fnames):
+        first = None
+        with open(readings_dir + "/" + fname) as f:
+            for line in f:
+                record = co2unit_archive.parse_row(line)[3]
+                if first is None:
+                    first = record[0]
+                if record[0] >= since:
+                    s.add(co2unit_archive._co2_mean(record[3]))
+        if first < since:
+            break
+    return s
+
+def dir_bytes(path):
+    return sum([os.stat(path + "/" + fname)[6] for fname in os.listdir(path)])
+
+def main():
+    benchutil.header("Mean CO2 over %d days of readings, TSV files vs archives" % DAYS)
+    base = benchutil.scratch_dir("archive")
+    readings_dir = base + "/data/readings"
+    archive_dir = base + "/data/archive"
+    state_path = base + "/var/compact-state.json"
+    fileutil.mkdirs(readings_dir)
+    end = make_readings(readings_dir)
+
+    tsv_files = len(os.listdir(readings_dir))
+    tsv_bytes = dir_bytes(readings_dir)
+    secs = benchutil.time_calls(lambda: co2unit_archive.compact(readings_dir, archive_dir, state_path,
+        max_files=tsv_files), reps=1) / 1e6
+    benchutil.report("compact %d closed files" % (tsv_files - 1), secs * 1000, "ms")
+
+    # The TSV query reads from a copy that keeps all files
+    all_dir = base + "/all"
+    fileutil.copy_recursive(readings_dir, all_dir)
+    co2unit_archive.compact(readings_dir, archive_dir, state_path, acked=sorted(os.listdir(readings_dir))[-1])
+
+    benchutil.report("files before", tsv_files, "files")
+    benchutil.report("files after", len(os.listdir(readings_dir)) + len(os.listdir(archive_dir)), "files")
+    benchutil.report("KiB before", tsv_bytes / 1024, "KiB")
+    benchutil.report("KiB after", (dir_bytes(readings_dir) + dir_bytes(archive_dir)) / 1024, "KiB")
+
+    pending = co2unit_archive.uncompacted(readings_dir, state_path)
+    for days in (1, 30):
+        since = end - days * 86400
+        old = tsv_mean(all_dir, since)
+        new = co2unit_archive.summarize("co2", since, archive_dir=archive_dir, tsv_paths=pending)
+        if old.count != new.count or abs(old.mean() - new.mean()) > 0.01:
+            raise Exception("Archives give %s, TSV files %s" % (new, old))
+        benchutil.report("last %d days, TSV files" % days,
+                benchutil.time_calls(lambda: tsv_mean(all_dir, since), reps=3) / 1000, "ms")
+        benchutil.report("last %d days, archives" % days,
+                benchutil.time_calls(lambda: co2unit_archive.summarize("co2", since,
+                    archive_dir=archive_dir, tsv_paths=pending), reps=3) / 1000, "ms")
+
+    fileutil.rm_recursive(base)
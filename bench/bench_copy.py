@@ -0,0 +1,46 @@
+"""
+Benchmark installing an update tree with fileutil.copy_recursive
+
+Copies a tree shaped like a code update (a few dozen .mpy files) with
+different block sizes, then installs it again over itself with
+skip_matching, which is what an update that changes only a few files
+costs.
+"""
+
+import logging
+
+import benchutil
+import fileutil
+
+logging.getLogger("fileutil").setLevel(logging.WARNING)
+
+NFILES = 40
+FILE_SIZE = 5 * 1024
+
+def make_tree(dpath):
+    content = bytes(range(256)) * (FILE_SIZE // 256)
+    fileutil.mkdirs(dpath + "/lib")
+    for i in range(NFILES):
+        with open("%s/lib/module_%02d.mpy" % (dpath, i), "wb") as f:
+            f.write(content)
+
+def main():
+    benchutil.header("copy_recursive: update of %d files, %d KiB" % (NFILES, NFILES * FILE_SIZE // 1024))
+    dpath = benchutil.scratch_dir("copy")
+    src = dpath + "/update/flash"
+    make_tree(src)
+
+    for block_size in [512, 4096, 16384]:
+        fileutil.rm_recursive(dpath + "/flash")
+        stats = fileutil.copy_recursive(src, dpath + "/flash", block_size)
+        benchutil.report("full copy, %d B blocks" % block_size, stats.bytes_per_sec() / 1024, "KB/s")
+        benchutil.report("full copy, %d B blocks" % block_size, stats.ms, "ms")
+
+    # Change one file, reinstall over the previous copy
+    with open(src + "/lib/module_00.mpy", "wb") as f:
+        f.write(b"changed")
+    stats = fileutil.copy_recursive(src, dpath + "/flash", skip_matching=True)
+    benchutil.report("reinstall, 1 of %d changed, skip_matching" % NFILES, stats.ms, "ms")
+    benchutil.report("  files rewritten", stats.files_copied, "files")
+
+    fileutil.rm_recursive(dpath)
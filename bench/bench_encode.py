@@ -0,0 +1,67 @@
+"""
+Benchmark the bytes sent for a readings file with each push encoding
+
+Builds a 100 KiB readings file from rows like the ones co2unit_measure
+writes, with a little noise in the values, and encodes it in send_batch_size
+batches the way push_sequential does. Reports the bytes on air per 100 KiB
+file and the time to encode it, and checks that each decodes back.
+"""
+
+import co2unit_codec
+
+import benchutil
+
+# co2unit_measure.READING_FILE_SIZE_CUTOFF
+FILE_SIZE = 100 * 1024
+BATCH_SIZE = 32 * 1024
+CHUNK_SIZE = 4 * 1024
+
+def make_data(size):
+    """ Half-hourly rows as co2unit_measure.make_row lays them out, with a bit of noise """
+    lines = []
+    total = 0
+    n = 0
+    while total < size:
+        noise = (n * 7919) % 13
+        row = ["co2unit-30aea42a50bc", "varanger-03",
+                "2019-07-{:02}".format(1 + n // 48),
+                "{:02}:{:02}:{:02}".format((n // 2) % 24, 30 * (n % 2), 10 + noise % 3),
+                23.4375 + (noise - 6) * 0.0625, 5]
+        row += [680 + noise + i for i in range(5)]
+        row += [400 + noise, 31000 + noise * 3, 29000 + noise * 5, 150, 2310 + noise]
+        line = ("\t".join([str(i) for i in row]) + "\n").encode()
+        lines.append(line)
+        total += len(line)
+        n += 1
+    return b"".join(lines)[:size]
+
+def encode_batches(data, encoding):
+    mv = memoryview(data)
+    bodies = []
+    for start in range(0, len(data), BATCH_SIZE):
+        out = co2unit_codec.io.BytesIO()
+        enc = co2unit_codec.encoder(encoding, out)
+        end = min(start + BATCH_SIZE, len(data))
+        for pos in range(start, end, CHUNK_SIZE):
+            enc.write(mv[pos:min(pos + CHUNK_SIZE, end)])
+        enc.finish()
+        bodies.append(out.getvalue())
+    return bodies
+
+def main():
+    benchutil.header("Bytes on air per %d KiB readings file, %d KiB per push" % (FILE_SIZE // 1024, BATCH_SIZE // 1024))
+    data = make_data(FILE_SIZE)
+    benchutil.report("raw", len(data) / 1024, "KiB")
+
+    for encoding in co2unit_codec.ENCODINGS:
+        if not co2unit_codec.can_encode(encoding):
+            print("{:48} {:>12} (cannot encode here)".format(encoding, "-"))
+            continue
+        bodies = encode_batches(data, encoding)
+        decoded = b"".join([co2unit_codec.decode(encoding, b) for b in bodies])
+        if decoded != data:
+            raise Exception("%s does not decode back to the data" % encoding)
+        sent = sum([len(b) for b in bodies])
+        benchutil.report(encoding, sent / 1024, "KiB")
+        benchutil.report(encoding + " encode time",
+                benchutil.time_calls(lambda: encode_batches(data, encoding), reps=3) / 1000, "ms/file")
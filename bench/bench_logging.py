@@ -0,0 +1,67 @@
+"""
+Benchmark the cost of log calls at disabled levels
+
+Compares a debug call with DEBUG off on the Logger that micropython-lib
+ships (copied here), which checks the level inside log(), with the logging
+module here, whose methods for disabled levels are a no-op, and with a call
+guarded by isEnabledFor. Enabled calls write to a null stream, for scale.
+"""
+
+import logging
+
+import benchutil
+
+REPS = 2000
+
+class OldLogger:
+    """ The level check of micropython-lib's Logger, writing nowhere """
+
+    level = logging.NOTSET
+
+    def log(self, level, msg, *args):
+        if level >= (self.level or logging._level):
+            msg % args
+
+    def debug(self, msg, *args):
+        self.log(logging.DEBUG, msg, *args)
+
+class NullStream:
+    def write(self, s):
+        pass
+
+def loop_old(logger):
+    for i in range(REPS):
+        logger.debug("UART > %s", i)
+
+def loop_new(logger):
+    for i in range(REPS):
+        logger.debug("UART > %s", i)
+
+def loop_guarded(logger):
+    for i in range(REPS):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("UART > %s", i)
+
+def loop_bare():
+    for i in range(REPS):
+        pass
+
+def main():
+    benchutil.header("Log calls at a disabled level (DEBUG off)")
+    saved = (logging._level, logging._stream)
+    try:
+        logging.basicConfig(level=logging.INFO, stream=NullStream())
+        logger = logging.getLogger("bench_logging")
+
+        # Per call in ns, less the loop itself
+        bare = benchutil.time_calls(loop_bare) * 1000 / REPS
+        def per_call(fn):
+            return benchutil.time_calls(fn) * 1000 / REPS - bare
+        benchutil.report("level check in log() (old)", per_call(lambda: loop_old(OldLogger())), "ns/call")
+        benchutil.report("no-op method", per_call(lambda: loop_new(logger)), "ns/call")
+        benchutil.report("isEnabledFor guard", per_call(lambda: loop_guarded(logger)), "ns/call")
+
+        logger.setLevel(logging.DEBUG)
+        benchutil.report("enabled, to a null stream", per_call(lambda: loop_new(logger)), "ns/call")
+    finally:
+        logging.basicConfig(level=saved[0], stream=saved[1])
@@ -0,0 +1,69 @@
+"""
+Benchmark the NVS operations of the task log in a wake cycle
+
+Runs the tasks of a typical measurement wake through the TaskRunner, with
+a fresh NvsTaskLog each wake, like after a deep sleep. NVS is MockPycom,
+counting its calls. On the device, each nvs_set is a flash write.
+"""
+
+import logging
+
+import benchutil
+import mock_apis
+import co2unit_main2
+
+logging.getLogger("main").setLevel(logging.CRITICAL)
+logging.getLogger("mock_apis").setLevel(logging.CRITICAL)
+
+WAKES = 3
+
+class CountingPycom(mock_apis.MockPycom):
+    def __init__(self):
+        mock_apis.MockPycom.__init__(self)
+        self.gets = 0
+        self.sets = 0
+
+    def nvs_get(self, key):
+        self.gets += 1
+        return mock_apis.MockPycom.nvs_get(self, key)
+
+    def nvs_set(self, key, val):
+        self.sets += 1
+        mock_apis.MockPycom.nvs_set(self, key, val)
+
+# Stand-ins for the tasks of a measurement wake
+class BootUp(object):
+    def run(self): pass
+class InitPeripherals(BootUp): pass
+class CheckForUpdates(BootUp): pass
+class CheckSchedule(BootUp): pass
+class TakeMeasurement(BootUp): pass
+class SleepUntilScheduled(BootUp): pass
+
+WAKE_TASKS = [BootUp, InitPeripherals, CheckForUpdates, CheckSchedule, TakeMeasurement, SleepUntilScheduled]
+
+def new_log():
+    log = co2unit_main2.NvsTaskLog()
+    for task in WAKE_TASKS:
+        log.register(task)
+    return log
+
+def wake_cycle():
+    co2unit_main2.nvs_task_log = new_log()
+    co2unit_main2.TaskRunner().run(*WAKE_TASKS)
+
+def main():
+    benchutil.header("NVS task log: %d-task wake cycle" % len(WAKE_TASKS))
+    pycom = CountingPycom()
+    co2unit_main2.pycom = pycom
+
+    for wake in range(WAKES):
+        pycom.gets = pycom.sets = 0
+        wake_cycle()
+        benchutil.report("wake %d: nvs_get" % wake, pycom.gets, "calls")
+        benchutil.report("wake %d: nvs_set" % wake, pycom.sets, "calls")
+
+    log = new_log()
+    log.read_run_log()
+    benchutil.report("record_start", benchutil.time_calls(lambda: log.record_start(WAKE_TASKS[0]), 100))
+    benchutil.report("wake cycle", benchutil.time_calls(wake_cycle, 20))
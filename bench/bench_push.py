@@ -0,0 +1,109 @@
+"""
+Benchmark pushing a file to the stand-in server
+
+Needs host_scripts/standin_server.py running (make standin_server).
+Compares one PUT per chunk, reopening the file each time (the old
+push_sequential behavior), with streaming several chunks per PUT from one
+open file, each with and without keep-alive connections.
+"""
+
+import ujson
+import utime
+
+import benchutil
+import fileutil
+import urequests
+
+SYNC_DEST = "http://127.0.0.1:8080"
+UNIT_ID = "co2unit-bench"
+FILE_SIZE = 100 * 1024
+CHUNK_SIZE = 4 * 1024
+# Keeps each run's uploads apart in the stand-in server's data dir
+RUN_ID = utime.time()
+
+def make_file(fpath, size):
+    line = b"co2unit-30aea42a50bc\tvaranger-03\t2019-07-31\t13:00:10\t23.4375\t1\t680\t700\t710\n"
+    with open(fpath, "wb") as f:
+        written = 0
+        while written < size:
+            n = min(len(line), size - written)
+            f.write(line[:n])
+            written += n
+
+def put(fname, progress, data, headers={}, keep_alive=False):
+    url = "{}/ou/{}/push-sequential/bench-{}/{}?offset={}".format(SYNC_DEST, UNIT_ID, RUN_ID, fname, progress)
+    resp = urequests.request("PUT", url, data=data, headers=headers, keep_alive=keep_alive)
+    ack = ujson.loads(resp.content)["ack_file"]
+    if resp.status_code != 200:
+        raise Exception("Unexpected response %s %s" % (resp.status_code, ack))
+    return ack[1]
+
+def push_per_chunk(fpath, fname, keep_alive=False):
+    buf = bytearray(CHUNK_SIZE)
+    mv = memoryview(buf)
+    progress = 0
+    while progress < FILE_SIZE:
+        with open(fpath, "rb") as f:
+            f.seek(progress)
+            n = f.readinto(buf)
+        progress = put(fname, progress, mv[:n], keep_alive=keep_alive)
+
+def push_streamed(fpath, fname, batch_size, keep_alive=False):
+    buf = bytearray(CHUNK_SIZE)
+    mv = memoryview(buf)
+    progress = 0
+
+    def chunks(f, nbytes):
+        while nbytes > 0:
+            n = f.readinto(mv[:min(len(mv), nbytes)])
+            nbytes -= n
+            yield mv[:n]
+
+    with open(fpath, "rb") as f:
+        while progress < FILE_SIZE:
+            batch = min(batch_size, FILE_SIZE - progress)
+            f.seek(progress)
+            progress = put(fname, progress, chunks(f, batch), {"Content-Length": str(batch)}, keep_alive)
+
+def ping(keep_alive=False):
+    url = "{}/ou/{}/alive".format(SYNC_DEST, UNIT_ID)
+    urequests.request("POST", url, keep_alive=keep_alive).content
+
+def server_up():
+    try:
+        ping()
+        return True
+    except OSError:
+        return False
+
+def main():
+    benchutil.header("push_sequential: %d KiB file to %s" % (FILE_SIZE // 1024, SYNC_DEST))
+    if not server_up():
+        print("skipped: stand-in server not running (make standin_server)")
+        return
+
+    dpath = benchutil.scratch_dir("push")
+    fpath = dpath + "/readings.tsv"
+    make_file(fpath, FILE_SIZE)
+
+    trial = [0]
+    def fresh_name():
+        trial[0] += 1
+        return "readings-%04d.tsv" % trial[0]
+
+    for keep_alive in [False, True]:
+        ka = ", keep-alive" if keep_alive else ""
+
+        us = benchutil.time_calls(lambda: ping(keep_alive), 20)
+        benchutil.report("alive ping" + ka, us)
+
+        us = benchutil.time_calls(lambda: push_per_chunk(fpath, fresh_name(), keep_alive), 3)
+        benchutil.report("%d B per PUT, reopen per chunk%s" % (CHUNK_SIZE, ka), FILE_SIZE / us * 1000, "KB/s")
+
+        for batch_size in [16*1024, 32*1024, FILE_SIZE]:
+            us = benchutil.time_calls(lambda: push_streamed(fpath, fresh_name(), batch_size, keep_alive), 3)
+            benchutil.report("%d B per PUT, streamed%s" % (batch_size, ka), FILE_SIZE / us * 1000, "KB/s")
+
+        urequests.close_pool()
+
+    fileutil.rm_recursive(dpath)
@@ -0,0 +1,65 @@
+"""
+Benchmark the scheduling work of a wake
+
+Compares building a Schedule from the config for CheckSchedule and again
+for SleepUntilScheduled, as each wake used to, with loading the compiled
+timeline from NVS (MockPycom), popping what is due, and saving it.
+"""
+
+import logging
+
+import benchutil
+import mock_apis
+import schedule
+import timeutil
+import co2unit_main2
+
+logging.getLogger("mock_apis").setLevel(logging.CRITICAL)
+
+RULE_COUNTS = [2, 8, 32]
+
+def make_cfg(nrules):
+    cfg = [["TakeMeasurement", 'minutes', 30, 0], ["Communicate", 'daily', 3, 15]]
+    for i in range(nrules - len(cfg)):
+        cfg.append(["Task%02d" % i, 'minutes', [5, 10, 15, 20, 30, 60][i % 6], i % 5])
+    return cfg[:nrules]
+
+def wake_with_schedule(cfg, tt):
+    sched = schedule.Schedule(cfg)
+    sched.check(tt)
+    sched = schedule.Schedule(cfg)
+    agenda = sched.next(tt)
+    timeutil.mktime(agenda[0][0]) - timeutil.mktime(tt)
+
+def wake_with_timeline(cfg, secs):
+    timeline = co2unit_main2.load_timeline(cfg, secs)
+    timeline.advance(secs)
+    co2unit_main2.save_timeline(timeline)
+    timeline = co2unit_main2.load_timeline(cfg, secs)
+    timeline.agenda()[0][0] - secs
+
+CRON_EXPRS = ["*/30 * * * *", "15 3 * * *", "0 12 * * 1", "0 0 1 3,9 *"]
+
+def scan_next(sched, secs):
+    secs = secs - secs % 60 + 60
+    while not sched.check(timeutil.localtime(secs)):
+        secs += 60
+    return secs
+
+def main():
+    benchutil.header("Scheduling per wake")
+    co2unit_main2.pycom = mock_apis.MockPycom()
+    tt = timeutil.parse_time("2020-08-27 07:30:05")
+    secs = timeutil.mktime(tt)
+    for nrules in RULE_COUNTS:
+        cfg = make_cfg(nrules)
+        benchutil.report("%2d rules: Schedule check and next" % nrules,
+                benchutil.time_calls(lambda: wake_with_schedule(cfg, tt)))
+        co2unit_main2.save_timeline(co2unit_main2.load_timeline(cfg, secs))
+        benchutil.report("%2d rules: timeline from NVS, advance" % nrules,
+                benchutil.time_calls(lambda: wake_with_timeline(cfg, secs)))
+
+    for expr in CRON_EXPRS:
+        sched = schedule.Cron(expr)
+        benchutil.report("cron %-14s next_secs" % expr, benchutil.time_calls(lambda: sched.next_secs(secs)))
+        benchutil.report("cron %-14s minute scan" % expr, benchutil.time_calls(lambda: scan_next(sched, secs), 1))
@@ -0,0 +1,110 @@
+"""
+Benchmark the sdcard driver against a card on a simulated SPI bus
+
+Runs block writes and reads like those FatFs makes through the driver, on
+SimSpiSdCard, and reports the time the bus would take (from the bytes
+clocked at the baudrate, busy polling included), the commands sent, and
+the allocating spi.read() calls. Compares the driver as it was, copied
+here, at its fixed 1.32 MHz, with the driver now at the same clock and
+after its clock ramp. Host time is not reported: the simulated card
+dominates it.
+"""
+
+import benchutil
+import sdcard
+import simhw
+
+NBLOCKS = 4096
+BLOCKS = 64
+
+class OldSDCard(sdcard.SDCard):
+    """ The polling and writeblocks of the driver before, and no ramp """
+
+    def __init__(self, spi, cs):
+        sdcard.SDCard.__init__(self, spi, cs, ramp=(1320000,))
+
+    def write(self, token, buf):
+        self.cs(0)
+        self.spi.read(1, token)
+        self.spi.write(buf)
+        self.spi.write(b'\xff')
+        self.spi.write(b'\xff')
+        if (self.spi.read(1, 0xff)[0] & 0x1f) != 0x05:
+            self.cs(1)
+            self.spi.write(b'\xff')
+            return
+        while self.spi.read(1, 0xff)[0] == 0:
+            pass
+        self.cs(1)
+        self.spi.write(b'\xff')
+
+    def write_token(self, token):
+        self.cs(0)
+        self.spi.read(1, token)
+        self.spi.write(b'\xff')
+        while self.spi.read(1, 0xff)[0] == 0x00:
+            pass
+        self.cs(1)
+        self.spi.write(b'\xff')
+
+    def writeblocks(self, block_num, buf):
+        nblocks, err = divmod(len(buf), 512)
+        assert nblocks and not err, 'Buffer length is invalid'
+        if nblocks == 1:
+            if self.cmd(24, block_num * self.cdv, 0) != 0:
+                raise OSError(5)
+            self.write(0xfe, buf)
+        else:
+            if self.cmd(25, block_num * self.cdv, 0) != 0:
+                raise OSError(5)
+            offset = 0
+            mv = memoryview(buf)
+            while nblocks:
+                self.write(0xfc, mv[offset : offset + 512])
+                offset += 512
+                nblocks -= 1
+            self.write_token(0xfd)
+
+def append_singles(sd, buf):
+    for i in range(BLOCKS):
+        sd.writeblocks(256 + i, buf)
+
+def append_eights(sd, buf):
+    for i in range(0, BLOCKS, 8):
+        sd.writeblocks(256 + i, buf)
+
+def scattered_singles(sd, buf):
+    for i in range(BLOCKS):
+        sd.writeblocks(256 + i * 7, buf)
+
+def read_singles(sd, buf):
+    for i in range(BLOCKS):
+        sd.readblocks(256 + i, buf)
+
+WORKLOADS = [
+        ("append 1-block writes", append_singles, 1),
+        ("append 8-block writes", append_eights, 8),
+        ("scattered 1-block writes", scattered_singles, 1),
+        ("1-block reads", read_singles, 1),
+        ]
+
+DRIVERS = [
+        ("old, 1.32 MHz", lambda card: OldSDCard(card, card.cs)),
+        ("now, 1.32 MHz", lambda card: sdcard.SDCard(card, card.cs, ramp=(1320000,))),
+        ("now, ramped", lambda card: sdcard.SDCard(card, card.cs)),
+        ]
+
+def main():
+    benchutil.header("sdcard: %d blocks on a simulated SPI card" % BLOCKS)
+    for wname, workload, nblocks in WORKLOADS:
+        buf = bytearray(nblocks * 512)
+        for dname, make in DRIVERS:
+            card = simhw.SimSpiSdCard(NBLOCKS)
+            sd = make(card)
+            card.reset_counts()
+            workload(sd, buf)
+            sd.sync()
+            name = "%s, %s" % (wname, dname)
+            benchutil.report(name, card.bus_us / 1000, "ms bus")
+            benchutil.report(name, card.ncommands(), "commands")
+            benchutil.report(name, card.reads, "allocating reads")
@@ -0,0 +1,41 @@
+"""
+Benchmark choosing the append target in directories of sequence files
+
+Compares a full directory scan (listdir and sort) with the append index.
+"""
+
+import logging
+
+import benchutil
+import fileutil
+import seqfile
+
+logging.getLogger("seqfile").setLevel(logging.WARNING)
+logging.getLogger("fileutil").setLevel(logging.WARNING)
+
+MATCH = ("readings-", ".tsv")
+SIZE_LIMIT = 100 * 1024
+
+def make_files(dpath, nfiles):
+    for i in range(nfiles):
+        with open("/".join([dpath, seqfile.make_sequence_filename(i, MATCH)]), "w") as f:
+            f.write("x")
+
+def main():
+    benchutil.header("seqfile: choose append target")
+    for nfiles in [10, 1000, 10000]:
+        dpath = benchutil.scratch_dir("seqfile")
+        data_dir = dpath + "/data"
+        index_path = dpath + "/index.json"
+        fileutil.mkdirs(data_dir)
+        make_files(data_dir, nfiles)
+
+        reps = 100 if nfiles < 10000 else 10
+        scan = benchutil.time_calls(lambda: fileutil.prep_append_file(data_dir, MATCH, SIZE_LIMIT), reps)
+        fileutil.prep_append_file(data_dir, MATCH, SIZE_LIMIT, index_path=index_path)
+        index = benchutil.time_calls(lambda: fileutil.prep_append_file(data_dir, MATCH, SIZE_LIMIT, index_path=index_path), reps)
+
+        benchutil.report("%5d files, directory scan" % nfiles, scan)
+        benchutil.report("%5d files, append index" % nfiles, index)
+
+        fileutil.rm_recursive(dpath)
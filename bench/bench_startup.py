@@ -0,0 +1,69 @@
+"""
+Benchmark importing the modules of the co2unit_main2 boot path
+
+Imports the modules of a measurement wake and of a communication wake, on
+the simulated hardware (see sim/simhw.py), and reports the time and heap
+the imports take, as importprof measures them. Each rep starts with none
+of the unit's modules loaded, like after a deep sleep.
+
+Run it once for each way of loading the modules (make bench_startup):
+
+    .py     source files, compiled at every import
+    .mpy    precompiled bytecode files
+    frozen  bytecode frozen into the firmware (make unix_port_frozen)
+
+The label is only printed; the modules are whatever the path finds.
+"""
+
+import sys
+
+import benchutil
+import importprof
+import simhw
+
+REPS = 5
+
+BOOT_PATHS = [
+        ("measurement wake", ["co2unit_main2", "co2unit_hw", "schedule", "co2unit_measure"]),
+        ("communication wake", ["co2unit_main2", "co2unit_hw", "schedule", "co2unit_comm", "co2unit_update"]),
+        ]
+
+# Needed by the benchmark itself
+KEEP = ["importprof", "logging"]
+
+def dirname(path):
+    return "/".join(path.split("/")[:-1])
+
+def forget_unit_modules():
+    """ Unloads the modules from importprof's directory (or all frozen ones) """
+    unit_dir = dirname(importprof.__file__)
+    for name, mod in list(sys.modules.items()):
+        if name not in KEEP and dirname(getattr(mod, "__file__", "")) == unit_dir:
+            del sys.modules[name]
+
+def import_cold(names):
+    """ Imports names with nothing loaded. Returns (modules, us, bytes). """
+    forget_unit_modules()
+    importprof.install()
+    for name in names:
+        __import__(name)
+    importprof.uninstall()
+    top = [rec for rec in importprof.records if rec[1] == 0]
+    return len(importprof.records), sum([rec[2] for rec in top]), sum([rec[3] for rec in top])
+
+def main(label=".py"):
+    benchutil.header("Boot path imports from %s" % label)
+    saved_modules = dict(sys.modules)
+    try:
+        simhw.Sim(simhw.mktime((2021, 6, 1, 0, 0, 0))).install()
+        for path_name, names in BOOT_PATHS:
+            runs = [import_cold(names) for _ in range(REPS)]
+            benchutil.report("%s: modules" % path_name, runs[0][0], "modules")
+            benchutil.report("%s: time (best of %d)" % (path_name, REPS), min([r[1] for r in runs]) / 1000, "ms")
+            benchutil.report("%s: heap" % path_name, min([r[2] for r in runs]), "bytes")
+    finally:
+        sys.modules.clear()
+        sys.modules.update(saved_modules)
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
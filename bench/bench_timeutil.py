@@ -0,0 +1,54 @@
+"""
+Benchmark the calendar arithmetic of timeutil
+
+Compares the closed-form utc_mktime and utc_localtime (what timeutil uses
+where utime has no mktime, like on the Unix port) with the loops over
+years and months they replaced, copied here.
+"""
+
+import benchutil
+import schedule
+import timeutil
+
+def loop_mktime(tt):
+    yy, mo, dd, hh, mm, ss, *_ = tt
+    ts = (yy - 1970) * 365 * 24 * 60 * 60
+    for year in range(1970, yy):
+        if timeutil.isleapyear(year):
+            ts += 24 * 60 * 60
+    for month in range(1, mo):
+        ts += timeutil.days_in_month(yy, month) * 24 * 60 * 60
+    return ts + (dd - 1) * 24 * 60 * 60 + hh * 60 * 60 + mm * 60 + ss
+
+def loop_localtime(ts):
+    yy = 1970
+    while True:
+        yearsecs = (366 if timeutil.isleapyear(yy) else 365) * 24 * 60 * 60
+        if ts < yearsecs:
+            break
+        ts -= yearsecs
+        yy += 1
+    mo = 1
+    while True:
+        monsecs = timeutil.days_in_month(yy, mo) * 24 * 60 * 60
+        if ts < monsecs:
+            break
+        ts -= monsecs
+        mo += 1
+    dd = 1 + ts // (24 * 60 * 60)
+    ts = ts % (24 * 60 * 60)
+    return (yy, mo, dd, ts // 3600, ts // 60 % 60, ts % 60, 0, 0)
+
+def main():
+    benchutil.header("timeutil: calendar arithmetic")
+    for iso in ["2021-11-30 12:34:56", "2099-11-30 12:34:56"]:
+        tt = timeutil.parse_time(iso)
+        ts = timeutil.utc_mktime(tt)
+        benchutil.report("%s: mktime, year loop" % iso[0:4], benchutil.time_calls(lambda: loop_mktime(tt), 200))
+        benchutil.report("%s: mktime, closed form" % iso[0:4], benchutil.time_calls(lambda: timeutil.utc_mktime(tt), 200))
+        benchutil.report("%s: localtime, year loop" % iso[0:4], benchutil.time_calls(lambda: loop_localtime(ts), 200))
+        benchutil.report("%s: localtime, closed form" % iso[0:4], benchutil.time_calls(lambda: timeutil.utc_localtime(ts), 200))
+
+    sched = schedule.ByMinute(30)
+    tt = timeutil.parse_time("2021-11-30 12:34:56")
+    benchutil.report("ByMinute.next (normalize)", benchutil.time_calls(lambda: sched.next(tt), 200))
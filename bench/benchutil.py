@@ -0,0 +1,35 @@
+"""
+Small helpers for benchmarks
+
+Benchmarks are meant to run on the MicroPython Unix port (make benchmark),
+but most will also run on the device.
+"""
+
+import gc
+import utime
+
+import fileutil
+
+def time_calls(fn, reps=10):
+    """ Calls fn() reps times and returns the mean time per call in microseconds """
+    gc.collect()
+    start = utime.ticks_us()
+    for _ in range(reps):
+        fn()
+    elapsed = utime.ticks_diff(utime.ticks_us(), start)
+    return elapsed / reps
+
+def report(name, value, unit="us/call"):
+    print("{:48} {:12.1f} {}".format(name, value, unit))
+
+def header(title):
+    print()
+    print(title)
+    print("-" * len(title))
+
+def scratch_dir(name):
+    """ Creates an empty scratch directory for a benchmark and returns its path """
+    path = "bench_tmp_" + name
+    fileutil.rm_recursive(path)
+    fileutil.mkdirs(path)
+    return path
@@ -0,0 +1,6 @@
+# Frozen module manifest for the MicroPython Unix port (make unix_port_frozen)
+#
+# Freezes the modules that `make frozen` collects in target/frozen/lib.
+# $(MPY_DIR) is thirdparty/micropython.
+
+freeze("$(MPY_DIR)/../../target/frozen/lib")
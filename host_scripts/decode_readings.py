@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+"""
+Decode binary readings files (readings-NNNN.bin) to the TSV readings format
+
+Usage: decode_readings.py readings-0000.bin [readings-0001.bin ...] > readings.tsv
+
+The output has the same columns as the TSV files written by the unit
+(see doc/co2-unit-data-layout.md), so it can go through the same import
+scripts on the server.
+
+The binary format itself is defined in src/lib/co2unit_packed.py,
+which this script imports directly.
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "lib"))
+import co2unit_packed
+
+def decode_file(fpath, out):
+    with open(fpath, "rb") as f:
+        data = f.read()
+    count = 0
+    for header, record in co2unit_packed.unpack_records(data):
+        row = co2unit_packed.record_row(header, record, time.gmtime(record[0]))
+        out.write("\t".join([str(i) for i in row]))
+        out.write("\n")
+        count += 1
+    return count
+
+def main(args):
+    if not args:
+        print(__doc__.strip(), file=sys.stderr)
+        return 1
+    for fpath in args:
+        count = decode_file(fpath, sys.stdout)
+        print("%s: %d records" % (fpath, count), file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
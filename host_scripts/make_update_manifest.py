@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Writes manifest.json for a CO2 unit update directory
+
+Usage: make_update_manifest.py update_dir
+
+Lists every file in the update (except the manifest itself) with its size
+and SHA-256. With a manifest, the unit downloads and installs only the files
+that differ from what it already has in /flash, and checks each file before
+installing it.
+
+Manifest format:
+
+    {"version": 1, "files": {"flash/lib/fileutil.mpy": [size, "sha256 hex"], ...}}
+"""
+
+import hashlib
+import json
+import os
+import sys
+
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 1
+
+def file_entry(fpath):
+    h = hashlib.sha256()
+    with open(fpath, "rb") as f:
+        for block in iter(lambda: f.read(64*1024), b""):
+            h.update(block)
+    return [os.path.getsize(fpath), h.hexdigest()]
+
+def make_manifest(update_dir):
+    files = {}
+    for root, dirs, fnames in os.walk(update_dir):
+        for fname in fnames:
+            fpath = os.path.join(root, fname)
+            relpath = os.path.relpath(fpath, update_dir).replace(os.sep, "/")
+            if relpath == MANIFEST_NAME:
+                continue
+            files[relpath] = file_entry(fpath)
+    return {"version": MANIFEST_VERSION, "files": files}
+
+def main(argv):
+    if len(argv) != 1:
+        print(__doc__.strip(), file=sys.stderr)
+        return 1
+    update_dir = argv[0]
+    manifest = make_manifest(update_dir)
+    mpath = os.path.join(update_dir, MANIFEST_NAME)
+    with open(mpath, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    print("%s: %d files" % (mpath, len(manifest["files"])), file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
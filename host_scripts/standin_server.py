@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the CO2 unit server, for testing and benchmarks
+
+Usage: standin_server.py [--port 8080] [--data-dir standin_data] [--encodings deflate,tsvdelta]
+
+Implements the parts of the co2_ou_server API that the unit uses,
+storing everything under data_dir/<unit_id>/, like remote_data/ on the real
+server:
+
+    POST /ou/<id>/alive?encodings               -> ping, picks an encoding
+    PUT  /ou/<id>/push-sequential/<path>?offset[&encoding]
+                                                -> append body to file
+    GET  /ou/<id>/<dir>?recursive=<bool>        -> JSON directory listing
+    GET  /ou/<id>/<path>                        -> file contents
+                                                   (Range: bytes=<start>- honored)
+
+Pushes follow the real server's offset semantics: the body is appended only
+if offset matches the current file size. Otherwise the server answers
+416 with its current progress. Both answers carry
+{"ack_file": [fname, progress, size]}.
+
+Encoded pushes (see src/lib/co2unit_codec.py): the ping answers with the
+first of the unit's offered encodings that --encodings allows, as
+{"encoding": name}. A push with &encoding=name is decoded before the offset
+check, and offsets and progress count decoded bytes. --encodings "" acts
+like a server that does not know about encodings.
+
+This is not the real server. It does no authentication and trusts paths
+only as far as keeping them inside data_dir.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "lib"))
+import co2unit_codec
+
+class Stats(object):
+    def __init__(self):
+        self.requests = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.start = time.time()
+
+    def __str__(self):
+        elapsed = time.time() - self.start
+        return "%d requests, %d bytes in, %d bytes out in %.1f s" % (
+                self.requests, self.bytes_in, self.bytes_out, elapsed)
+
+class StandinHandler(BaseHTTPRequestHandler):
+    # Allows keep-alive for clients that ask for it.
+    # HTTP/1.0 clients still get one request per connection.
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately; don't let Nagle delay the body
+    disable_nagle_algorithm = True
+
+    data_dir = "standin_data"
+    encodings = co2unit_codec.ENCODINGS
+    stats = Stats()
+    quiet = False
+
+    def log_message(self, fmt, *args):
+        if not self.quiet:
+            super().log_message(fmt, *args)
+
+    def _parse(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        parts = url.path.strip("/").split("/")
+        if len(parts) < 2 or parts[0] != "ou":
+            return None, None, query
+        unit_id, rest = parts[1], parts[2:]
+        return unit_id, rest, query
+
+    def _local_path(self, unit_id, rest):
+        base = os.path.realpath(os.path.join(self.data_dir, unit_id))
+        path = os.path.realpath(os.path.join(base, *rest))
+        if path != base and not path.startswith(base + os.sep):
+            raise ValueError("Path escapes data dir: %s" % path)
+        return path
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        remaining = length
+        chunks = []
+        while remaining > 0:
+            chunk = self.rfile.read(min(remaining, 64*1024))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        body = b"".join(chunks)
+        self.stats.bytes_in += len(body)
+        return body
+
+    def _send(self, status, body=b"", content_type="application/json", headers={}):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+        self.stats.bytes_out += len(body)
+        self.stats.requests += 1
+
+    def _send_json(self, status, obj):
+        self._send(status, json.dumps(obj))
+
+    def do_POST(self):
+        unit_id, rest, query = self._parse()
+        self._read_body()
+        if rest == ["alive"]:
+            answer = {"alive": unit_id, "query": query}
+            encoding = co2unit_codec.pick(query.get("encodings", "").split(","), self.encodings)
+            if encoding:
+                answer["encoding"] = encoding
+            self._send_json(200, answer)
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_PUT(self):
+        unit_id, rest, query = self._parse()
+        if not rest or rest[0] != "push-sequential" or len(rest) < 2:
+            self._read_body()
+            return self._send_json(404, {"error": "not found"})
+
+        fpath = self._local_path(unit_id, rest[1:])
+        fname = rest[-1]
+        offset = int(query.get("offset", 0))
+        size = os.path.getsize(fpath) if os.path.exists(fpath) else 0
+
+        body = self._read_body()
+        encoding = query.get("encoding")
+        if encoding:
+            if encoding not in self.encodings:
+                return self._send_json(400, {"error": "unknown encoding %s" % encoding})
+            try:
+                body = co2unit_codec.decode(encoding, body)
+            except Exception as e:
+                return self._send_json(400, {"error": "cannot decode %s: %s" % (encoding, e)})
+
+        if offset != size:
+            return self._send_json(416, {"ack_file": [fname, size, size]})
+
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        with open(fpath, "ab") as f:
+            f.write(body)
+        size += len(body)
+        self._send_json(200, {"ack_file": [fname, size, size]})
+
+    def do_GET(self):
+        unit_id, rest, query = self._parse()
+        if unit_id is None:
+            return self._send_json(404, {"error": "not found"})
+
+        path = self._local_path(unit_id, rest)
+        if os.path.isdir(path):
+            if query.get("recursive") == "True":
+                listing = []
+                for root, dirs, files in os.walk(path):
+                    for f in files:
+                        listing.append(os.path.relpath(os.path.join(root, f), path))
+            else:
+                listing = os.listdir(path)
+            listing.sort()
+            return self._send_json(200, listing)
+
+        if not os.path.isfile(path):
+            return self._send_json(404, {"error": "not found"})
+
+        with open(path, "rb") as f:
+            content = f.read()
+
+        # Only the open-ended form that the unit uses to resume downloads
+        rng = self.headers.get("Range", "")
+        if rng.startswith("bytes=") and rng.endswith("-"):
+            start = int(rng[6:-1])
+            size = len(content)
+            if start >= size:
+                return self._send(416, headers={"Content-Range": "bytes */%d" % size})
+            headers = {"Content-Range": "bytes %d-%d/%d" % (start, size - 1, size)}
+            return self._send(206, content[start:],
+                    content_type="application/octet-stream", headers=headers)
+
+        self._send(200, content, content_type="application/octet-stream")
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--bind", default="127.0.0.1")
+    parser.add_argument("--data-dir", default="standin_data")
+    parser.add_argument("--quiet", action="store_true", help="Do not log each request")
+    parser.add_argument("--encodings", default=",".join(co2unit_codec.ENCODINGS),
+            help="Push encodings to accept, comma-separated (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    StandinHandler.data_dir = args.data_dir
+    StandinHandler.encodings = [e for e in args.encodings.split(",") if e]
+    StandinHandler.quiet = args.quiet
+    os.makedirs(args.data_dir, exist_ok=True)
+
+    server = ThreadingHTTPServer((args.bind, args.port), StandinHandler)
+    print("Serving %s on http://%s:%d" % (args.data_dir, args.bind, args.port), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print("\n%s" % StandinHandler.stats, file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
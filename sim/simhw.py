@@ -0,0 +1,1146 @@
+"""
+Simulated hardware for running whole wake cycles on the Unix port
+
+Stands in for everything the unit code touches below the Co2UnitHw layer:
+
+- utime/time        SimClock, a virtual clock. Sleeps advance it instantly.
+- machine           reset cause, deep sleep, internal RTC, WDT, pins, Chrono
+- pycom             NVS that survives deep sleep, plus the *_on_boot settings
+- explorir's UART   SimExplorIr, answering the sensor's UART commands
+- onewire           SimDs18x20 with a conversion delay
+- ds3231            SimDs3231, an external RTC on the virtual clock
+- sdcard            RamBlockDev, a RAM-backed SD card (FAT if the port has it)
+                    (SimSpiSdCard, the card's side of the SPI bus, is for
+                    testing the sdcard driver itself)
+- network, usocket  SimLte and SimSocket, talking to SimServer in-process
+
+Each fake charges a configurable latency (LATENCIES) to the virtual clock,
+so a wake costs about as much virtual time as it would on the device, and
+weeks of operation run in seconds. Sim.install() puts the fakes into
+sys.modules, so the unit code imports them instead of the real drivers.
+"""
+
+import sys
+
+try:
+    import uos as os
+except ImportError:
+    import os
+
+try:
+    import ustruct as struct
+except ImportError:
+    import struct
+
+# Virtual time charged for each operation, in ms, or kbit/s for link speeds.
+# Rough figures from logs of units in the field; override to try others.
+LATENCIES = {
+    "boot_ms":              1500,   # ROM boot, firmware init, imports up to main.py
+    "sd_init_ms":           40,     # SPI init and card identification
+    "sd_read_block_ms":     1,      # per 512-byte block
+    "sd_write_block_ms":    3,      # per 512-byte block
+    "co2_reply_ms":         20,     # until the CO2 sensor answers a UART command
+    "etemp_conversion_ms":  600,    # DS18x20 12-bit conversion
+    "lte_attach_ms":        9000,
+    "lte_connect_ms":       2500,
+    "lte_detach_ms":        1500,   # each of disconnect, detach and deinit
+    "dns_ms":               400,
+    "rtt_ms":               350,    # LTE-M round trip
+    "ntp_ms":               500,
+    "uplink_kbps":          120,
+    "downlink_kbps":        250,
+}
+
+PWRON_RESET = 0
+HARD_RESET = 1
+WDT_RESET = 2
+DEEPSLEEP_RESET = 3
+SOFT_RESET = 4
+
+BLOCK_SIZE = 512
+
+_sim = None
+
+class SimReset(KeyboardInterrupt):
+    """ Raised by machine.deepsleep() to end a wake
+
+    A subclass of KeyboardInterrupt, because that is the one exception the
+    TaskRunner lets through.
+    """
+    def __init__(self, cause, sleep_ms):
+        KeyboardInterrupt.__init__(self, cause, sleep_ms)
+        self.cause = cause
+        self.sleep_ms = sleep_ms
+
+# Time
+# --------------------------------------------------
+
+# Calendar arithmetic on days since 1970-01-01,
+# from http://howardhinnant.github.io/date_algorithms.html
+
+def days_from_civil(yy, mo, dd):
+    yy -= mo <= 2
+    era = yy // 400
+    yoe = yy - era * 400
+    doy = (153 * (mo - 3 if mo > 2 else mo + 9) + 2) // 5 + dd - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+def civil_from_days(days):
+    days += 719468
+    era = days // 146097
+    doe = days - era * 146097
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy + 2) // 153
+    dd = doy - (153 * mp + 2) // 5 + 1
+    mo = mp + 3 if mp < 10 else mp - 9
+    return yoe + era * 400 + (mo <= 2), mo, dd
+
+def mktime(tt):
+    """ Like the Pycom mktime: seconds since 1970, fields may overflow """
+    yy, mo, dd, hh, mm, ss = tt[0:6]
+    yy += (mo - 1) // 12
+    mo = (mo - 1) % 12 + 1
+    return ((days_from_civil(yy, mo, 1) + dd - 1) * 86400
+            + hh * 3600 + mm * 60 + ss)
+
+def gmtime(secs):
+    days, secs = divmod(secs, 86400)
+    yy, mo, dd = civil_from_days(days)
+    yd = days - days_from_civil(yy, 1, 1) + 1
+    return (yy, mo, dd, secs // 3600, secs // 60 % 60, secs % 60, (days + 3) % 7, yd)
+
+class SimClock(object):
+    """ Virtual clock, installed as the utime and time modules
+
+    ms is the true time since the start of the simulation. The internal RTC
+    (time(), localtime()) is the true time plus irtc_offset_ms. Ticks count
+    from the last boot, like on the device.
+    """
+
+    def __init__(self, start_secs):
+        self.start_secs = start_secs
+        self.ms = 0
+        self.boot_ms = 0
+        self.irtc_offset_ms = 0
+
+    def advance(self, ms):
+        if ms > 0:
+            self.ms += int(ms)
+
+    def true_secs(self):
+        return self.start_secs + self.ms // 1000
+
+    def boot(self):
+        self.boot_ms = self.ms
+
+    # utime API
+
+    def time(self):
+        return (self.start_secs * 1000 + self.ms + self.irtc_offset_ms) // 1000
+
+    def gmtime(self, secs=None):
+        return gmtime(self.time() if secs is None else int(secs))
+
+    localtime = gmtime
+
+    def mktime(self, tt):
+        return mktime(tt)
+
+    def ticks_ms(self):
+        return self.ms - self.boot_ms
+
+    def ticks_us(self):
+        return (self.ms - self.boot_ms) * 1000
+
+    ticks_cpu = ticks_us
+
+    def ticks_diff(self, a, b):
+        return a - b
+
+    def ticks_add(self, a, b):
+        return a + b
+
+    def sleep_ms(self, ms):
+        self.advance(ms)
+
+    def sleep_us(self, us):
+        self.advance(us // 1000)
+
+    def sleep(self, secs):
+        self.advance(secs * 1000)
+
+# machine
+# --------------------------------------------------
+
+class Pin(object):
+    IN = 1
+    OUT = 2
+    OPEN_DRAIN = 3
+    PULL_UP = 1
+    PULL_DOWN = 2
+
+    def __init__(self, id, mode=None, pull=None, value=None, alt=None):
+        self.id = id
+        self._value = value or 0
+
+    def __call__(self, value=None):
+        return self.value(value)
+
+    def value(self, value=None):
+        if value is None:
+            return self._value
+        self._value = value
+
+    def hold(self, hold=None):
+        pass
+
+class SPI(object):
+    MASTER = 0
+
+    def __init__(self, bus=0, *args, **kwargs):
+        pass
+
+    def init(self, *args, **kwargs):
+        pass
+
+    def deinit(self):
+        pass
+
+class WDT(object):
+    """ Counts feeds that came later than the timeout
+
+    A real watchdog would have reset the unit there. We only count, because
+    some unit code swallows exceptions around its feeds.
+    """
+
+    def __init__(self, id=0, timeout=5000):
+        self.timeout = timeout
+        self.last = _sim.clock.ms
+
+    def init(self, timeout):
+        self.timeout = timeout
+
+    def feed(self):
+        if _sim.clock.ms - self.last > self.timeout:
+            _sim.wake["wdt_late"] += 1
+        self.last = _sim.clock.ms
+
+class Chrono(object):
+    def __init__(self):
+        self._acc = 0
+        self._started = None
+
+    def _elapsed(self):
+        if self._started is None:
+            return self._acc
+        return self._acc + _sim.clock.ms - self._started
+
+    def start(self):
+        if self._started is None:
+            self._started = _sim.clock.ms
+
+    def stop(self):
+        self._acc = self._elapsed()
+        self._started = None
+
+    def reset(self):
+        self._acc = 0
+        if self._started is not None:
+            self._started = _sim.clock.ms
+
+    def read(self):
+        return self._elapsed() / 1000
+
+    def read_ms(self):
+        return self._elapsed()
+
+    def read_us(self):
+        return self._elapsed() * 1000
+
+class Timer(object):
+    Chrono = Chrono
+
+class SimRtc(object):
+    """ The internal RTC. It keeps running through deep sleep. """
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def now(self):
+        clock = _sim.clock
+        tt = clock.gmtime()
+        us = (clock.start_secs * 1000 + clock.ms + clock.irtc_offset_ms) % 1000 * 1000
+        return tt[0:6] + (us, None)
+
+    def init(self, tt):
+        clock = _sim.clock
+        us = tt[6] if len(tt) > 6 and tt[6] else 0
+        set_ms = mktime(tt) * 1000 + us // 1000
+        clock.irtc_offset_ms = set_ms - (clock.start_secs * 1000 + clock.ms)
+
+class SimMachine(object):
+    """ Stands in for the machine module """
+
+    PWRON_RESET = PWRON_RESET
+    HARD_RESET = HARD_RESET
+    WDT_RESET = WDT_RESET
+    DEEPSLEEP_RESET = DEEPSLEEP_RESET
+    SOFT_RESET = SOFT_RESET
+    PIN_WAKE = 1
+    RTC_WAKE = 2
+    WAKEUP_ALL_LOW = 0
+    WAKEUP_ANY_HIGH = 1
+
+    Pin = Pin
+    SPI = SPI
+    WDT = WDT
+    Timer = Timer
+    RTC = SimRtc
+
+    def __init__(self, sim):
+        self.sim = sim
+        self._rng = 12345
+
+    def UART(self, *args, **kwargs):
+        return self.sim.co2
+
+    def reset_cause(self):
+        return self.sim.reset_cause
+
+    def wake_reason(self):
+        return (self.RTC_WAKE, None)
+
+    def deepsleep(self, ms):
+        raise SimReset(DEEPSLEEP_RESET, ms)
+
+    def pin_sleep_wakeup(self, pins, mode, enable_pull=False):
+        pass
+
+    def unique_id(self):
+        return b"\x30\xae\xa4\x51\x7e\x00"
+
+    def rng(self):
+        # Deterministic, so runs can be compared
+        self._rng = (self._rng * 1103515245 + 12345) & 0xffffff
+        return self._rng
+
+    def disable_irq(self):
+        return 0
+
+    def enable_irq(self, state=0):
+        pass
+
+    def idle(self):
+        pass
+
+# pycom
+# --------------------------------------------------
+
+class SimPycom(object):
+    """ NVS and boot settings, which survive deep sleep """
+
+    def __init__(self):
+        self.nvram = {}
+        self.on_boot = {}
+        self.sets = 0
+
+    def nvs_get(self, key):
+        return self.nvram.get(key)
+
+    def nvs_set(self, key, value):
+        self.sets += 1
+        self.nvram[key] = value
+
+    def nvs_erase(self, key):
+        del self.nvram[key]
+
+    def nvs_erase_all(self):
+        self.nvram.clear()
+
+    def _boot_setting(self, key, value):
+        if value is None:
+            return self.on_boot.get(key)
+        self.on_boot[key] = value
+
+    def wifi_on_boot(self, value=None): return self._boot_setting("wifi", value)
+    def lte_modem_en_on_boot(self, value=None): return self._boot_setting("lte_modem", value)
+    def heartbeat_on_boot(self, value=None): return self._boot_setting("heartbeat", value)
+    def wdt_on_boot(self, value=None): return self._boot_setting("wdt", value)
+    def wdt_on_boot_timeout(self, value=None): return self._boot_setting("wdt_timeout", value)
+
+    def heartbeat(self, value=None):
+        pass
+
+    def rgbled(self, color):
+        pass
+
+# Sensors and external RTC
+# --------------------------------------------------
+
+class SimExplorIr(object):
+    """ The UART of an ExplorIR CO2 sensor
+
+    Answers each command after co2_reply_ms. Z readings come from the
+    current replay row, one per command, repeating the last one.
+    """
+
+    # A typical multi-field answer, by field
+    RAW_FIELDS = {"d": 32274, "h": 32989, "o": 31179, "v": 18373, "Z": 229}
+
+    def __init__(self, sim):
+        self.sim = sim
+        self.reset()
+
+    def reset(self):
+        self.reply = None
+        self.ready_ms = 0
+        self.mode = 0
+        self.mask = 0
+        self.nread = 0
+
+    def _answer(self, line):
+        self.reply = line.encode("ascii")
+        self.ready_ms = self.sim.clock.ms + self.sim.latencies["co2_reply_ms"]
+
+    def write(self, cmd):
+        cmd = bytes(cmd).decode("ascii").strip()
+        code = cmd[0:1]
+        arg = int(cmd[2:]) if len(cmd) > 2 else 0
+        if code == "K":
+            self.mode = arg
+            self._answer(" K %05d\r\n" % arg)
+        elif code == ".":
+            self._answer(" . 00001\r\n")
+        elif code == "Z":
+            co2s = self.sim.row()[1] or [0]
+            self._answer(" Z %05d\r\n" % co2s[min(self.nread, len(co2s) - 1)])
+            self.nread += 1
+        elif code == "M":
+            self.mask = arg
+            self._answer(" M %05d\r\n" % arg)
+        elif code == "Q":
+            import explorir
+            fields = ["%s %05d" % (f, self.RAW_FIELDS.get(f, 0))
+                    for f in sorted(explorir.FIELD_MASKS) if explorir.FIELD_MASKS[f] & self.mask]
+            self._answer(" " + " ".join(fields) + "\r\n")
+        else:
+            self._answer(" ? 00000\r\n")
+        return len(cmd)
+
+    def readline(self):
+        if self.reply is None or self.sim.clock.ms < self.ready_ms:
+            return None
+        line, self.reply = self.reply, None
+        return line
+
+    def any(self):
+        if self.reply is None or self.sim.clock.ms < self.ready_ms:
+            return 0
+        return len(self.reply)
+
+class SimOneWire(object):
+    def __init__(self, pin):
+        self.pin = pin
+
+class SimDs18x20(object):
+    def __init__(self, onewire):
+        self.ow = onewire
+        self.roms = [b"\x28\x00\x00\x00\x00\x00\x00\x00"]
+        self.ready_ms = None
+
+    def isbusy(self):
+        return self.ready_ms is None or _sim.clock.ms < self.ready_ms
+
+    def start_conversion(self, rom=None):
+        self.ready_ms = _sim.clock.ms + _sim.latencies["etemp_conversion_ms"]
+
+    def read_temp_async(self, rom=None):
+        if self.isbusy():
+            return None
+        return _sim.row()[0]
+
+class SimOneWireModule(object):
+    OneWire = SimOneWire
+    DS18X20 = SimDs18x20
+
+class SimDs3231(object):
+    """ External RTC, running on the true time plus its own offset """
+
+    def __init__(self, bus, pins=None, baudrate=400000):
+        pass
+
+    def _secs(self):
+        clock = _sim.clock
+        return (clock.start_secs * 1000 + clock.ms + _sim.ertc_offset_ms) // 1000
+
+    def get_time(self, set_rtc=False):
+        tt = gmtime(self._secs())[0:6] + (0, 0)
+        if set_rtc:
+            SimRtc().init(tt[0:6] + (0,))
+        return tt
+
+    def save_time(self):
+        clock = _sim.clock
+        _sim.ertc_offset_ms = clock.time() * 1000 - (clock.start_secs * 1000 + clock.ms)
+
+    def deinit(self):
+        pass
+
+class SimDs3231Module(object):
+    DS3231 = SimDs3231
+
+# SD card
+# --------------------------------------------------
+
+class RamBlockDev(object):
+    """ Block device in RAM, counting reads and writes """
+
+    def __init__(self, nblocks):
+        self.data = bytearray(nblocks * BLOCK_SIZE)
+        self.nblocks = nblocks
+        self.blocks_read = 0
+        self.blocks_written = 0
+
+    def readblocks(self, block_num, buf, offset=0):
+        start = block_num * BLOCK_SIZE + offset
+        mv = memoryview(self.data)
+        buf[:] = mv[start:start + len(buf)]
+        n = (len(buf) + BLOCK_SIZE - 1) // BLOCK_SIZE
+        self.blocks_read += n
+        _sim.clock.advance(n * _sim.latencies["sd_read_block_ms"])
+
+    def writeblocks(self, block_num, buf, offset=0):
+        start = block_num * BLOCK_SIZE + offset
+        self.data[start:start + len(buf)] = buf
+        n = (len(buf) + BLOCK_SIZE - 1) // BLOCK_SIZE
+        self.blocks_written += n
+        _sim.clock.advance(n * _sim.latencies["sd_write_block_ms"])
+
+    def ioctl(self, op, arg):
+        if op == 4:     # number of blocks
+            return self.nblocks
+        if op == 5:     # block size
+            return BLOCK_SIZE
+        return 0
+
+    def count(self):
+        return self.nblocks
+
+class SimSdCs(object):
+    """ Chip select pin of a SimSpiSdCard """
+    OUT = 2
+
+    def __init__(self, card):
+        self.card = card
+
+    def init(self, mode=None, value=1):
+        self(value)
+
+    def __call__(self, value):
+        self.card.selected = not value
+
+class SimSpiSdCard(object):
+    """ An SDHC card on the SPI bus, for the sdcard driver
+
+    Answers the bytes the driver clocks out as the card would: commands,
+    responses, data tokens and busy signalling. Use it as both the bus and,
+    through its cs attribute, the chip select pin:
+
+        card = SimSpiSdCard(2048)
+        sd = sdcard.SDCard(card, card.cs)
+
+    It keeps count of the commands, the bytes on the bus, and how long the
+    bus would take for them at the baudrate set (bus_us). Programming a block
+    keeps the card busy for a time, which the driver sees as polled bytes.
+    Above max_baudrate the card reads nothing but 0xff, like a bus clocked
+    faster than the wiring allows. Above max_data_baudrate, responses still
+    come through but data blocks and registers come back with bits flipped.
+    Runs without a Sim.
+    """
+    MASTER = 0
+
+    # Busy time in us: first block of a write command, each further block
+    # of a CMD25 run, and after the stop token. Rough figures; cards vary.
+    FIRST_BLOCK_US = 800
+    NEXT_BLOCK_US = 200
+    STOP_US = 400
+
+    # TRAN_SPEED of 25 Mbit/s
+    TRAN_SPEED = 0x32
+
+    def __init__(self, nblocks, max_baudrate=25000000, max_data_baudrate=None):
+        self.data = bytearray(nblocks * BLOCK_SIZE)
+        self.nblocks = nblocks
+        self.max_baudrate = max_baudrate
+        self.max_data_baudrate = max_data_baudrate or max_baudrate
+        self.cs = SimSdCs(self)
+        self.selected = False
+        self.baudrate = 100000
+        self.idle = True
+        self.app_cmd = False
+        self.cmdbuf = bytearray(6)
+        self.ncmd = 0
+        self.out = bytearray()
+        self.outpos = 0
+        self.mode = None
+        self.block = 0
+        self.first = True
+        self.rx = bytearray(BLOCK_SIZE + 2)
+        self.nrx = -1
+        self.reset_counts()
+
+    def reset_counts(self):
+        self.commands = {}
+        self.nbytes = 0
+        self.bus_us = 0
+        self.reads = 0
+
+    def ncommands(self):
+        return sum(self.commands.values())
+
+    # The bus
+    # --------------------------------------------------
+
+    def init(self, *args, baudrate=None, **kwargs):
+        if baudrate:
+            self.baudrate = baudrate
+
+    def deinit(self):
+        pass
+
+    def write(self, buf):
+        for b in buf:
+            self._byte(b)
+
+    def read(self, nbytes, write=0x00):
+        # Allocates a result, unlike readinto
+        self.reads += 1
+        buf = bytearray(nbytes)
+        self.readinto(buf, write)
+        return bytes(buf)
+
+    def readinto(self, buf, write=0x00):
+        for i in range(len(buf)):
+            buf[i] = self._byte(write)
+
+    def write_readinto(self, wbuf, rbuf):
+        for i in range(len(wbuf)):
+            rbuf[i] = self._byte(wbuf[i])
+
+    # The card
+    # --------------------------------------------------
+
+    def _byte(self, mosi):
+        self.nbytes += 1
+        self.bus_us += 8000000 / self.baudrate
+        if not self.selected:
+            return 0xff
+        if self.baudrate > self.max_baudrate:
+            return 0xff
+
+        if self.outpos < len(self.out):
+            miso = self.out[self.outpos]
+            self.outpos += 1
+        elif self.mode == "read":
+            self._queue_block()
+            miso = 0xff
+        else:
+            miso = 0xff
+
+        if self.nrx >= 0:
+            self.rx[self.nrx] = mosi
+            self.nrx += 1
+            if self.nrx == len(self.rx):
+                self._block_received()
+        elif self.ncmd or mosi & 0xc0 == 0x40:
+            self.cmdbuf[self.ncmd] = mosi
+            self.ncmd += 1
+            if self.ncmd == len(self.cmdbuf):
+                self.ncmd = 0
+                self._command()
+        elif self.mode in ("write1", "write") and self.outpos == len(self.out):
+            if mosi == 0xfe and self.mode == "write1" or mosi == 0xfc and self.mode == "write":
+                self.nrx = 0
+            elif mosi == 0xfd and self.mode == "write":
+                self.mode = None
+                self._queue(b"\xff")
+                self._busy(self.STOP_US)
+        return miso
+
+    def _queue(self, data):
+        if self.outpos == len(self.out):
+            self.out = bytearray()
+            self.outpos = 0
+        self.out.extend(data)
+
+    def _busy(self, us):
+        self._queue(bytes((us * self.baudrate + 7999999) // 8000000))
+
+    def _queue_data(self, data):
+        if self.baudrate > self.max_data_baudrate:
+            data = bytes(b ^ 0x10 for b in data)
+        self._queue(b"\xff\xfe")
+        self._queue(data)
+        self._queue(b"\xff\xff")
+
+    def _queue_block(self):
+        start = self.block * BLOCK_SIZE
+        self._queue_data(self.data[start:start + BLOCK_SIZE])
+        self.block += 1
+
+    def _r1(self, r1, extra=b""):
+        self._queue(b"\xff")
+        self._queue(bytes([r1 | self.idle]))
+        self._queue(extra)
+
+    def _command(self):
+        cmd = self.cmdbuf[0] & 0x3f
+        arg = struct.unpack(">I", self.cmdbuf[1:5])[0]
+        app_cmd = self.app_cmd
+        self.app_cmd = False
+        self.commands[cmd] = self.commands.get(cmd, 0) + 1
+        if cmd == 12:
+            self.mode = None
+            self.out = bytearray()
+            self.outpos = 0
+            self._r1(0)
+            return
+        if self.mode:
+            self._r1(0x04)
+            return
+        if cmd == 0:
+            self.idle = True
+            self._r1(0)
+        elif cmd == 8:
+            self._r1(0, struct.pack(">I", arg & 0xfff))
+        elif cmd == 55:
+            self.app_cmd = True
+            self._r1(0)
+        elif cmd == 41 and app_cmd:
+            self.idle = False
+            self._r1(0)
+        elif cmd == 58:
+            self._r1(0, b"\xc0\xff\x80\x00")
+        elif cmd == 9:
+            csd = bytearray(16)
+            csd[0] = 0x40
+            csd[3] = self.TRAN_SPEED
+            c_size = self.nblocks // 1024 - 1
+            csd[7] = c_size >> 16 & 0x3f
+            csd[8] = c_size >> 8 & 0xff
+            csd[9] = c_size & 0xff
+            import sdcard
+            csd[15] = sdcard.crc7(csd[:15]) << 1 | 1
+            self._r1(0)
+            self._queue_data(csd)
+        elif cmd in (13, 16):
+            self._r1(0, b"\x00" if cmd == 13 else b"")
+        elif cmd in (17, 18, 24, 25) and arg >= self.nblocks:
+            self._r1(0x20)
+        elif cmd in (17, 18):
+            self._r1(0)
+            self.block = arg
+            self._queue_block()
+            if cmd == 18:
+                self.mode = "read"
+        elif cmd in (24, 25):
+            self._r1(0)
+            self.block = arg
+            self.first = True
+            self.mode = "write1" if cmd == 24 else "write"
+        else:
+            self._r1(0x04)
+
+    def _block_received(self):
+        self.nrx = -1
+        if self.block >= self.nblocks:
+            self._queue(b"\x0d")
+            return
+        start = self.block * BLOCK_SIZE
+        self.data[start:start + BLOCK_SIZE] = self.rx[:BLOCK_SIZE]
+        self.block += 1
+        self._queue(b"\x05")
+        self._busy(self.FIRST_BLOCK_US if self.first else self.NEXT_BLOCK_US)
+        self.first = False
+        if self.mode == "write1":
+            self.mode = None
+
+class SimSd(object):
+    """ The SD card, mounted as FAT on the RAM block device if we can
+
+    Ports without VfsFat (or CPython) get a scratch directory instead. Then
+    the bytes written are estimated from the growth of the files.
+    """
+
+    def __init__(self, nblocks=16 * 1024, scratch="sim_tmp_sd"):
+        self.bdev = RamBlockDev(nblocks)
+        self.fat = hasattr(os, "VfsFat")
+        self.mounted = False
+        if self.fat:
+            os.VfsFat.mkfs(self.bdev)
+            self.mount_point = "/sd"
+        else:
+            import fileutil
+            fileutil.rm_recursive(scratch)
+            fileutil.mkdirs(scratch)
+            self.mount_point = os.getcwd() + "/" + scratch
+
+    def SDCard(self, spi, cs):
+        _sim.clock.advance(_sim.latencies["sd_init_ms"])
+        return self.bdev
+
+    def mount(self, dev=None):
+        if self.fat and not self.mounted:
+            os.mount(os.VfsFat(dev or self.bdev), self.mount_point)
+        self.mounted = True
+
+    def umount(self):
+        if self.fat and self.mounted:
+            os.umount(self.mount_point)
+        self.mounted = False
+
+    def bytes_written(self):
+        if self.fat:
+            return self.bdev.blocks_written * BLOCK_SIZE
+        return _tree_size(self.mount_point)
+
+def _tree_size(path):
+    total = 0
+    for name in os.listdir(path):
+        fpath = path + "/" + name
+        st = os.stat(fpath)
+        if st[0] & 0x4000:
+            total += _tree_size(fpath)
+        else:
+            total += st[6]
+    return total
+
+def sim_hw_class(base, sd):
+    """ Co2UnitHw, with the SD card mounted through SimSd """
+
+    class SimCo2UnitHw(base):
+        SDCARD_MOUNT_POINT = sd.mount_point
+
+        def mount_sd_card(self):
+            if not self.sd_mounted:
+                sd.mount(self.sd_cache)
+            self.sd_mounted = True
+
+        def prepare_for_shutdown(self):
+            if self.sd_mounted:
+                self.flush_sd_cache()
+                sd.umount()
+                self.sd_mounted = False
+            base.prepare_for_shutdown(self)
+
+    return SimCo2UnitHw
+
+# LTE and server
+# --------------------------------------------------
+
+class SimLte(object):
+    """ The LTE modem. Attach and connect complete after their latencies. """
+
+    def __init__(self, *args, **kwargs):
+        _sim.lte_on(True)
+        self.attached_ms = None
+        self.connected_ms = None
+
+    def attach(self, *args, **kwargs):
+        self.attached_ms = _sim.clock.ms + _sim.latencies["lte_attach_ms"]
+
+    def isattached(self):
+        return self.attached_ms is not None and _sim.clock.ms >= self.attached_ms
+
+    def connect(self, *args, **kwargs):
+        self.connected_ms = _sim.clock.ms + _sim.latencies["lte_connect_ms"]
+
+    def isconnected(self):
+        return self.isattached() and self.connected_ms is not None \
+                and _sim.clock.ms >= self.connected_ms
+
+    def disconnect(self):
+        _sim.clock.advance(_sim.latencies["lte_detach_ms"])
+        self.connected_ms = None
+
+    def detach(self):
+        _sim.clock.advance(_sim.latencies["lte_detach_ms"])
+        self.attached_ms = None
+        self.connected_ms = None
+
+    def deinit(self, *args, **kwargs):
+        _sim.clock.advance(_sim.latencies["lte_detach_ms"])
+        self.attached_ms = None
+        self.connected_ms = None
+        _sim.lte_on(False)
+
+    def send_at_cmd(self, cmd):
+        if cmd == "AT+CSQ":
+            return "\r\n+CSQ: 18,99\r\n\r\nOK\r\n"
+        return "\r\nOK\r\n"
+
+class SimNetwork(object):
+    LTE = SimLte
+
+def _check_online():
+    if not _sim.online():
+        raise OSError(113, "EHOSTUNREACH")
+
+class SimServer(object):
+    """ In-process stand-in for the unit server
+
+    Follows host_scripts/standin_server.py: pings are accepted, pushes are
+    appended if the offset matches, and there are no updates to fetch.
+    Pushes are decoded in the encoding picked at the ping, from those in
+    encodings (see co2unit_codec). Only the sizes of pushed files are kept.
+    """
+
+    def __init__(self, encodings=("deflate", "tsvdelta")):
+        self.sizes = {}
+        self.requests = 0
+        self.encodings = encodings
+
+    def handle(self, method, path, body):
+        import co2unit_codec
+        self.requests += 1
+        path, _, query = path.partition("?")
+        query = dict([kv.split("=", 1) for kv in query.split("&") if "=" in kv])
+        parts = path.strip("/").split("/")
+        if method == "POST" and parts[2:] == ["alive"]:
+            encoding = co2unit_codec.pick(query.get("encodings", "").split(","), self.encodings)
+            if encoding:
+                return 200, b'{"alive": "%s", "encoding": "%s"}' % (parts[1].encode(), encoding.encode())
+            return 200, b'{"alive": "%s"}' % parts[1].encode()
+        if method == "PUT" and parts[2:3] == ["push-sequential"]:
+            fpath = "/".join(parts[3:])
+            fname = parts[-1]
+            offset = int(query.get("offset", 0))
+            if "encoding" in query:
+                body = co2unit_codec.decode(query["encoding"], body)
+            size = self.sizes.get(fpath, 0)
+            if offset == size:
+                size += len(body)
+                self.sizes[fpath] = size
+                status = 200
+            else:
+                status = 416
+            return status, b'{"ack_file": ["%s", %d, %d]}' % (fname.encode(), size, size)
+        return 404, b'{"error": "not found"}'
+
+class SimSocket(object):
+    """ A TCP connection to SimServer, or a UDP socket to an NTP server """
+
+    def __init__(self, af=2, type=1, proto=0):
+        self.udp = type == 2
+        self._head = b""
+        self._need = None
+        self._in = b""
+        self._pos = 0
+
+    def connect(self, addr):
+        _check_online()
+        _sim.clock.advance(_sim.latencies["rtt_ms"])
+
+    def settimeout(self, t): pass
+    def setblocking(self, flag): pass
+    def setsockopt(self, *args): pass
+    def close(self): pass
+
+    def write(self, data):
+        _check_online()
+        n = len(data)
+        _sim.radio(n, 0)
+        if self._need is None:
+            self._head += bytes(data)
+            i = self._head.find(b"\r\n\r\n")
+            if i < 0:
+                return n
+            lines = self._head[:i].decode().split("\r\n")
+            self._method, self._path = lines[0].split(" ")[0:2]
+            length = 0
+            for line in lines[1:]:
+                if line.lower().startswith("content-length:"):
+                    length = int(line[15:])
+            self._need = length - (len(self._head) - i - 4)
+            self._body = self._head[i + 4:]
+            self._head = b""
+        else:
+            self._need -= n
+            self._body += bytes(data)
+        if self._need <= 0:
+            self._need = None
+            status, body = _sim.server.handle(self._method, self._path, self._body)
+            self._respond(status, body)
+        return n
+
+    send = write
+
+    def _respond(self, status, body):
+        head = b"HTTP/1.1 %d X\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n" % (status, len(body))
+        self._in = self._in[self._pos:] + head + body
+        self._pos = 0
+        _sim.clock.advance(_sim.latencies["rtt_ms"])
+        _sim.radio(0, len(head) + len(body))
+
+    def readline(self):
+        i = self._in.find(b"\n", self._pos)
+        end = len(self._in) if i < 0 else i + 1
+        line = self._in[self._pos:end]
+        self._pos = end
+        return line
+
+    def read(self, n=-1):
+        end = len(self._in) if n is None or n < 0 else min(len(self._in), self._pos + n)
+        data = self._in[self._pos:end]
+        self._pos = end
+        return data
+
+    def readinto(self, buf, nbytes=None):
+        n = len(buf) if nbytes is None else nbytes
+        data = self.read(n)
+        buf[0:len(data)] = data
+        return len(data)
+
+    recv = read
+
+    def sendto(self, data, addr):
+        _check_online()
+        _sim.radio(len(data), 48)
+        _sim.clock.advance(_sim.latencies["ntp_ms"])
+        # NTP counts seconds from 1900
+        secs = _sim.clock.true_secs() + 2208988800
+        self._in = bytes(40) + struct.pack("!I", secs) + bytes(4)
+        self._pos = 0
+        return len(data)
+
+class SimUsocket(object):
+    AF_INET = 2
+    SOCK_STREAM = 1
+    SOCK_DGRAM = 2
+    IPPROTO_TCP = 6
+    socket = SimSocket
+
+    def getaddrinfo(self, host, port, *args):
+        _check_online()
+        _sim.clock.advance(_sim.latencies["dns_ms"])
+        return [(2, 1, 0, "", ("10.0.0.1", port))]
+
+# The simulation
+# --------------------------------------------------
+
+# Rows from doc/co2-unit-data-layout.md: (etemp, [co2 readings])
+DEFAULT_ROWS = [
+    (23.4375, [680, 700, 710, 710, 700, 690, 700, 700, 700, 700]),
+    (23.375, [800, 810, 810, 800, 850, 850, 850, 840, 840, 830]),
+    (23.375, [770, 780, 750, 740, 740, 740, 740, 740, 740, 740]),
+    (23.25, [690, 660, 660, 660, 690, 690, 680, 680, 680, 680]),
+]
+
+def read_replay_rows(fpath):
+    """ Reads (etemp, co2 readings) from a readings TSV file """
+    rows = []
+    with open(fpath) as f:
+        for line in f:
+            cols = line.rstrip("\r\n").split("\t")
+            if len(cols) < 7:
+                continue
+            etemp = None if cols[4] == "None" else float(cols[4])
+            co2s = [int(c) for c in cols[6:16] if c not in ("", "None")]
+            rows.append((etemp, co2s))
+    return rows
+
+class Sim(object):
+    """ One simulated unit: its clock, devices, card, NVS, and the server """
+
+    def __init__(self, start_secs, latencies=None, rows=None):
+        global _sim
+        _sim = self
+        self.latencies = dict(LATENCIES)
+        if latencies:
+            self.latencies.update(latencies)
+        self.rows = rows or DEFAULT_ROWS
+        self.row_index = -1
+        self.row_taken = True
+
+        self.clock = SimClock(start_secs)
+        self.machine = SimMachine(self)
+        self.pycom = SimPycom()
+        self.co2 = SimExplorIr(self)
+        self.ertc_offset_ms = 0
+        self.server = SimServer()
+        self.sd = None
+        self.reset_cause = DEEPSLEEP_RESET
+        self.lte_since = None
+        self.wake = None
+
+    def install(self):
+        """ Puts the fakes into sys.modules, in place of the real modules """
+        self.sd = SimSd()
+        for name, mod in [
+                ("utime", self.clock), ("time", self.clock),
+                ("machine", self.machine), ("pycom", self.pycom),
+                ("network", SimNetwork()), ("usocket", SimUsocket()),
+                ("onewire", SimOneWireModule()), ("ds3231", SimDs3231Module()),
+                ("sdcard", self.sd),
+                ]:
+            sys.modules[name] = mod
+
+    def row(self):
+        """ (etemp, co2 readings) for the measurement in this wake """
+        if not self.row_taken:
+            self.row_taken = True
+            self.row_index += 1
+        return self.rows[self.row_index % len(self.rows)]
+
+    def online(self):
+        return self.lte_since is not None
+
+    def lte_on(self, on):
+        if on and self.lte_since is None:
+            self.lte_since = self.clock.ms
+        elif not on and self.lte_since is not None:
+            self.wake["lte_ms"] += self.clock.ms - self.lte_since
+            self.lte_since = None
+
+    def radio(self, up, down):
+        self.wake["up"] += up
+        self.wake["down"] += down
+        lat = self.latencies
+        self.clock.advance(up * 8 // lat["uplink_kbps"] + down * 8 // lat["downlink_kbps"])
+
+    def begin_wake(self):
+        self.clock.boot()
+        self.co2.reset()
+        self.row_taken = False
+        self.wake = {
+                "secs": self.clock.true_secs(),
+                "awake_ms": 0,
+                "lte_ms": 0,
+                "up": 0,
+                "down": 0,
+                "sd_bytes": self.sd.bytes_written(),
+                "nvs_sets": self.pycom.sets,
+                "wdt_late": 0,
+                "tasks": [],
+                "errors": 0,
+                }
+        self.wake_start_ms = self.clock.ms
+        self.clock.advance(self.latencies["boot_ms"])
+
+    def end_wake(self, tasks, log_text):
+        """ Power goes off: finishes the stats of the wake and returns them """
+        wake = self.wake
+        self.lte_on(False)
+        self.sd.umount()
+        wake["awake_ms"] = self.clock.ms - self.wake_start_ms
+        wake["sd_bytes"] = self.sd.bytes_written() - wake["sd_bytes"]
+        wake["nvs_sets"] = self.pycom.sets - wake["nvs_sets"]
+        wake["tasks"] = tasks
+        wake["errors"] = log_text.count("ERROR:")
+        return wake
+
+    def deep_sleep(self, cause, ms):
+        self.reset_cause = cause
+        self.clock.advance(ms)
@@ -0,0 +1,221 @@
+"""
+Simulate weeks of unit operation on the Unix port, in seconds
+
+Runs the real wake cycle of co2unit_main2 (BootUp ... SleepUntilScheduled)
+over and over on simulated hardware (see simhw.py). Deep sleep advances the
+virtual clock instead of stopping the CPU. Each wake starts with freshly
+imported unit modules, as after a real deep sleep; only NVS, the RTCs, the
+SD card and the server keep their state.
+
+Usage (make simulate SIM_ARGS="..."):
+
+    simulate.py [--days 7] [--start "2021-06-01 00:00:00"]
+                [--replay readings-0000.tsv] [--latency name=ms ...]
+                [--conf ou-measure-config.json='{"co2_mode": "adaptive"}' ...]
+                [--import-profile] [--verbose]
+
+--replay takes a readings TSV from a unit, whose CO2 and temperature values
+the simulated sensors answer with, one row per measurement. Latency names
+are the keys of simhw.LATENCIES.
+
+Prints awake time, LTE time, data sent, and bytes written to the SD card,
+per simulated day. With --import-profile, also prints the imports of the
+first wake of each kind (see importprof.py), timed by the host clock.
+"""
+
+import gc
+import json
+import logging
+import sys
+import uio
+
+try:
+    import uos as os
+except ImportError:
+    import os
+
+try:
+    import utime as host_time
+except ImportError:
+    import time as host_time
+
+import importprof
+import simhw
+
+SITE_CODE = "sim-01"
+SYNC_DEST = "http://sim-server:8080"
+
+def parse_args(argv):
+    args = {
+            "days": 7,
+            "start": "2021-06-01 00:00:00",
+            "replay": None,
+            "latencies": {},
+            "confs": {},
+            "verbose": False,
+            "import_profile": False,
+            }
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg in ("--verbose", "--import-profile"):
+            args[arg[2:].replace("-", "_")] = True
+            i += 1
+            continue
+        if i + 1 >= len(argv):
+            raise ValueError("Missing value for %s" % arg)
+        val = argv[i+1]
+        if arg == "--days":
+            args["days"] = int(val)
+        elif arg == "--start":
+            args["start"] = val
+        elif arg == "--replay":
+            args["replay"] = val
+        elif arg == "--latency":
+            name, ms = val.split("=", 1)
+            if name not in simhw.LATENCIES:
+                raise ValueError("Unknown latency %r. Known: %s" % (name, sorted(simhw.LATENCIES)))
+            args["latencies"][name] = int(ms)
+        elif arg == "--conf":
+            fname, text = val.split("=", 1)
+            args["confs"][fname] = json.loads(text)
+        else:
+            raise ValueError("Unknown argument %r" % arg)
+        i += 2
+    return args
+
+def setup_sd(sim, confs):
+    """ Writes the unit's configuration to the simulated SD card """
+    import fileutil
+    sim.sd.mount()
+    conf_dir = sim.sd.mount_point + "/conf"
+    fileutil.mkdirs(conf_dir)
+    confs = dict(confs)
+    confs.setdefault("ou-id.json", {}).setdefault("site_code", SITE_CODE)
+    confs.setdefault("ou-comm-config.json", {}).setdefault("sync_dest", SYNC_DEST)
+    for fname in confs:
+        with open(conf_dir + "/" + fname, "w") as f:
+            f.write(json.dumps(confs[fname]))
+    sim.sd.umount()
+
+def forget_modules(keep):
+    """ Unloads modules imported since keep was taken, as a reset would """
+    for name in list(sys.modules):
+        if name not in keep:
+            del sys.modules[name]
+    # The sim keeps logging loaded; drop what the unit added to it
+    logging._loggers.clear()
+    del logging._handlers[:]
+    gc.collect()
+
+def run_wake(sim, home, verbose=False, import_profile=False):
+    """ Runs one wake, from boot to deep sleep, and returns its stats """
+    sim.begin_wake()
+    log = uio.StringIO()
+    logging.basicConfig(level=logging.INFO, stream=log)
+    if import_profile:
+        importprof.install()
+
+    import co2unit_hw
+    co2unit_hw.Co2UnitHw = simhw.sim_hw_class(co2unit_hw.Co2UnitHw, sim.sd)
+    import co2unit_main2 as main
+
+    # Same as main.py, with MainWrapper's last resort sleep
+    main.wdt = sim.machine.WDT(timeout=main.RUNNING_WDT_MS)
+    runner = main.TaskRunner()
+    try:
+        runner.run(main.BootUp, main.SleepUntilScheduled)
+        sim.machine.deepsleep(main.LAST_RESORT_DEEPSLEEP_MS)
+    except simhw.SimReset as e:
+        reset = e
+    importprof.uninstall()
+
+    os.chdir(home)
+    text = log.getvalue()
+    if verbose:
+        print(text)
+    wake = sim.end_wake([type(t).__name__ for t in runner.history], text)
+    if import_profile:
+        wake["imports"] = importprof.records[:]
+    sim.deep_sleep(reset.cause, reset.sleep_ms)
+    return wake
+
+def day_totals(wakes, start_secs):
+    days = []
+    for wake in wakes:
+        day = (wake["secs"] - start_secs) // 86400
+        while len(days) <= day:
+            days.append({"wakes": 0, "meas": 0, "comm": 0, "awake_ms": 0, "lte_ms": 0,
+                "up": 0, "down": 0, "sd_bytes": 0, "nvs_sets": 0, "errors": 0, "wdt_late": 0})
+        d = days[day]
+        d["wakes"] += 1
+        d["meas"] += wake["tasks"].count("TakeMeasurement")
+        d["comm"] += wake["tasks"].count("Communicate")
+        for key in ["awake_ms", "lte_ms", "up", "down", "sd_bytes", "nvs_sets", "errors", "wdt_late"]:
+            d[key] += wake[key]
+    return days
+
+COLUMNS = [
+        ("wakes", "wakes", 1),
+        ("meas", "meas", 1),
+        ("comm", "comm", 1),
+        ("awake_ms", "awake_ms", 1),
+        ("lte_ms", "lte_ms", 1),
+        ("up", "up_KiB", 1024),
+        ("down", "down_KiB", 1024),
+        ("sd_bytes", "sd_KiB", 1024),
+        ("nvs_sets", "nvs_sets", 1),
+        ("errors", "errors", 1),
+        ("wdt_late", "wdt_late", 1),
+        ]
+
+def report(days, start_secs):
+    print("{:10}".format("day") + "".join(["{:>10}".format(title) for _, title, _ in COLUMNS]))
+    for i, d in enumerate(days):
+        date = "{:04}-{:02}-{:02}".format(*simhw.gmtime(start_secs + i * 86400)[0:3])
+        print("{:10}".format(date) + "".join(["{:10.1f}".format(d[key] / div) for key, _, div in COLUMNS]))
+    n = len(days) or 1
+    print("{:10}".format("mean/day") + "".join(
+        ["{:10.1f}".format(sum([d[key] for d in days]) / div / n) for key, _, div in COLUMNS]))
+
+def main(argv):
+    args = parse_args(argv)
+    rows = simhw.read_replay_rows(args["replay"]) if args["replay"] else None
+
+    yy, mo, dd = [int(p) for p in args["start"].split(" ")[0].split("-")]
+    hh, mm, ss = [int(p) for p in (args["start"].split(" ") + ["0:0:0"])[1].split(":")]
+    start_secs = simhw.mktime((yy, mo, dd, hh, mm, ss))
+
+    sim = simhw.Sim(start_secs, args["latencies"], rows)
+    sim.install()
+    home = os.getcwd()
+    keep = set(sys.modules)
+
+    setup_sd(sim, args["confs"])
+    forget_modules(keep)
+
+    if not sim.sd.fat:
+        print("No FAT support on this port. SD bytes are the growth of the files on it.")
+
+    end_secs = start_secs + args["days"] * 86400
+    wakes = []
+    profiled = []
+    wall_start = host_time.ticks_ms()
+    while sim.clock.true_secs() < end_secs:
+        wake = run_wake(sim, home, args["verbose"], args["import_profile"])
+        wakes.append(wake)
+        forget_modules(keep)
+        if args["import_profile"] and wake["tasks"] not in profiled:
+            profiled.append(wake["tasks"])
+            print("Imports of wake running %s" % ", ".join(wake["tasks"]))
+            importprof.records[:] = wake.pop("imports")
+            importprof.report()
+            print()
+    wall_ms = host_time.ticks_diff(host_time.ticks_ms(), wall_start)
+
+    report(day_totals(wakes, start_secs), start_secs)
+    print("%d wakes over %d days simulated in %d ms" % (len(wakes), args["days"], wall_ms))
+    print("Server received %d requests; files: %s" % (sim.server.requests, sim.server.sizes))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
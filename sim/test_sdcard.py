@@ -0,0 +1,138 @@
+"""
+Tests the sdcard driver against SimSpiSdCard, a card on a simulated SPI bus
+"""
+
+import unittest
+
+try:
+    import uos as os
+except ImportError:
+    import os
+
+import sdcard
+import simhw
+
+NBLOCKS = 2048
+
+def pattern(block_num, nblocks=1):
+    buf = bytearray(nblocks * 512)
+    for i in range(nblocks):
+        for j in range(0, 512, 8):
+            buf[i * 512 + j] = (block_num + i) & 0xff
+            buf[i * 512 + j + 1] = j >> 3
+    return buf
+
+class TestSdCardInit(unittest.TestCase):
+
+    def test_tran_speed(self):
+        self.assertEqual(sdcard.tran_speed(0x32), 25000000)
+        self.assertEqual(sdcard.tran_speed(0x5a), 50000000)
+        self.assertEqual(sdcard.tran_speed(0x79), 8000000)
+        self.assertEqual(sdcard.tran_speed(0x07), 0)
+
+    def test_init(self):
+        card = simhw.SimSpiSdCard(NBLOCKS)
+        sd = sdcard.SDCard(card, card.cs)
+        self.assertEqual(sd.count(), NBLOCKS)
+        self.assertEqual(sd.ioctl(4, 0), NBLOCKS)
+        self.assertEqual(sd.ioctl(5, 0), 512)
+        self.assertEqual(sd.baudrate, sdcard.RAMP_BAUDRATES[-1])
+
+    def test_ramp_stops_at_rated_speed(self):
+        card = simhw.SimSpiSdCard(NBLOCKS)
+        card.TRAN_SPEED = 0x79
+        sd = sdcard.SDCard(card, card.cs)
+        self.assertEqual(sd.baudrate, 5000000)
+
+    def test_ramp_falls_back(self):
+        card = simhw.SimSpiSdCard(NBLOCKS, max_baudrate=6000000)
+        sd = sdcard.SDCard(card, card.cs)
+        self.assertEqual(sd.baudrate, 5000000)
+        sd.writeblocks(3, pattern(3))
+        buf = bytearray(512)
+        sd.readblocks(3, buf)
+        self.assertEqual(buf, pattern(3))
+
+    def test_crc7(self):
+        # CMD0 and CMD8 (0x1aa) as sent at init, with their CRC bytes
+        self.assertEqual(sdcard.crc7(b"\x40\x00\x00\x00\x00"), 0x95 >> 1)
+        self.assertEqual(sdcard.crc7(b"\x48\x00\x00\x01\xaa"), 0x87 >> 1)
+
+    def test_ramp_checks_data(self):
+        # CMD13 would pass at 10 MHz, but data comes back corrupt
+        card = simhw.SimSpiSdCard(NBLOCKS, max_data_baudrate=6000000)
+        sd = sdcard.SDCard(card, card.cs)
+        self.assertEqual(sd.baudrate, 5000000)
+        sd.writeblocks(3, pattern(3))
+        buf = bytearray(512)
+        sd.readblocks(3, buf)
+        self.assertEqual(buf, pattern(3))
+
+    def test_no_ramp(self):
+        card = simhw.SimSpiSdCard(NBLOCKS)
+        sd = sdcard.SDCard(card, card.cs, ramp=())
+        self.assertEqual(sd.baudrate, sdcard.INIT_BAUDRATE)
+
+class TestSdCardBlocks(unittest.TestCase):
+
+    def setUp(self):
+        self.card = simhw.SimSpiSdCard(NBLOCKS)
+        self.sd = sdcard.SDCard(self.card, self.card.cs)
+        self.card.reset_counts()
+
+    def test_read_write(self):
+        sd = self.sd
+        sd.writeblocks(10, pattern(10))
+        sd.writeblocks(20, pattern(20, 4))
+        buf = bytearray(512)
+        sd.readblocks(10, buf)
+        self.assertEqual(buf, pattern(10))
+        buf = bytearray(4 * 512)
+        sd.readblocks(20, buf)
+        self.assertEqual(buf, pattern(20, 4))
+
+    def test_adjacent_writes_are_one_run(self):
+        sd = self.sd
+        for i in range(8):
+            sd.writeblocks(100 + i, pattern(100 + i))
+        sd.writeblocks(108, pattern(108, 2))
+        self.assertEqual(self.card.commands, {25: 1})
+        self.assertEqual(sd.run_next, 110)
+        sd.ioctl(3, 0)
+        self.assertEqual(sd.run_next, -1)
+        self.assertEqual(self.card.data[100*512:110*512], pattern(100, 10))
+
+    def test_run_ends(self):
+        sd = self.sd
+        sd.writeblocks(100, pattern(100))
+        sd.writeblocks(50, pattern(50))
+        self.assertEqual(self.card.commands, {25: 2})
+        # A read ends the run before its command
+        buf = bytearray(512)
+        sd.readblocks(50, buf)
+        self.assertEqual(buf, pattern(50))
+        self.assertEqual(sd.run_next, -1)
+        sd.writeblocks(51, pattern(51))
+        self.assertEqual(self.card.commands, {25: 3, 17: 1})
+        sd.sync()
+        self.assertEqual(sd.run_next, -1)
+
+    def test_polling_does_not_allocate(self):
+        sd = self.sd
+        sd.writeblocks(0, pattern(0))
+        sd.writeblocks(1, pattern(1, 3))
+        sd.sync()
+        sd.readblocks(0, bytearray(512))
+        self.assertEqual(self.card.reads, 0)
+
+    def test_fat(self):
+        if not hasattr(os, "VfsFat"):
+            raise unittest.SkipTest("No VfsFat in this port")
+        os.VfsFat.mkfs(self.sd)
+        vfs = os.VfsFat(self.sd)
+        with vfs.open("/data.txt", "w") as f:
+            for i in range(100):
+                f.write("line %03d of some data\n" % i)
+        with vfs.open("/data.txt", "r") as f:
+            lines = f.read().split("\n")
+        self.assertEqual(lines[42], "line 042 of some data")
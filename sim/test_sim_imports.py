@@ -0,0 +1,87 @@
+"""
+Tests that a measurement wake imports only the modules it needs
+
+Runs one wake after deep sleep in the simulator, with a measurement due,
+and records its imports with importprof. Every module imported costs boot
+time and heap on every wake, dozens of times a day.
+"""
+
+import logging
+import sys
+import unittest
+
+try:
+    import uos as os
+except ImportError:
+    import os
+
+import importprof
+import simhw
+import simulate
+
+# Unit modules (from the same directory as importprof) that a measurement
+# wake may import. Think twice before adding to this list.
+MEASUREMENT_WAKE_IMPORTS = [
+        "blockcache",
+        "co2unit_acquire",
+        "co2unit_hw",
+        "co2unit_id",
+        "co2unit_main2",
+        "co2unit_measure",
+        "co2unit_settle",
+        "co2unit_update",
+        "configutil",
+        "explorir",
+        "fileutil",
+        "pycom_util",
+        "schedule",
+        "seqfile",
+        "timeutil",
+        ]
+
+# Test infrastructure, loaded before the wake starts
+KEEP = ["importprof", "logging", "mock_apis", "unittest"]
+
+def dirname(path):
+    return "/".join(path.split("/")[:-1])
+
+def unit_dir():
+    return dirname(importprof.__file__)
+
+def unit_modules():
+    """ Names of the loaded modules from the unit's directory """
+    return [name for name, mod in list(sys.modules.items())
+            if dirname(getattr(mod, "__file__", "")) == unit_dir()]
+
+class TestMeasurementWakeImports(unittest.TestCase):
+
+    def run_wake(self):
+        saved_modules = dict(sys.modules)
+        saved_log = (logging._level, logging._stream)
+        home = os.getcwd()
+        try:
+            sim = simhw.Sim(simhw.mktime((2021, 6, 1, 0, 0, 0)))
+            sim.install()
+            simulate.setup_sd(sim, {})
+
+            # Start with none of the unit's modules loaded, like after deep sleep
+            for name in unit_modules():
+                if name not in KEEP and not name.startswith("test_"):
+                    del sys.modules[name]
+
+            wake = simulate.run_wake(sim, home, import_profile=True)
+            imported = [name for name in importprof.imported() if name in unit_modules()]
+        finally:
+            os.chdir(home)
+            sys.modules.clear()
+            sys.modules.update(saved_modules)
+            logging.basicConfig(level=saved_log[0], stream=saved_log[1])
+        return wake, imported
+
+    def test_measurement_wake_import_set(self):
+        wake, imported = self.run_wake()
+        self.assertEqual(wake["tasks"], ["BootUp", "InitPeripherals", "CheckForUpdates", "CheckSchedule", "TakeMeasurement"])
+        self.assertEqual(wake["errors"], 0)
+        self.assertIn("co2unit_measure", imported)
+        extra = [name for name in imported if name not in MEASUREMENT_WAKE_IMPORTS]
+        self.assertEqual(extra, [])
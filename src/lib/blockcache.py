@@ -0,0 +1,129 @@
+import logging
+
+_logger = logging.getLogger("blockcache")
+#_logger.setLevel(logging.DEBUG)
+
+BLOCK_SIZE = const(512)
+
+class BlockCache(object):
+    """ Write-back LRU cache of single blocks, in front of a block device
+
+    Has the readblocks/writeblocks/ioctl block device protocol, so VfsFat
+    can mount it in place of the device. Appending a line to a file makes
+    FAT rewrite the same FAT and directory entry blocks; with the cache,
+    those rewrites stay in RAM and go to the device once, on flush() or
+    when their slot is needed for another block.
+
+    Only single-block reads and writes are cached. Longer ones are file
+    data in bulk, which would only push the FAT blocks out: they go to the
+    device directly, and the cached copies of any blocks they cover are
+    kept up to date.
+
+    A sync from the filesystem (ioctl 3), which FAT does on every file close,
+    does not write back unless flush_on_sync is set. The writes held are
+    lost on a reset without flush(): call it before unmounting.
+    """
+
+    def __init__(self, dev, slots=8, flush_on_sync=False):
+        self.dev = dev
+        self.flush_on_sync = flush_on_sync
+        self.buf = bytearray(slots * BLOCK_SIZE)
+        self.mv = memoryview(self.buf)
+        self.slots = [self.mv[i*BLOCK_SIZE:(i+1)*BLOCK_SIZE] for i in range(slots)]
+        # Per slot: block number (-1 if free), dirty flag, and last use
+        self.blocks = [-1] * slots
+        self.dirty = [False] * slots
+        self.used = [0] * slots
+        self.index = {}
+        self.clock = 0
+        self.hits = 0
+        self.misses = 0
+        self.writebacks = 0
+
+    def _touch(self, slot):
+        self.clock += 1
+        self.used[slot] = self.clock
+
+    def _write_back(self, slot):
+        self.dev.writeblocks(self.blocks[slot], self.slots[slot])
+        self.dirty[slot] = False
+        self.writebacks += 1
+
+    def _take_slot(self, block_num):
+        """ Frees the least recently used slot and assigns it to block_num """
+        slot = 0
+        for i in range(1, len(self.used)):
+            if self.used[i] < self.used[slot]:
+                slot = i
+        old = self.blocks[slot]
+        if old >= 0:
+            if self.dirty[slot]:
+                self._write_back(slot)
+            del self.index[old]
+        self.blocks[slot] = block_num
+        self.index[block_num] = slot
+        return slot
+
+    def readblocks(self, block_num, buf):
+        if len(buf) != BLOCK_SIZE:
+            self.dev.readblocks(block_num, buf)
+            # Blocks in the cache may be newer than on the device
+            mv = memoryview(buf)
+            for i in range(len(buf) // BLOCK_SIZE):
+                slot = self.index.get(block_num + i)
+                if slot is not None and self.dirty[slot]:
+                    mv[i*BLOCK_SIZE:(i+1)*BLOCK_SIZE] = self.slots[slot]
+            return
+
+        slot = self.index.get(block_num)
+        if slot is None:
+            self.misses += 1
+            slot = self._take_slot(block_num)
+            self.dev.readblocks(block_num, self.slots[slot])
+        else:
+            self.hits += 1
+        self._touch(slot)
+        buf[:] = self.slots[slot]
+
+    def writeblocks(self, block_num, buf):
+        if len(buf) != BLOCK_SIZE:
+            self.dev.writeblocks(block_num, buf)
+            mv = memoryview(buf)
+            for i in range(len(buf) // BLOCK_SIZE):
+                slot = self.index.get(block_num + i)
+                if slot is not None:
+                    self.slots[slot][:] = mv[i*BLOCK_SIZE:(i+1)*BLOCK_SIZE]
+                    self.dirty[slot] = False
+            return
+
+        slot = self.index.get(block_num)
+        if slot is None:
+            self.misses += 1
+            slot = self._take_slot(block_num)
+        else:
+            self.hits += 1
+        self._touch(slot)
+        self.slots[slot][:] = buf
+        self.dirty[slot] = True
+
+    def flush(self):
+        """ Writes all dirty blocks back to the device, in block order """
+        dirty = sorted(self.blocks[i] for i in range(len(self.blocks)) if self.dirty[i])
+        for block_num in dirty:
+            self._write_back(self.index[block_num])
+        if dirty:
+            _logger.debug("Wrote back %d blocks (hits %d, misses %d)", len(dirty), self.hits, self.misses)
+        self.dev.ioctl(3, 0)
+
+    def ioctl(self, op, arg):
+        if op == 2: # deinit
+            self.flush()
+            return self.dev.ioctl(op, arg)
+        if op == 3: # sync
+            if self.flush_on_sync:
+                self.flush()
+            return 0
+        return self.dev.ioctl(op, arg)
+
+    def count(self):
+        return self.dev.ioctl(4, 0)
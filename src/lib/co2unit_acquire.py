@@ -0,0 +1,158 @@
+"""
+Reading all sensors of a measurement at the same time
+
+Each sensor is a task: a generator that does one step of work and then
+yields how many milliseconds to wait before its next step. run_tasks()
+steps whichever tasks are due and otherwise sleeps until the next
+deadline. So the external temperature conversion runs while the CO2
+sensor boots and settles, and nothing busy-waits.
+
+Each task records its phases (boot, conversion, reads) in a Trace, so we
+can see where the awake time goes.
+
+The clock is passed in (anything with ticks_ms, ticks_diff and sleep_ms,
+like the utime module), so this module has no device dependencies and can
+be tested with a virtual clock.
+"""
+
+import logging
+
+import co2unit_settle
+
+_logger = logging.getLogger("co2unit_acquire")
+#_logger.setLevel(logging.DEBUG)
+
+# Same as explorir.MODE_POLLING, without importing the UART driver here
+CO2_MODE_POLLING = const(2)
+
+# CO2 sensor needs time to boot after power-on before it answers on the UART.
+# In tests, about 165 ms seems to work.
+CO2_BOOT_MS = const(200)
+# Always take at least this many CO2 readings.
+# Experience shows that the first two are often way off.
+CO2_MIN_READS = const(2)
+
+# DS18x20 conversion takes up to 750 ms (12-bit)
+ETEMP_CONVERSION_MS = const(750)
+ETEMP_POLL_MS = const(20)
+ETEMP_TIMEOUT_MS = const(1000)
+
+class Trace(object):
+    """ Records phases as (name, start_ms, end_ms), relative to creation """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.t0 = clock.ticks_ms()
+        self.phases = []
+
+    def now(self):
+        return self.clock.ticks_diff(self.clock.ticks_ms(), self.t0)
+
+    def add(self, name, start):
+        end = self.now()
+        self.phases.append((name, start, end))
+        _logger.debug("%-12s %5d - %5d ms", name, start, end)
+
+    def __str__(self):
+        return ", ".join(["%s %d-%d" % p for p in self.phases])
+
+def run_tasks(tasks, trace, wdt=None):
+    """ Runs generator tasks until all are finished
+
+    Each task yields the number of ms until it wants to run again.
+    Between steps, sleeps until the earliest deadline.
+    """
+    # [deadline ms, task], deadlines relative to the trace start
+    pending = [[trace.now(), t] for t in tasks]
+    while pending:
+        for entry in list(pending):
+            if entry[0] > trace.now():
+                continue
+            try:
+                wait_ms = next(entry[1])
+                entry[0] = trace.now() + wait_ms
+            except StopIteration:
+                pending.remove(entry)
+        if wdt: wdt.feed()
+        if not pending:
+            break
+        sleep_ms = min([entry[0] for entry in pending]) - trace.now()
+        if sleep_ms > 0:
+            trace.clock.sleep_ms(sleep_ms)
+
+def etemp_task(hw, result, trace):
+    """ Reads the external temperature sensor into result["etemp"] """
+    start = trace.now()
+    result["etemp"] = None
+    result["etemp_ms"] = None
+    try:
+        etemp = hw.etemp
+        etemp.start_conversion()
+    except Exception as e:
+        _logger.error("Unexpected error starting etemp reading. %s: %s", type(e).__name__, e)
+        return
+    yield ETEMP_CONVERSION_MS
+    trace.add("etemp conv", start)
+
+    start = trace.now()
+    try:
+        while True:
+            reading = etemp.read_temp_async()
+            if reading is not None:
+                break
+            if trace.now() > ETEMP_TIMEOUT_MS:
+                _logger.error("Timeout reading external temp sensor after %d ms", trace.now())
+                break
+            yield ETEMP_POLL_MS
+        if reading is not None:
+            result["etemp"] = reading
+            result["etemp_ms"] = trace.now()
+            _logger.info("etemp reading : %6.3f C   at %4d ms", reading, trace.now())
+    except Exception as e:
+        _logger.error("Unexpected error waiting for etemp reading. %s: %s", type(e).__name__, e)
+    trace.add("etemp read", start)
+
+def co2_task(hw, readings, raw_fields, mc, result, trace):
+    """ Reads the CO2 sensor into readings until done, then reads raw fields
+
+    mc is the measurement config (see co2unit_settle.co2_done).
+    """
+    start = trace.now()
+    result["co2_samples"] = 0
+    result["co2_ms"] = None
+    result["co2_raws"] = {field:None for field in raw_fields}
+    yield CO2_BOOT_MS
+    trace.add("co2 boot", start)
+
+    start = trace.now()
+    co2 = None
+    try:
+        co2 = hw.co2
+        co2.set_mode(CO2_MODE_POLLING)
+    except Exception as e:
+        _logger.error("Unexpected error initializing CO2 sensor. %s: %s", type(e).__name__, e)
+    if co2 is None:
+        trace.add("co2 reads", start)
+        return
+    n = 0
+    while True:
+        try:
+            readings[n] = co2.read_co2()
+            _logger.info("CO2 reading #%d: %6d ppm at %4d ms", n, readings[n], trace.now())
+        except Exception as e:
+            _logger.error("Unexpected error during CO2 sensor reading #%d. %s: %s", n, type(e).__name__, e)
+        n += 1
+        if n >= CO2_MIN_READS and co2unit_settle.co2_done(readings, n, mc):
+            break
+        yield mc.co2_read_interval_ms
+    result["co2_samples"] = n
+    result["co2_ms"] = trace.now()
+    trace.add("co2 reads", start)
+
+    start = trace.now()
+    try:
+        co2.select_fields(raw_fields)
+        result["co2_raws"] = co2.read_fields()
+    except Exception as e:
+        _logger.error("Unexpected error reading co2 multi-fields. %s: %s", type(e).__name__, e)
+    trace.add("co2 raws", start)
@@ -0,0 +1,650 @@
+"""
+Per-month columnar archives of readings, compacted from closed TSV files
+
+Readings go to TSV files of up to 100 KiB (see co2unit_measure), so years
+of readings make thousands of files. Compaction (see compact) rolls each
+closed file into archives of one file per month, data/archive/readings-
+YYYY-MM.col, and removes the TSV files once the server has acknowledged
+them in the comm state's sync_states.
+
+An archive file is a sequence of segments, one per run of rows of a TSV
+file with the same month, hardware id and site code: usually one per file
+and month. Each segment is a header, an index and its columns (integers little-endian):
+
+    4 bytes     magic b"CO2A"
+    1 byte      format version (currently 1)
+    1 byte      number of CO2 reading columns (n_co2)
+    1 byte      number of raw ExplorIr field columns (n_raws)
+    1+n bytes   name of the TSV file (length-prefixed string)
+    1+n bytes   hardware id (length-prefixed string)
+    1+n bytes   site code (length-prefixed string)
+    uint16      number of rows (n)
+    uint32 * 2  earliest and latest reading time, seconds since 1970
+
+    Index, for each column but the time: float32 min, max and mean,
+    and uint16 count of values present. NaN and 0 if none are.
+
+    Columns, n values each:
+    uint32      ts          reading time, seconds since 1970
+    float32     etemp       external temperature (C), NaN if missing
+    uint16      flash_count camera flashes observed since last reading
+    float32     co2         mean of the row's CO2 readings, NaN if none
+    int32       co2_0 ...   CO2 readings (ppm), -1 if missing
+    int32       raw_0 ...   raw ExplorIr fields, -1 if missing
+
+Summaries over a time range (see summarize) use the index of each segment
+that the range covers whole, and read columns only for the segments at its
+ends.
+
+Lines of a TSV file that are not whole rows, such as one cut short by a
+reset, cannot go in a segment. They are kept as they are in a file of the
+same name in data/archive/skipped/.
+
+A reset while appending can leave a segment cut short at the end of an
+archive. Compaction cuts it off and appends it again, and a TSV file is
+only removed once all of its segments, and its skipped lines, are whole
+(see check_file).
+"""
+
+import logging
+import os
+
+try:
+    import uarray as array
+except ImportError:
+    import array
+
+try:
+    import ustruct as struct
+except ImportError:
+    import struct
+
+import configutil
+import fileutil
+import timeutil
+
+_logger = logging.getLogger("co2unit_archive")
+#_logger.setLevel(logging.DEBUG)
+
+wdt = timeutil.DummyWdt()
+
+MAGIC = b"CO2A"
+VERSION = 1
+
+MISSING_INT = -1
+NAN = float("nan")
+
+# len(co2unit_measure.CO2_RAWS), the fields at the end of each TSV row
+N_RAWS = const(5)
+
+TSV_MATCH = ("readings-", ".tsv")
+ARCHIVE_MATCH = ("readings-", ".col")
+
+READINGS_DIR = "data/readings"
+ARCHIVE_DIR = "data/archive"
+# In the archive dir, for lines that are not whole rows
+SKIPPED_DIR = "skipped"
+COMPACT_STATE_PATH = "var/compact-state.json"
+COMPACT_STATE_DEFAULTS = {
+        "compacted": None,  # Last TSV file rolled into the archives
+        }
+
+# Bounds the time one wake spends catching up on a backlog
+COMPACT_FILES_MAX = const(4)
+
+# Arrays hold the columns in native byte order, written as they are if that
+# is little-endian
+_NATIVE_LE = struct.pack("I", 1) == struct.pack("<I", 1)
+
+_INDEX_FMT = "<fffH"
+_INDEX_SIZE = const(14)
+
+class ArchiveFormatError(Exception): pass
+
+class Summary(object):
+    """ Min, max, mean and count of values, leaving out missing ones """
+
+    def __init__(self):
+        self.min = None
+        self.max = None
+        self.total = 0.0
+        self.count = 0
+
+    def add(self, value):
+        if value is None or value != value:
+            return
+        if self.count == 0 or value < self.min:
+            self.min = value
+        if self.count == 0 or value > self.max:
+            self.max = value
+        self.total += value
+        self.count += 1
+
+    def merge(self, vmin, vmax, mean, count):
+        if not count:
+            return
+        if self.count == 0 or vmin < self.min:
+            self.min = vmin
+        if self.count == 0 or vmax > self.max:
+            self.max = vmax
+        self.total += mean * count
+        self.count += count
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def __str__(self):
+        return "Summary(min=%s, max=%s, mean=%s, count=%d)" % (self.min, self.max, self.mean(), self.count)
+
+def columns(n_co2, n_raws):
+    """ (name, struct code) of each column of a segment """
+    return [("ts", "I"), ("etemp", "f"), ("flash_count", "H"), ("co2", "f")] \
+            + [("co2_%d" % i, "i") for i in range(n_co2)] \
+            + [("raw_%d" % i, "i") for i in range(n_raws)]
+
+def archive_name(month):
+    """ Archive file name for a month string, e.g. "2019-07" """
+    return ARCHIVE_MATCH[0] + month + ARCHIVE_MATCH[1]
+
+def _month_of(ts):
+    tt = timeutil.localtime(ts)
+    return "{:04}-{:02}".format(tt[0], tt[1])
+
+def _int_or_missing(s):
+    try:
+        return int(s)
+    except ValueError:
+        return MISSING_INT
+
+def parse_row(line, n_raws=N_RAWS):
+    """ Parses a TSV readings row as co2unit_measure.make_row lays it out
+
+    Returns (hw_id, site_code, month, (ts, etemp, flash_count, co2s, raws)),
+    or None if the line is not a whole row.
+    """
+    fields = line.rstrip("\n").split("\t")
+    if len(fields) < 6 + n_raws:
+        return None
+    hw_id, site_code, dateval, timeval = fields[0:4]
+    try:
+        ts = timeutil.mktime(timeutil.parse_time(dateval + " " + timeval))
+    except ValueError:
+        return None
+    try:
+        etemp = float(fields[4])
+    except ValueError:
+        etemp = None
+    flash_count = max(0, min(_int_or_missing(fields[5]), 0xffff))
+    end = len(fields) - n_raws
+    co2s = [_int_or_missing(v) for v in fields[6:end]]
+    raws = [_int_or_missing(v) for v in fields[end:]]
+    return hw_id, site_code, dateval[0:7], (ts, etemp, flash_count, co2s, raws)
+
+def _co2_mean(co2s):
+    present = [v for v in co2s if v != MISSING_INT]
+    return sum(present) / len(present) if present else None
+
+def _pack_str(s):
+    b = s.encode("utf-8")
+    if len(b) > 255:
+        raise ArchiveFormatError("String too long for header: %r" % s)
+    return bytes([len(b)]) + b
+
+class SegmentBuffer(object):
+    """ The columns of one segment, filled a row at a time
+
+    Each column is an array of its struct code, so the rows of a segment in
+    the making take a few bytes per value rather than objects per row.
+    """
+
+    def __init__(self, n_raws=N_RAWS):
+        self.n_raws = n_raws
+        self.ts = array.array("I")
+        self.etemp = array.array("f")
+        self.flash_count = array.array("H")
+        self.co2 = array.array("f")
+        self.co2s = []
+        self.raws = [array.array("i") for i in range(n_raws)]
+
+    def __len__(self):
+        return len(self.ts)
+
+    def add(self, record):
+        """ Adds a row, as parse_row returns it """
+        ts, etemp, flash_count, co2s, raws = record
+        # A row with more CO2 readings than the rows before adds columns
+        while len(self.co2s) < len(co2s):
+            self.co2s.append(array.array("i", [MISSING_INT] * len(self.ts)))
+        self.ts.append(ts)
+        self.etemp.append(NAN if etemp is None else etemp)
+        self.flash_count.append(flash_count)
+        mean = _co2_mean(co2s)
+        self.co2.append(NAN if mean is None else mean)
+        for i in range(len(self.co2s)):
+            self.co2s[i].append(co2s[i] if i < len(co2s) else MISSING_INT)
+        for i in range(self.n_raws):
+            self.raws[i].append(raws[i])
+
+    def parts(self, source, hw_id, site_code):
+        """ Generates the segment in parts: header and index, then each column
+
+        Columns come as the arrays themselves where the byte order allows,
+        to write without a copy.
+        """
+        n = len(self.ts)
+        if not 0 < n <= 0xffff:
+            raise ArchiveFormatError("Cannot pack %d rows in a segment" % n)
+        cols = [self.ts, self.etemp, self.flash_count, self.co2] + self.co2s + self.raws
+        specs = columns(len(self.co2s), self.n_raws)
+
+        parts = [MAGIC, bytes([VERSION, len(self.co2s), self.n_raws]),
+                _pack_str(source), _pack_str(hw_id), _pack_str(site_code),
+                struct.pack("<HII", n, min(self.ts), max(self.ts))]
+        for i in range(1, len(specs)):
+            code = specs[i][1]
+            s = Summary()
+            for v in cols[i]:
+                s.add(None if code == "i" and v == MISSING_INT else v)
+            if s.count:
+                parts.append(struct.pack(_INDEX_FMT, s.min, s.max, s.mean(), s.count))
+            else:
+                parts.append(struct.pack(_INDEX_FMT, NAN, NAN, NAN, 0))
+        yield b"".join(parts)
+        for i in range(len(specs)):
+            if _NATIVE_LE:
+                yield cols[i]
+            else:
+                yield struct.pack("<%d%s" % (n, specs[i][1]), *cols[i])
+
+def pack_segment(source, hw_id, site_code, rows, n_raws=N_RAWS):
+    """ Packs rows, as parse_row returns them, into one segment """
+    buf = SegmentBuffer(n_raws)
+    for r in rows:
+        buf.add(r)
+    return b"".join([bytes(part) for part in buf.parts(source, hw_id, site_code)])
+
+def _read(f, n):
+    data = f.read(n)
+    if len(data) < n:
+        raise ArchiveFormatError("Segment cut short")
+    return data
+
+def _read_str(f):
+    n = _read(f, 1)[0]
+    return str(_read(f, n), "utf-8")
+
+def read_segment(f):
+    """ Reads the header and index of the segment at the file position
+
+    Returns a dictionary describing the segment, with the file position of
+    each column, and leaves the file at the next segment. Returns None at
+    the end of the file. Raises ArchiveFormatError if the segment is not
+    whole, including columns that would end past the end of the file.
+    """
+    head = f.read(7)
+    if not head:
+        return None
+    if len(head) < 7 or head[0:4] != MAGIC:
+        raise ArchiveFormatError("Bad segment start %r" % (head,))
+    if head[4] != VERSION:
+        raise ArchiveFormatError("Unsupported version %d" % head[4])
+    n_co2 = head[5]
+    n_raws = head[6]
+    source = _read_str(f)
+    hw_id = _read_str(f)
+    site_code = _read_str(f)
+    n, ts_first, ts_last = struct.unpack("<HII", _read(f, 10))
+
+    specs = columns(n_co2, n_raws)
+    index = {}
+    data = _read(f, _INDEX_SIZE * (len(specs) - 1))
+    for i in range(1, len(specs)):
+        index[specs[i][0]] = struct.unpack_from(_INDEX_FMT, data, _INDEX_SIZE * (i - 1))
+
+    pos = f.tell()
+    offsets = {}
+    for name, code in specs:
+        offsets[name] = (pos, code)
+        pos += n * struct.calcsize(code)
+    # Seeking past the end succeeds, so check against the size
+    f.seek(0, 2)
+    if f.tell() < pos:
+        raise ArchiveFormatError("Segment of %s cut short, %d of %d bytes" % (source, f.tell(), pos))
+    f.seek(pos)
+
+    return {
+            "source": source,
+            "hw_id": hw_id,
+            "site_code": site_code,
+            "n_co2": n_co2,
+            "n_raws": n_raws,
+            "rows": n,
+            "ts_first": ts_first,
+            "ts_last": ts_last,
+            "index": index,
+            "offsets": offsets,
+            }
+
+def segments(f):
+    """ Generates the segments of an archive file """
+    f.seek(0)
+    while True:
+        seg = read_segment(f)
+        if seg is None:
+            return
+        yield seg
+
+def archived(path):
+    """ The whole segments of an archive file and where they end
+
+    Returns a dictionary of the row counts of the segments by (source, hw_id,
+    site_code), summed over segments with the same key, and the file size up to the end of the last whole segment.
+    That is less than the file size if the last append was cut short.
+    """
+    present = {}
+    good = 0
+    if not fileutil.isfile(path):
+        return present, good
+    try:
+        with open(path, "rb") as f:
+            for seg in segments(f):
+                key = (seg["source"], seg["hw_id"], seg["site_code"])
+                present[key] = present.get(key, 0) + seg["rows"]
+                good = f.tell()
+    except ArchiveFormatError as e:
+        _logger.warning("%s: bad segment at %d: %s", path, good, e)
+    return present, good
+
+def read_column(f, seg, name):
+    """ The values of a column of a segment, with missing ones as None """
+    pos, code = seg["offsets"][name]
+    n = seg["rows"]
+    f.seek(pos)
+    vals = struct.unpack("<%d%s" % (n, code), f.read(n * struct.calcsize(code)))
+    if code == "i":
+        return [None if v == MISSING_INT else v for v in vals]
+    if code == "f":
+        return [None if v != v else v for v in vals]
+    return list(vals)
+
+def _row_value(record, name):
+    ts, etemp, flash_count, co2s, raws = record
+    if name == "ts":
+        return ts
+    if name == "etemp":
+        return etemp
+    if name == "flash_count":
+        return flash_count
+    if name == "co2":
+        return _co2_mean(co2s)
+    # co2_N or raw_N
+    vals = co2s if name.startswith("co2_") else raws
+    i = int(name[4:])
+    v = vals[i] if i < len(vals) else MISSING_INT
+    return None if v == MISSING_INT else v
+
+def summarize(column, since=None, until=None, archive_dir=ARCHIVE_DIR, tsv_paths=(), n_raws=N_RAWS):
+    """ Summary of a column over readings with since <= ts < until
+
+    Goes through the archives of the months in the range, and the rows of
+    tsv_paths, for readings not compacted yet (see uncompacted). For
+    example, the mean CO2 of the last 24 hours:
+
+        summarize("co2", since=now - 24*60*60, tsv_paths=uncompacted(...)).mean()
+    """
+    s = Summary()
+    lo = since if since is not None else 0
+    hi = until if until is not None else 0xffffffff
+    first = _month_of(since) if since is not None else None
+    last = _month_of(until) if until is not None else None
+
+    fnames = []
+    if fileutil.isdir(archive_dir):
+        fnames = sorted(os.listdir(archive_dir))
+    for fname in fnames:
+        if not fname.startswith(ARCHIVE_MATCH[0]) or not fname.endswith(ARCHIVE_MATCH[1]):
+            continue
+        month = fname[len(ARCHIVE_MATCH[0]):-len(ARCHIVE_MATCH[1])]
+        if (first and month < first) or (last and month > last):
+            continue
+        try:
+            with open(archive_dir + "/" + fname, "rb") as f:
+                for seg in segments(f):
+                    if column not in seg["offsets"] or seg["ts_last"] < lo or seg["ts_first"] >= hi:
+                        continue
+                    if lo <= seg["ts_first"] and seg["ts_last"] < hi and column != "ts":
+                        s.merge(*seg["index"][column])
+                        continue
+                    next_seg = f.tell()
+                    tss = read_column(f, seg, "ts")
+                    vals = read_column(f, seg, column)
+                    for i in range(len(tss)):
+                        if lo <= tss[i] < hi:
+                            s.add(vals[i])
+                    f.seek(next_seg)
+        except ArchiveFormatError as e:
+            # Until compaction cuts it off, use the segments before it
+            _logger.warning("%s: %s", fname, e)
+
+    for path in tsv_paths:
+        with open(path) as f:
+            for line in f:
+                parsed = parse_row(line, n_raws)
+                if parsed and lo <= parsed[3][0] < hi:
+                    s.add(_row_value(parsed[3], column))
+    return s
+
+def _present(path, present):
+    """ Rows already in the archive at path by key, kept in present
+
+    The first time, cuts off a segment cut short at the end of the archive.
+    """
+    if path not in present:
+        present[path], good = archived(path)
+        if fileutil.isfile(path) and good < fileutil.file_size(path):
+            _logger.warning("%s: cutting off %d bytes after the last whole segment",
+                    path, fileutil.file_size(path) - good)
+            fileutil.copy_file(path, path, wdt=wdt, size=good)
+    return present[path]
+
+def _append_segment(path, source, hw_id, site_code, buf):
+    if not len(buf):
+        return 0
+    with open(path, "ab") as f:
+        for part in buf.parts(source, hw_id, site_code):
+            f.write(part)
+    wdt.feed()
+    _logger.info("%s: %d rows to %s", source, len(buf), path)
+    return len(buf)
+
+def _skipped_path(archive_dir, source):
+    return archive_dir + "/" + SKIPPED_DIR + "/" + source
+
+def _line_count(path):
+    n = 0
+    with open(path) as f:
+        for line in f:
+            n += 1
+    return n
+
+def compact_file(tsv_path, archive_dir, n_raws=N_RAWS):
+    """ Appends the rows of a TSV file to the archives of their months
+
+    Streams the file a row at a time into a SegmentBuffer, and appends a
+    segment each time the month, hardware id or site code changes, so only
+    one segment is in RAM at a time. Lines that are not whole rows are
+    copied to the skipped dir instead, and blank lines left out.
+
+    Rows already in whole segments from the same file, from a run that
+    stopped before saving its state, are not written again: segments go out
+    in the order of the file, so those are the first rows of each key. A
+    segment cut short at the end of an archive is cut off first.
+    Returns the number of rows archived.
+    """
+    source = tsv_path.split("/")[-1]
+    fileutil.mkdirs(archive_dir, wdt=wdt)
+    present = {}
+    # Rows of the file so far, by (month, hw_id, site_code)
+    seen = {}
+    count = 0
+    skipped = 0
+    key = None
+    path = None
+    buf = None
+    skipped_f = None
+    try:
+        with open(tsv_path) as f:
+            for line in f:
+                parsed = parse_row(line, n_raws)
+                if not parsed:
+                    if not line.strip():
+                        continue
+                    if not skipped_f:
+                        fileutil.mkdirs(archive_dir + "/" + SKIPPED_DIR, wdt=wdt)
+                        skipped_f = open(_skipped_path(archive_dir, source), "w")
+                    skipped_f.write(line if line.endswith("\n") else line + "\n")
+                    skipped += 1
+                    continue
+                hw_id, site_code, month, record = parsed
+                if (month, hw_id, site_code) != key or len(buf) == 0xffff:
+                    if key:
+                        count += _append_segment(path, source, key[1], key[2], buf)
+                    key = (month, hw_id, site_code)
+                    path = archive_dir + "/" + archive_name(month)
+                    buf = SegmentBuffer(n_raws)
+                    done = _present(path, present).get((source, hw_id, site_code), 0)
+                n = seen.get(key, 0)
+                seen[key] = n + 1
+                if n < done:
+                    continue
+                buf.add(record)
+    finally:
+        if skipped_f:
+            skipped_f.close()
+    if key:
+        count += _append_segment(path, source, key[1], key[2], buf)
+    wdt.feed()
+
+    if skipped:
+        _logger.warning("%s: %d lines that are not whole rows kept in %s",
+                source, skipped, _skipped_path(archive_dir, source))
+    if count < sum(seen.values()):
+        _logger.info("%s: %d rows already archived", source, sum(seen.values()) - count)
+    return count
+
+def check_file(tsv_path, archive_dir, n_raws=N_RAWS):
+    """ Whether all rows of a TSV file are in whole segments of the archives
+
+    And its lines that are not whole rows in the skipped dir.
+    """
+    source = tsv_path.split("/")[-1]
+    seen = {}
+    skipped = 0
+    with open(tsv_path) as f:
+        for line in f:
+            parsed = parse_row(line, n_raws)
+            if parsed:
+                key = parsed[0:3]
+                seen[key] = seen.get(key, 0) + 1
+            elif line.strip():
+                skipped += 1
+    wdt.feed()
+    if skipped:
+        path = _skipped_path(archive_dir, source)
+        if not fileutil.isfile(path) or _line_count(path) != skipped:
+            _logger.warning("%s: %d skipped lines not whole in %s", source, skipped, path)
+            return False
+    present = {}
+    for key, rows in seen.items():
+        hw_id, site_code, month = key
+        path = archive_dir + "/" + archive_name(month)
+        if path not in present:
+            present[path] = archived(path)[0]
+        if present[path].get((source, hw_id, site_code)) != rows:
+            _logger.warning("%s: %s %s not whole in %s", source, hw_id, site_code, path)
+            return False
+    return True
+
+def _tsv_files(readings_dir):
+    if not fileutil.isdir(readings_dir):
+        return []
+    return sorted([fname for fname in os.listdir(readings_dir)
+        if fname.startswith(TSV_MATCH[0]) and fname.endswith(TSV_MATCH[1])])
+
+def uncompacted(readings_dir=READINGS_DIR, state_path=COMPACT_STATE_PATH):
+    """ Paths of the TSV files not rolled into the archives yet """
+    state = configutil.read_config_json(state_path, COMPACT_STATE_DEFAULTS)
+    return [readings_dir + "/" + fname for fname in _tsv_files(readings_dir)
+            if not state.compacted or fname > state.compacted]
+
+def compact(readings_dir=READINGS_DIR, archive_dir=ARCHIVE_DIR,
+        state_path=COMPACT_STATE_PATH, acked=None, max_files=COMPACT_FILES_MAX):
+    """ Rolls closed TSV files into the archives and removes acknowledged ones
+
+    All TSV files but the last, which readings are still appended to, are
+    closed. Up to max_files of them are compacted per call, in order.
+
+    acked is the file in the comm state's ack_file for the readings dir.
+    The server has all of the files before it, which are removed once
+    compacted and checked. The acknowledged file itself stays, because
+    push_sequential goes on from it by name.
+
+    Returns the lists of files compacted and removed.
+    """
+    state = configutil.read_config_json(state_path, COMPACT_STATE_DEFAULTS)
+    closed = _tsv_files(readings_dir)[:-1]
+
+    compacted = []
+    for fname in closed:
+        if state.compacted and fname <= state.compacted:
+            continue
+        if len(compacted) >= max_files:
+            _logger.info("Compacted %d files, leaving the rest for later", len(compacted))
+            break
+        compact_file(readings_dir + "/" + fname, archive_dir)
+        state.compacted = fname
+        configutil.save_config_json(state_path, state)
+        compacted.append(fname)
+
+    removed = []
+    if acked and state.compacted:
+        for fname in closed:
+            if fname < acked and fname <= state.compacted:
+                path = readings_dir + "/" + fname
+                if not check_file(path, archive_dir):
+                    compact_file(path, archive_dir)
+                    if not check_file(path, archive_dir):
+                        _logger.error("%s: still not whole in the archives, keeping it", fname)
+                        continue
+                os.remove(path)
+                removed.append(fname)
+                wdt.feed()
+        if removed:
+            _logger.info("Removed %d acknowledged files, %s to %s", len(removed), removed[0], removed[-1])
+
+    return compacted, removed
+
+def compact_sequence(hw, ctx=None):
+    """ Compacts the readings on the SD card
+
+    ctx shares the RTC sync, SD card and configs of the wake with other
+    tasks (see co2unit_main2.WakeContext).
+    """
+    _logger.info("Starting compaction...")
+
+    if ctx:
+        ctx.prepare_sd(hw)
+    else:
+        hw.sync_to_most_reliable_rtc(reset_ok=True)
+        hw.mount_sd_card()
+        os.chdir(hw.SDCARD_MOUNT_POINT)
+
+    import co2unit_comm
+    cs = configutil.read_config_json(co2unit_comm.COMM_STATE_PATH, co2unit_comm.COMM_STATE_DEFAULTS)
+    ack = cs.sync_states.get(READINGS_DIR, {}).get("ack_file")
+
+    return compact(
+            readings_dir=hw.SDCARD_MOUNT_POINT + "/" + READINGS_DIR,
+            archive_dir=hw.SDCARD_MOUNT_POINT + "/" + ARCHIVE_DIR,
+            state_path=hw.SDCARD_MOUNT_POINT + "/" + COMPACT_STATE_PATH,
+            acked=ack[0] if ack else None)
@@ -0,0 +1,196 @@
+"""
+Encodings for compressed uploads of pushed files
+
+The unit offers the encodings it can produce in the alive ping
+(?encodings=deflate,tsvdelta) and the server answers with the one it picks
+({"encoding": "tsvdelta"}), or none. A server that does not know about
+encodings answers without one, and the unit sends raw bytes as before.
+
+Each push then carries ?offset=N&encoding=E, and its body is the bytes of
+the file from N on, encoded on their own: no state is carried between
+requests. Offsets and the progress in acks count the bytes of the file, not
+of the encoded bodies, so resuming works the same either way.
+
+Encodings:
+
+- deflate   zlib stream (RFC 1950), where the firmware can compress
+- tsvdelta  line by line, each tab-separated field that is the same as the
+            field above it becomes the single byte 0x01. Fields that start
+            with 0x01 or 0x02 are escaped with a leading 0x02. Readings files
+            repeat the hardware id, site code and date on every line.
+
+This module has no device dependencies,
+so the same code is used by the stand-in server to decode.
+"""
+
+try:
+    import uio as io
+except ImportError:
+    import io
+
+DEFLATE = "deflate"
+TSVDELTA = "tsvdelta"
+ENCODINGS = (DEFLATE, TSVDELTA)
+
+# Compression window, 2**DEFLATE_WBITS bytes, for encoders that take one
+DEFLATE_WBITS = 10
+
+_SAME = b"\x01"
+_ESCAPE = b"\x02"
+
+class TsvDeltaEncoder(object):
+    """ Writes the tsvdelta encoding of the data written to it to out
+
+    Data may be written in pieces that split lines; the last line goes out
+    on finish().
+    """
+
+    def __init__(self, out):
+        self.out = out
+        self.prev = []
+        self.partial = b""
+
+    def write(self, data):
+        data = bytes(data)
+        start = 0
+        while True:
+            end = data.find(b"\n", start)
+            if end < 0:
+                break
+            line = data[start:end]
+            if self.partial:
+                line = self.partial + line
+                self.partial = b""
+            self._line(line)
+            self.out.write(b"\n")
+            start = end + 1
+        if start < len(data):
+            self.partial += data[start:]
+
+    def finish(self):
+        if self.partial:
+            self._line(self.partial)
+            self.partial = b""
+
+    def _line(self, line):
+        fields = line.split(b"\t")
+        prev = self.prev
+        out = self.out
+        for i in range(len(fields)):
+            if i:
+                out.write(b"\t")
+            field = fields[i]
+            if len(field) > 1 and i < len(prev) and field == prev[i]:
+                out.write(_SAME)
+            else:
+                if field[0:1] in (_SAME, _ESCAPE):
+                    out.write(_ESCAPE)
+                out.write(field)
+        self.prev = fields
+
+def decode_tsvdelta(data):
+    out = []
+    prev = []
+    lines = bytes(data).split(b"\n")
+    for n in range(len(lines)):
+        fields = lines[n].split(b"\t")
+        for i in range(len(fields)):
+            field = fields[i]
+            if field == _SAME:
+                fields[i] = prev[i]
+            elif field[0:1] == _ESCAPE:
+                fields[i] = field[1:]
+        out.append(b"\t".join(fields))
+        prev = fields
+    return b"\n".join(out)
+
+class _ZlibEncoder(object):
+    """ deflate through CPython's zlib """
+
+    def __init__(self, out):
+        import zlib
+        self.out = out
+        self.c = zlib.compressobj(9, zlib.DEFLATED, DEFLATE_WBITS)
+
+    def write(self, data):
+        self.out.write(self.c.compress(bytes(data)))
+
+    def finish(self):
+        self.out.write(self.c.flush())
+
+class _DeflateIOEncoder(object):
+    """ deflate through MicroPython's deflate module """
+
+    def __init__(self, out):
+        import deflate
+        self.d = deflate.DeflateIO(out, deflate.ZLIB, DEFLATE_WBITS)
+
+    def write(self, data):
+        self.d.write(data)
+
+    def finish(self):
+        self.d.close()
+
+_deflate_encoder = None
+
+def _find_deflate_encoder():
+    global _deflate_encoder
+    if _deflate_encoder is None:
+        _deflate_encoder = False
+        for cls in (_DeflateIOEncoder, _ZlibEncoder):
+            try:
+                # Firmware may have the module without compression
+                enc = cls(io.BytesIO())
+                enc.write(b"x")
+                enc.finish()
+                _deflate_encoder = cls
+                break
+            except (ImportError, OSError, AttributeError, ValueError):
+                pass
+    return _deflate_encoder
+
+def can_encode(encoding):
+    if encoding == TSVDELTA:
+        return True
+    if encoding == DEFLATE:
+        return bool(_find_deflate_encoder())
+    return False
+
+def pick(offered, supported=ENCODINGS):
+    """ The first of the offered encodings that is supported, or None """
+    for encoding in offered:
+        if encoding in supported:
+            return encoding
+    return None
+
+def encoder(encoding, out):
+    """ An encoder writing to out, with write(data) and finish() """
+    if encoding == TSVDELTA:
+        return TsvDeltaEncoder(out)
+    if encoding == DEFLATE and can_encode(DEFLATE):
+        return _deflate_encoder(out)
+    raise ValueError("Cannot encode %s" % encoding)
+
+def encode(encoding, data):
+    out = io.BytesIO()
+    enc = encoder(encoding, out)
+    enc.write(data)
+    enc.finish()
+    return out.getvalue()
+
+def decode(encoding, data):
+    if encoding == TSVDELTA:
+        return decode_tsvdelta(data)
+    if encoding == DEFLATE:
+        try:
+            import zlib
+            return zlib.decompress(bytes(data))
+        except ImportError:
+            pass
+        try:
+            import deflate
+            return deflate.DeflateIO(io.BytesIO(data), deflate.ZLIB).read()
+        except ImportError:
+            import uzlib
+            return uzlib.decompress(data)
+    raise ValueError("Unknown encoding %s" % encoding)
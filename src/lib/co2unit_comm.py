@@ -1,18 +1,14 @@
 import logging
 import machine
-import network
 import os
 import pycom
 import time
-import uio
-import urequests
 
 import co2unit_errors
 import co2unit_id
 import configutil
 import fileutil
 import pycom_util
-import seqfile
 import timeutil
 
 _logger = logging.getLogger("co2unit_comm")
@@ -31,10 +27,19 @@ COMM_CONF_DEFAULTS = {
         "ntp_host": None,   # None will defer to library default (pool.ntp.org)
         "ntp_max_drift_secs": 4,
         "send_chunk_size": 4*1024,
+        "send_batch_size": 32*1024,     # Bytes per PUT, streamed in chunks
+        "send_encoded_batch_size": 8*1024,  # Bytes of file per encoded PUT, encoded in RAM
+        "recv_chunk_size": 4*1024,      # Download buffer, written to SD as it fills
+        # Offered to the server for pushes, in order of preference (see co2unit_codec)
+        "send_encodings": ["deflate", "tsvdelta"],
         "total_connect_secs_max": 60*5,
         "connect_backoff_max": 7,
         }
 
+# Pushes in an agreed encoding: only the readings TSV files
+ENCODED_DIR = "data/readings"
+ENCODED_SUFFIX = ".tsv"
+
 STATE_DIR = "var"
 COMM_STATE_PATH = STATE_DIR + "/ou-comm-state.json"
 COMM_STATE_DEFAULTS = {
@@ -43,14 +48,17 @@ COMM_STATE_DEFAULTS = {
         "signal_quality": None,
         }
 
-def read_comm_config(hw):
+def read_comm_config(hw, ctx=None):
     """
     Read comm config
 
-    SD card should be mounted and the current directory
+    SD card should be mounted and the current directory.
+    ctx, if given, caches the config files for the wake. Not the comm state,
+    which changes.
     """
-    ou_id = configutil.read_config_json(co2unit_id.OU_ID_PATH, co2unit_id.OU_ID_DEFAULTS)
-    cc = configutil.read_config_json(COMM_CONF_PATH, COMM_CONF_DEFAULTS)
+    read_config = ctx.read_config if ctx else configutil.read_config_json
+    ou_id = read_config(co2unit_id.OU_ID_PATH, co2unit_id.OU_ID_DEFAULTS)
+    cc = read_config(COMM_CONF_PATH, COMM_CONF_DEFAULTS)
     cs = configutil.read_config_json(COMM_STATE_PATH, COMM_STATE_DEFAULTS)
 
     if not cc.sync_dest:
@@ -80,24 +88,34 @@ tschrono = machine.Timer.Chrono()
 tschrono.start()
 
 class TimedStep(object):
-    def __init__(self, desc="", suppress_exception=False):
+    """ Logs the start, end and time of a step
+
+    desc is formatted with args only if the step is logged, so steps in loops
+    cost little with INFO off.
+    """
+
+    def __init__(self, desc="", *args, suppress_exception=False):
         self.desc = desc
+        self.args = args
         self.suppress_exception = suppress_exception
 
+    def __str__(self):
+        return self.desc % self.args if self.args else self.desc
+
     def __enter__(self):
         wdt.feed()
         tschrono.reset()
-        _logger.info("%s ...", self.desc)
+        _logger.info("%s ...", self)
 
     def __exit__(self, exc_type, exc_value, traceback):
         elapsed = tschrono.read_ms()
         wdt.feed()
         if exc_type:
-            _logger.warning("%s failed (%d ms). %s: %s", self.desc, elapsed, exc_type.__name__, exc_value)
+            _logger.warning("%s failed (%d ms). %s: %s", self, elapsed, exc_type.__name__, exc_value)
             if self.suppress_exception:
                 return True
         else:
-            _logger.info("%s OK (%d ms)", self.desc, elapsed)
+            _logger.info("%s OK (%d ms)", self, elapsed)
 
 def lte_connect(hw):
     total_chrono.start()
@@ -106,6 +124,7 @@ def lte_connect(hw):
     signal_quality = None
 
     with TimedStep("LTE init"):
+        import network
         pycom.nvs_set("lte_on", True)
         lte = network.LTE()
 
@@ -136,6 +155,11 @@ def lte_connect(hw):
     return lte, signal_quality
 
 def lte_deinit(lte):
+    import urequests
+    # Pooled keep-alive connections die with the network
+    urequests.close_pool()
+    urequests.clear_dns_cache()
+
     if not lte: return
 
     try:
@@ -152,14 +176,25 @@ def lte_deinit(lte):
             lte.deinit()
             pycom.nvs_set("lte_on", False)
 
-def request(method, host, path, data=None, json=None, headers={}, accept_statuses=[200]):
+def request(method, host, path, data=None, json=None, headers={}, accept_statuses=[200], stream=False):
+    """ Sends a request and checks the status
+
+    With stream=True, an accepted response is returned with its body unread,
+    for the caller to read with resp.readinto() or resp.save_to().
+    """
+    import urequests
     url = host + path
     desc = " ".join([method,url])
-    if data:
+    if "Content-Length" in headers:
+        desc += " ({} bytes payload, streamed)".format(headers["Content-Length"])
+    elif data:
         desc += " ({} bytes payload)".format(len(data))
     with TimedStep(desc):
-        resp = urequests.request(method, url, data, json, headers)
+        resp = urequests.request(method, url, data, json, headers, keep_alive=True)
         wdt.feed()
+        if stream and resp.status_code in accept_statuses:
+            _logger.info("%s %s (streaming)", desc, resp.status_code)
+            return resp
         resp.content
         wdt.feed()
         if resp.status_code not in accept_statuses:
@@ -177,8 +212,28 @@ def send_alive_ping(sync_dest, ou_id, cc, cs):
     except:
         pass
 
+    offered = upload_encodings(cc)
+    if offered:
+        path += "&encodings=" + ",".join(offered)
+
     return request("POST", sync_dest, path)
 
+def upload_encodings(cc):
+    """ The encodings of send_encodings that this firmware can produce """
+    import co2unit_codec
+    return [e for e in cc.send_encodings if co2unit_codec.can_encode(e)]
+
+def agreed_encoding(resp, offered):
+    """ The encoding that the server picked in its answer to the alive ping
+
+    None if it picked none, as servers that do not know about encodings do.
+    """
+    try:
+        encoding = resp.json().get("encoding")
+    except Exception:
+        return None
+    return encoding if encoding in offered else None
+
 class PushSequentialState(object):
     def __init__(self, dirname, fname=None, progress=None, totalsize=None):
         self.fname = fname
@@ -186,9 +241,20 @@ class PushSequentialState(object):
         self.totalsize = totalsize
 
         self.dirname = dirname
+        self.path = None
         # Make sure directory exists before trying to read it
         fileutil.mkdirs(dirname, wdt=wdt)
-        self.dirlist = os.listdir(dirname)
+        # Sizes from the listing, where the filesystem gives them (FAT does),
+        # save a stat per file
+        self.sizes = {}
+        if hasattr(os, "ilistdir"):
+            self.dirlist = []
+            for e in os.ilistdir(dirname):
+                self.dirlist.append(e[0])
+                if len(e) > 3:
+                    self.sizes[e[0]] = e[3]
+        else:
+            self.dirlist = os.listdir(dirname)
         self.dirlist.sort()
         if not self.dirlist:
             _logger.info("%s: dir is empty. Nothing to push", dirname)
@@ -203,7 +269,9 @@ class PushSequentialState(object):
         return str(self.to_list())
 
     def fpath(self):
-        return "/".join([self.dirname, self.fname])
+        if self.path is None:
+            self.path = "/".join([self.dirname, self.fname])
+        return self.path
 
     def update_by_fname(self, fname, progress=None):
         if not fname:
@@ -223,7 +291,11 @@ class PushSequentialState(object):
             if fname != self.fname:
                 self.fname = fname
                 self.progress = 0
-            self.totalsize = os.stat(self.fpath())[6]
+            self.path = None
+            if fname in self.sizes:
+                self.totalsize = self.sizes[fname]
+            else:
+                self.totalsize = os.stat(self.fpath())[6]
 
     def update_to_next_file(self):
         self.update_by_dirindex(self.dirindex + 1)
@@ -239,7 +311,80 @@ class PushSequentialState(object):
         return self.dirindex == len(self.dirlist)
 
 
-def push_sequential(sync_dest, ou_id, cc, dirname, ss):
+def _encode_batch(reader, nbytes, encoding):
+    """ Encodes the next nbytes from the reader, for the body of one push """
+    import co2unit_codec
+    import uio
+    out = uio.BytesIO()
+    enc = co2unit_codec.encoder(encoding, out)
+    for chunk in reader.chunks(nbytes, wdt):
+        enc.write(chunk)
+    enc.finish()
+    return out.getvalue()
+
+def _push_file(sync_dest, ou_id, cc, pushstate, reader, encoding=None):
+    """ Pushes the current file of pushstate through a fileutil.SequentialReader
+
+    Each request sends up to send_batch_size bytes. If that is more than one
+    chunk, the body is streamed from the file, one chunk at a time. The file
+    stays open in the reader between requests.
+
+    With an encoding agreed with the server, each batch is encoded into one
+    body instead, held in RAM, so batches are at most send_encoded_batch_size.
+    Only TSV files are encoded. The offsets stay those of the file.
+
+    Returns False if we ran out of time.
+    """
+    fname = pushstate.fname
+    fpath = pushstate.fpath()
+    chunk_size = len(reader.buf)
+    if not fname.endswith(ENCODED_SUFFIX):
+        encoding = None
+    batch_size = cc.send_encoded_batch_size if encoding else cc.send_batch_size
+    while pushstate.fname == fname and not pushstate.file_complete():
+
+        if total_time_up(cc): return False
+
+        remaining = pushstate.totalsize - pushstate.progress
+        batch = min(max(batch_size, chunk_size), remaining)
+        reader.open(fpath, pushstate.progress)
+
+        path = "/ou/{id}/push-sequential/{fpath}?offset={progress}".format(\
+                id=ou_id.hw_id, fpath=fpath, progress=pushstate.progress)
+
+        if encoding:
+            path += "&encoding=" + encoding
+            with TimedStep("Encoding data %s", pushstate):
+                senddata = _encode_batch(reader, batch, encoding)
+            _logger.info("%s: %d bytes encoded to %d", fpath, batch, len(senddata))
+            resp = request("PUT", sync_dest, path, data=senddata, accept_statuses=[200,416])
+        elif batch <= chunk_size:
+            with TimedStep("Reading data %s", pushstate):
+                senddata = reader.read(batch)
+                batch = len(senddata)
+
+            if _logger.isEnabledFor(logging.DEBUG):
+                _logger.debug("%s read %d bytes: '%s' ...", fpath, batch, bytes(senddata[:40]))
+
+            resp = request("PUT", sync_dest, path, data=senddata, accept_statuses=[200,416])
+        else:
+            senddata = reader.chunks(batch, wdt)
+            headers = {"Content-Length": str(batch)}
+            resp = request("PUT", sync_dest, path, data=senddata, headers=headers, accept_statuses=[200,416])
+
+        if resp.status_code == 200:
+            pushstate.add_progress(batch)
+
+        parsed = resp.json()
+        if "ack_file" in parsed:
+            fname_ack, progress, totalize = parsed["ack_file"]
+            if fname_ack != pushstate.fname or progress != pushstate.progress:
+                _logger.info("New progress in server response: %s, %d", fname_ack, progress)
+                pushstate.update_by_fname(fname_ack, progress)
+
+    return True
+
+def push_sequential(sync_dest, ou_id, cc, dirname, ss, encoding=None):
 
     with TimedStep("Determine current sync state"):
         key = "ack_file"
@@ -249,40 +394,17 @@ def push_sequential(sync_dest, ou_id, cc, dirname, ss):
             pushstate = PushSequentialState(dirname)
 
     try:
-        buf = bytearray(cc.send_chunk_size)
-        mv = memoryview(buf)
-
-        while not pushstate.dir_complete():
-            while not pushstate.file_complete():
+        with fileutil.SequentialReader(bytearray(cc.send_chunk_size)) as reader:
+            while not pushstate.dir_complete():
+                fname = pushstate.fname
 
-                if total_time_up(cc): return
+                if not pushstate.file_complete():
+                    if not _push_file(sync_dest, ou_id, cc, pushstate, reader, encoding):
+                        return
 
-                with TimedStep("Reading data %s" % pushstate):
-                    with open(pushstate.fpath(), "rb") as f:
-                        f.seek(pushstate.progress)
-                        readbytes = f.readinto(buf)
-                    senddata = mv[:readbytes]
-                    _logger.debug("%s read %d bytes", pushstate.fpath(), readbytes)
-
-                if _logger.level <= logging.DEBUG:
-                    s = uio.BytesIO(mv)#[:40])
-                    _logger.debug("Read data: '%s' ...", s.getvalue())
-
-                path = "/ou/{id}/push-sequential/{fpath}?offset={progress}".format(\
-                        id=ou_id.hw_id, fpath=pushstate.fpath(), progress=pushstate.progress)
-                resp = request("PUT", sync_dest, path, data=senddata, accept_statuses=[200,416])
-
-                if resp.status_code == 200:
-                    pushstate.add_progress(readbytes)
-
-                parsed = resp.json()
-                if "ack_file" in parsed:
-                    fname, progress, totalize = parsed["ack_file"]
-                    if fname != pushstate.fname or progress != pushstate.progress:
-                        _logger.info("New progress in server response: %s, %d", fname, progress)
-                        pushstate.update_by_fname(fname, progress)
-
-            pushstate.update_to_next_file()
+                # Server may have moved us to another file
+                if pushstate.fname == fname:
+                    pushstate.update_to_next_file()
 
         _logger.info("%s: all synced", dirname)
     finally:
@@ -299,7 +421,78 @@ def fetch_dir_list(sync_dest, ou_id, cc, dpath, recursive=False):
     else:
         return None
 
+PART_SUFFIX = ".part"
+
+def download_file(sync_dest, path, dest_path, buf, expect=None):
+    """ Streams a remote file to dest_path, one buffer at a time
+
+    The file is written to dest_path + PART_SUFFIX first, and renamed when
+    complete. If an earlier attempt left a partial file, only the rest is
+    requested with a Range header. A server that ignores Range sends the whole
+    file, which then overwrites the partial file.
+
+    If expect is given as (size, sha256), the file is checked before the
+    rename, and a file that does not match is deleted.
+    """
+    part_path = dest_path + PART_SUFFIX
+    offset = fileutil.file_size(part_path) if fileutil.isfile(part_path) else 0
+
+    headers = {}
+    if offset:
+        headers["Range"] = "bytes={}-".format(offset)
+    resp = request("GET", sync_dest, path, headers=headers, accept_statuses=[200,206,416], stream=True)
+
+    if resp.status_code == 416:
+        # Partial file is as long as the remote file or longer. Start over.
+        resp.content
+        if not offset:
+            raise Exception("{} {}".format(path, resp.status_code))
+        _logger.warning("%s: range from %d not satisfiable, downloading again", path, offset)
+        os.remove(part_path)
+        return download_file(sync_dest, path, dest_path, buf, expect)
+
+    if resp.status_code == 206:
+        if resp.range_start != offset:
+            resp.close()
+            raise Exception("{}: asked for range from {}, got {}".format(path, offset, resp.range_start))
+        mode = "ab"
+    else:
+        offset = 0
+        mode = "wb"
+
+    with TimedStep("Download {} from {}".format(dest_path, offset)):
+        with open(part_path, mode) as f:
+            nbytes = resp.save_to(f, buf, wdt.feed)
+        _logger.info("%s: got %d bytes", dest_path, nbytes)
+    if expect and not fileutil.file_matches(part_path, expect[0], expect[1], wdt=wdt):
+        os.remove(part_path)
+        raise Exception("{}: does not match manifest {}".format(path, expect))
+    os.rename(part_path, dest_path)
+    wdt.feed()
+
+def fetch_manifest(sync_dest, ou_id, rpath, tmp_dir):
+    """ Fetches the manifest of an update into tmp_dir, if it has one
+
+    Returns the files listed, or None if the update has no manifest.
+    """
+    import co2unit_update
+    co2unit_update.wdt = wdt
+    path = "/ou/{id}/{rpath}/{mname}".format(\
+            id=ou_id.hw_id, rpath=rpath, mname=co2unit_update.MANIFEST_NAME)
+    resp = request("GET", sync_dest, path, accept_statuses=[200,404])
+    if resp.status_code != 200:
+        _logger.info("%s has no manifest", rpath)
+        return None
+    files = co2unit_update.parse_manifest(resp.text)
+    fileutil.mkdirs(tmp_dir, wdt=wdt)
+    with open(tmp_dir + "/" + co2unit_update.MANIFEST_NAME, "wb") as f:
+        f.write(resp.content)
+    return files
+
 def pull_last_dir(sync_dest, ou_id, cc, dpath, ss):
+    import co2unit_update
+    import seqfile
+
     # Find most recent update
     _logger.info("Fetching available directories in %s ...", dpath)
     dirlist = fetch_dir_list(sync_dest, ou_id, cc, dpath)
@@ -320,26 +513,26 @@ def pull_last_dir(sync_dest, ou_id, cc, dpath, ss):
         _logger.info("Already have %s, skipping", rpath)
         return False
 
-    _logger.info("Getting list of files in %s ...", rpath)
     tmp_dir = "tmp/" + rpath
-    fetch_paths = fetch_dir_list(sync_dest, ou_id, cc, rpath, recursive=True)
+    files = fetch_manifest(sync_dest, ou_id, rpath, tmp_dir)
+    if files is None:
+        _logger.info("Getting list of files in %s ...", rpath)
+        fetch_paths = fetch_dir_list(sync_dest, ou_id, cc, rpath, recursive=True)
+    else:
+        with TimedStep("Comparing %d files in manifest to installed files" % len(files)):
+            fetch_paths = co2unit_update.files_to_fetch(files)
 
     # Fetch each file
-    _logger.info("Fetching files to %s", tmp_dir)
+    _logger.info("Fetching %d files to %s", len(fetch_paths), tmp_dir)
+    buf = bytearray(cc.recv_chunk_size)
     for fpath in fetch_paths:
         tmp_path = "/".join([tmp_dir,fpath])
         if fileutil.isfile(tmp_path): continue
 
         path = "/ou/{id}/{rpath}/{fpath}".format(id=ou_id.hw_id, rpath=rpath, fpath=fpath)
         wdt.feed()
-        resp = request("GET", sync_dest, path)
         fileutil.mkdirs(fileutil.dirname(tmp_path), wdt=wdt)
-        content = resp.content
-        wdt.feed()
-        with open(tmp_path, "w") as f:
-            # TODO: make sure to write all
-            f.write(content)
-            wdt.feed()
+        download_file(sync_dest, path, tmp_path, buf, expect=files[fpath] if files else None)
 
     # When finished, move whole directory in place
     _logger.info("Moving %s into place", rpath)
@@ -352,7 +545,11 @@ def pull_last_dir(sync_dest, ou_id, cc, dpath, ss):
 def transmit_data(sync_dest, ou_id, cc, cs):
 
     with TimedStep("Send alive ping"):
-        send_alive_ping(sync_dest, ou_id, cc, cs)
+        resp = send_alive_ping(sync_dest, ou_id, cc, cs)
+
+    encoding = agreed_encoding(resp, upload_encodings(cc))
+    if encoding:
+        _logger.info("Server takes pushes in %s encoding", encoding)
 
     got_updates = False
 
@@ -362,7 +559,7 @@ def transmit_data(sync_dest, ou_id, cc, cs):
         ss = cs.sync_states[dirname]
 
         if dirtype == "push_sequential":
-            push_sequential(sync_dest, ou_id, cc, dirname, ss)
+            push_sequential(sync_dest, ou_id, cc, dirname, ss, encoding if dirname == ENCODED_DIR else None)
         elif dirtype == "pull_last_dir":
             updated = pull_last_dir(sync_dest, ou_id, cc, dirname, ss)
             got_updates = got_updates or updated
@@ -374,22 +571,25 @@ def transmit_data(sync_dest, ou_id, cc, cs):
 
     return got_updates
 
-def comm_sequence(hw):
+def comm_sequence(hw, ctx=None):
     """ Transmits data
 
-    - SD card must be mounted before calling
+    - ctx shares the RTC sync, SD card and configs of the wake with other
+      tasks (see co2unit_main2.WakeContext)
     """
     _logger.info("Starting communication sequence...")
 
-    hw.sync_to_most_reliable_rtc(reset_ok=True)
-    hw.mount_sd_card()
+    if ctx:
+        ctx.prepare_sd(hw)
+    else:
+        hw.sync_to_most_reliable_rtc(reset_ok=True)
+        hw.mount_sd_card()
+        os.chdir(hw.SDCARD_MOUNT_POINT)
 
     lte = None
     got_updates = False
 
-    os.chdir(hw.SDCARD_MOUNT_POINT)
-
-    ou_id, cc, cs = read_comm_config(hw)
+    ou_id, cc, cs = read_comm_config(hw, ctx)
 
     try:
         # Check connect backoff state and skip this round if need be
@@ -419,6 +619,9 @@ def comm_sequence(hw):
                 cs.connect_backoff = [1, backoff]
                 raise
 
+        # Write out what is recorded so far, to go with this upload
+        logging.flush()
+
         for sync_dest in cc.sync_dest:
             try:
                 with TimedStep("Transmit data to {}".format(sync_dest)):
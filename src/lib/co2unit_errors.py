@@ -4,46 +4,156 @@ import time
 
 import fileutil
 
-_logger = logging.getLogger("errors")
+_logger = logging.getLogger("co2unit_errors")
 #_logger.setLevel(logging.DEBUG)
 
-def _record(hw, level, msg, exc=None):
-    _logger.debug("Attempting to write error in log on SD card...")
+# The records themselves, which also go to the ring (see ErrorRing)
+_records = logging.getLogger("errors")
 
-    if not hw.power_peripherals():
-        hw.power_peripherals(True)
-        _logger.info("Giving hardware a moment after power on")
-        time.sleep_ms(100)
+ERRORS_INDEX_PATH = "var/errors-append-index.json"
+ERRORS_MATCH = ("errors-", ".txt")
 
-    hw.sync_to_most_reliable_rtc(reset_ok=True)
-    hw.mount_sd_card()
+# RAM kept for records between flushes. When full, the oldest are dropped.
+RING_BYTES = const(4 * 1024)
 
-    errors_dir = hw.SDCARD_MOUNT_POINT + "/errors"
-    errors_match = ("errors-", ".txt")
+RECORD_START = "----- "
 
-    target = fileutil.prep_append_file(dir=errors_dir, match=errors_match)
+LEVEL_STRS = {
+        logging.INFO: "INFO",
+        logging.WARNING: "WARN",
+        logging.ERROR: "ERROR",
+        logging.CRITICAL: "CRIT",
+        }
 
-    tt = time.gmtime()
-    try:
-        import timeutil
-        tt = timeutil.format_time(tt)
-    except:
-        pass
+class ErrorRing(logging.Handler):
+    """ Keeps records in a preallocated ring buffer until flushed to errors/
+
+    Recording costs no I/O. flush() powers the peripherals, syncs the RTC and
+    mounts the SD card if need be, and appends all pending records to the
+    current errors file at once: one mount and one open per wake instead of
+    one per record. hw is the Co2UnitHw to flush with, from the last record.
+
+    Records can come before the RTC is synced, so a record gets the ticks at
+    emit and a placeholder of the same width as the time. flush() overwrites
+    the placeholders with times from the synced RTC (see stamp).
+    """
+
+    def __init__(self, size=RING_BYTES, level=logging.INFO):
+        self.buf = bytearray(size)
+        self.mv = memoryview(self.buf)
+        self.level = level
+        # Bytes recorded and flushed, ever; the ring holds the tail of end
+        self.end = 0
+        self.flushed = 0
+        self.hw = None
+        # (position, ticks) of the placeholders not yet stamped
+        self.stamps = []
 
-    fmt_msg = "----- {} {:5} {}\n".format(tt, level, msg)
-    _logger.info(fmt_msg)
+    def write(self, data):
+        size = len(self.buf)
+        if len(data) > size:
+            self.end += len(data) - size
+            data = data[-size:]
+        pos = self.end % size
+        first = min(len(data), size - pos)
+        self.mv[pos:pos+first] = data[:first]
+        if first < len(data):
+            self.mv[0:len(data)-first] = data[first:]
+        self.end += len(data)
 
-    with open(target, "at") as f:
-        f.write(fmt_msg)
+    def emit(self, level, name, msg, exc=None):
+        ticks = time.ticks_ms()
+        self.stamps = [st for st in self.stamps if st[0] >= self.end - len(self.buf)]
+        self.stamps.append((self.end + len(RECORD_START), ticks))
+        level_str = "EXC" if exc else LEVEL_STRS.get(level, "LVL%d" % level)
+        # Padded to the width of timeutil.format_time's output
+        unsynced = "T{:+d}ms".format(ticks)
+        self.write("{}{:19} {:5} {}\n".format(RECORD_START, unsynced, level_str, msg).encode())
         if exc:
-            sys.print_exception(exc, f)
-    _logger.info("Recorded error successfully to %s", target)
+            import uio
+            s = uio.StringIO()
+            sys.print_exception(exc, s)
+            self.write(s.getvalue().encode())
+
+    def stamp(self, now_secs, now_ticks):
+        """ Overwrites the pending placeholders with times, given a synced now """
+        import timeutil
+        size = len(self.buf)
+        for pos, ticks in self.stamps:
+            if pos < self.end - size or pos < self.flushed:
+                continue
+            secs = now_secs - time.ticks_diff(now_ticks, ticks) // 1000
+            tt = timeutil.format_time(time.gmtime(secs)).encode()
+            for i in range(len(tt)):
+                self.buf[(pos + i) % size] = tt[i]
+        self.stamps = []
+
+    def pending(self):
+        """ Number of bytes not yet flushed that are still in the ring """
+        return min(self.end - self.flushed, len(self.buf))
+
+    def dropped(self):
+        """ Number of bytes not yet flushed that the ring overwrote """
+        return max(0, self.end - self.flushed - len(self.buf))
+
+    def drain(self, f):
+        """ Writes the pending records to f and empties the ring """
+        n = self.pending()
+        dropped = self.dropped()
+        size = len(self.buf)
+        start = (self.end - n) % size
+        if dropped:
+            # Skip the rest of the partly overwritten record
+            skip = 0
+            while skip < n and self.buf[(start + skip) % size] != 0x0a:
+                skip += 1
+            skip = min(skip + 1, n)
+            start = (start + skip) % size
+            n -= skip
+            f.write("----- {} bytes of records dropped\n".format(dropped + skip).encode())
+        first = min(n, size - start)
+        f.write(self.mv[start:start+first])
+        if first < n:
+            f.write(self.mv[0:n-first])
+        self.flushed = self.end
+
+    def flush(self):
+        hw = self.hw
+        if not self.pending() or not hw:
+            return
+        _logger.debug("Attempting to write records to log on SD card...")
+        try:
+            if not hw.power_peripherals():
+                hw.power_peripherals(True)
+                _logger.info("Giving hardware a moment after power on")
+                time.sleep_ms(100)
+
+            hw.sync_to_most_reliable_rtc(reset_ok=True)
+            self.stamp(time.time(), time.ticks_ms())
+            hw.mount_sd_card()
+
+            errors_dir = hw.SDCARD_MOUNT_POINT + "/errors"
+            index_path = hw.SDCARD_MOUNT_POINT + "/" + ERRORS_INDEX_PATH
+            target = fileutil.prep_append_file(dir=errors_dir, match=ERRORS_MATCH, index_path=index_path)
+
+            n = self.pending()
+            with open(target, "ab") as f:
+                self.drain(f)
+            _logger.info("Flushed %d bytes of records to %s", n, target)
+        except Exception as e:
+            _logger.exc(e, "Could not flush records to SD card")
+
+ring = ErrorRing()
+_records.addHandler(ring)
 
 def record_error(hw, exc, msg):
-    _record(hw, "EXC", msg, exc)
+    ring.hw = hw
+    _records.exc(exc, msg)
 
 def warning(hw, msg):
-    _record(hw, "WARN", msg)
+    ring.hw = hw
+    _records.warning(msg)
 
 def info(hw, msg):
-    _record(hw, "INFO", msg)
+    ring.hw = hw
+    _records.info(msg)
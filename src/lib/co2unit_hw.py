@@ -23,10 +23,14 @@ def pinset_on_boot(pinset):
 class Co2UnitHw(object):
     SDCARD_MOUNT_POINT = "/sd"
 
+    # 512-byte blocks of the SD card cached in RAM (see blockcache)
+    SD_CACHE_SLOTS = 8
+
     def __init__(self):
         self._power_peripherals = None
         self._mosfet_pin = None
         self._sdcard = None
+        self._sd_cache = None
         self._ertc = None
         self._flash_pin = None
         self._co2 = None
@@ -96,6 +100,24 @@ class Co2UnitHw(object):
                     raise
         return self._sdcard
 
+    @property
+    def sd_cache(self):
+        """ The SD card behind a write-back block cache, which is what is mounted
+
+        The cache holds writes across file closes, so the FAT blocks each task
+        rewrites go to the card once per wake. It is flushed at unmount
+        (prepare_for_shutdown), before the last-resort deep sleep and after
+        a task fails. A reset at any other time loses what it holds.
+        """
+        if not self._sd_cache:
+            import blockcache
+            self._sd_cache = blockcache.BlockCache(self.sdcard, self.SD_CACHE_SLOTS)
+        return self._sd_cache
+
+    def flush_sd_cache(self):
+        if self._sd_cache:
+            self._sd_cache.flush()
+
     @property
     def ertc(self):
         if not self._ertc:
@@ -200,7 +222,7 @@ class Co2UnitHw(object):
     def mount_sd_card(self):
         if not self.sd_mounted:
             _logger.info("Mounting SD card")
-            os.mount(self.sdcard, self.SDCARD_MOUNT_POINT)
+            os.mount(self.sd_cache, self.SDCARD_MOUNT_POINT)
         else:
             _logger.debug("SD card already mounted")
         self.sd_mounted = True
@@ -225,6 +247,7 @@ class Co2UnitHw(object):
         if self.sd_mounted:
             _logger.info("Unmounting SD card")
             try:
+                self.flush_sd_cache()
                 os.umount(self.SDCARD_MOUNT_POINT)
             except:
                 _logger.exception("Could not unmount SD card")
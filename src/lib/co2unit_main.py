@@ -92,6 +92,7 @@ def crash_recovery_sequence(hw):
     try:
         import co2unit_errors
         co2unit_errors.warning(hw, "Had to run recovery procedure. Watchdog reset?")
+        logging.flush()
     except Exception as e:
         _logger.exc(e, "Could not log warning")
 
@@ -65,51 +65,83 @@ class MainWrapper(object):
 
         if exc_val:
             _logger.exc(exc_val, "Uncaught exception at MainWrapper top level")
+        # Records still in RAM are lost in deep sleep
+        logging.flush()
+
+        if hw:
+            try:
+                hw.flush_sd_cache()
+            except Exception as e:
+                _logger.exc(e, "Could not flush SD cache")
 
         _logger.warning("MainWrapper last resort. Don't know what else to do. Going to sleep for a while (%d ms).", LAST_RESORT_DEEPSLEEP_MS)
         machine.deepsleep(LAST_RESORT_DEEPSLEEP_MS)
         return False
 
 class NvsTaskLog(object):
+    """ Log of the last task events (START, OK, FAIL), kept in NVS
+
+    The log is a ring buffer of LOG_LEN slots, one NVS key per slot. Each
+    slot holds a packed event and its sequence number, and an event goes in
+    slot seq % LOG_LEN. So recording an event is a single nvs_set: either the
+    next slot, or the newest slot again with its repetition count bumped.
+    The newest slot is the one whose successor does not continue its
+    sequence. The slots are read from NVS once and then kept in RAM.
+
+    Older code kept the log as a plain list in the same keys, rewriting all
+    of them on every event. The first load converts that layout
+    (see _upgrade) and marks the new one in FORMAT_KEY.
+    """
 
     TASK_NONE = -1
     TASK_UNKNOWN = -2
 
     STAT_STRS = [None, "START","OK","FAIL"]
     KEY_PREFIX = "task_log_"
+    FORMAT_KEY = "task_log_fmt"
+    FORMAT_RING = 2
     LOG_LEN = 16
 
     NULL_EVENT = (None, None, 0)
 
     def __init__(self):
         self.registry = []
+        # Packed slots, loaded from NVS on first use
+        self._slots = None
+        self._newest = None
 
     def register(self, task):
         self.registry.append(task)
 
-    def _pack_event(self, task, status, repetitions):
+    def _task_id(self, task):
         if task == None:
-            taskid = self.TASK_NONE
+            return self.TASK_NONE
         elif task in self.registry:
             taskid = self.registry.index(task)
-        else:
-            taskid = self.TASK_UNKNOWN
+            if taskid < 128:
+                return taskid
+        return self.TASK_UNKNOWN
 
+    def _pack_event(self, task, status, repetitions, seq=0):
+        taskid = self._task_id(task)
         status = self.STAT_STRS.index(status)
 
         if repetitions > 255:
             repetitions = 255
 
-        b = ustruct.pack("hBB", taskid, status, repetitions)
+        b = ustruct.pack("bBBB", taskid, status, repetitions, seq & 0xff)
         i = ustruct.unpack("I", b)[0]
         return i
 
+    def _unpack_slot(self, packed):
+        """ Returns taskid, status index, repetitions, seq """
+        return ustruct.unpack("bBBB", ustruct.pack("I", packed))
+
     def _unpack_event(self, packed):
         if packed == None:
             return self.NULL_EVENT
 
-        b = ustruct.pack("I", packed)
-        taskid, status, repetitions = ustruct.unpack("hBB", b)
+        taskid, status, repetitions, _ = self._unpack_slot(packed)
 
         if taskid == self.TASK_NONE:
             task = None
@@ -126,38 +158,84 @@ class NvsTaskLog(object):
     def _key_str(self, i):
         return "{}{:03d}".format(self.KEY_PREFIX, i)
 
-    def _persist_run_log(self, log):
-        for i, event in enumerate(log):
-            key = self._key_str(i)
-            packed = self._pack_event(*event)
-            pycom.nvs_set(key, packed)
+    def _find_newest(self):
+        slots = self._slots
+        for i in range(0, self.LOG_LEN):
+            if slots[i] == None:
+                continue
+            after = slots[(i+1) % self.LOG_LEN]
+            seq = self._unpack_slot(slots[i])[3]
+            if after == None or self._unpack_slot(after)[3] != (seq+1) & 0xff:
+                return i
+        return None
+
+    def _upgrade(self):
+        """ Converts the old layout: a list of ("hBB" packed) events, oldest first """
+        old = []
+        for i in range(0, self.LOG_LEN):
+            packed = nvs_get_default(self._key_str(i), default=None)
+            if packed != None:
+                old.append(ustruct.unpack("hBB", ustruct.pack("I", packed)))
+        for seq, (taskid, status, repetitions) in enumerate(old):
+            if not -128 <= taskid < 128:
+                taskid = self.TASK_UNKNOWN
+            packed = ustruct.unpack("I", ustruct.pack("bBBB", taskid, status, repetitions, seq))[0]
+            self._slots[seq] = packed
+            pycom.nvs_set(self._key_str(seq), packed)
+        pycom.nvs_set(self.FORMAT_KEY, self.FORMAT_RING)
+        if old:
+            _logger.info("Converted task log of %d events to ring buffer", len(old))
+
+    def _load(self):
+        if self._slots != None:
+            return
+        self._slots = [None] * self.LOG_LEN
+        if nvs_get_default(self.FORMAT_KEY) != self.FORMAT_RING:
+            self._upgrade()
+        else:
+            for i in range(0, self.LOG_LEN):
+                self._slots[i] = nvs_get_default(self._key_str(i), default=None)
+        self._newest = self._find_newest()
 
     def read_run_log(self):
+        """ Returns the events, oldest first """
+        self._load()
         log = []
-        for i in range(0, self.LOG_LEN):
-            key = self._key_str(i)
-            packed = nvs_get_default(key, default=None)
-            event = self._unpack_event(packed)
+        if self._newest == None:
+            return log
+        for i in range(1, self.LOG_LEN+1):
+            event = self._unpack_event(self._slots[(self._newest + i) % self.LOG_LEN])
             if event != self.NULL_EVENT:
                 log.append(event)
         return log
 
     def _record_event(self, task, status):
-        log = self.read_run_log()
+        self._load()
+
+        slot = self._newest
+        seq = -1
+        if slot != None:
+            taskid, statid, repetitions, seq = self._unpack_slot(self._slots[slot])
+            if (taskid, statid) == (self._task_id(task), self.STAT_STRS.index(status)):
+                packed = self._pack_event(task, status, repetitions+1, seq)
+            else:
+                slot = None
 
-        if log and log[0][0:2] == (task, status):
-            log[0] = (task, status, log[0][2]+1)
-        else:
-            if len(log) >= self.LOG_LEN:
-                log = log[1:]
-            log.append( (task,status,1) )
+        if slot == None:
+            seq = (seq+1) & 0xff
+            slot = seq % self.LOG_LEN
+            packed = self._pack_event(task, status, 1, seq)
 
-        self._persist_run_log(log)
+        self._slots[slot] = packed
+        self._newest = slot
+        pycom.nvs_set(self._key_str(slot), packed)
 
     def reset_log(self):
         for i in range(0, self.LOG_LEN):
             key = self._key_str(i)
             nvs_erase_idempotent(key)
+        self._slots = [None] * self.LOG_LEN
+        self._newest = None
 
     def record_start(self, task): self._record_event(task, "START")
     def record_ok(self, task): self._record_event(task, "OK")
@@ -165,11 +243,57 @@ class NvsTaskLog(object):
 
 nvs_task_log = NvsTaskLog()
 
+class WakeContext(object):
+    """ Work that the tasks of a wake share, done once for all of them
+
+    - Syncing the RTCs, mounting the SD card and changing to it
+    - Reading and parsing config files from the SD card, kept by path
+    - Compacting the readings, at most once (see CompactReadings)
+
+    The configs go stale when an update patches them (see CheckForUpdates).
+    The schedule is kept apart, with its timeline (see load_schedule).
+    """
+
+    def __init__(self):
+        self.rtc_synced = False
+        self.sd_ready = False
+        self.configs = {}
+        self.schedule = None
+        self.compacted = False
+
+    def prepare_sd(self, hw):
+        if not self.rtc_synced:
+            self.sync_rtc(hw)
+        if not self.sd_ready:
+            import os
+            hw.mount_sd_card()
+            os.chdir(hw.SDCARD_MOUNT_POINT)
+            self.sd_ready = True
+
+    def sync_rtc(self, hw):
+        hw.sync_to_most_reliable_rtc(reset_ok=True)
+        self.rtc_synced = True
+
+    def read_config(self, path, defaults={}):
+        """ Like configutil.read_config_json, but reads each path once """
+        if path not in self.configs:
+            import configutil
+            self.configs[path] = configutil.read_config_json(path, defaults)
+        return self.configs[path]
+
+    def invalidate_configs(self):
+        self.configs = {}
+        self.schedule = None
+
+# The context of the wake, replaced by each TaskRunner
+ctx = WakeContext()
+
 class TaskRunner(object):
 
     def __init__(self):
         self.queue = []
         self.history = []
+        self.ctx = WakeContext()
 
     def run_next_task(self):
         task = self.queue[0]
@@ -195,6 +319,14 @@ class TaskRunner(object):
         except:
             _logger.exception("=== Task %s FAIL ===", instance)
             nvs_task_log.record_fail(task)
+            # Save what was recorded, in case things go worse
+            logging.flush()
+            # Blocks still held in the SD cache are lost on a reset
+            if hw:
+                try:
+                    hw.flush_sd_cache()
+                except Exception as e:
+                    _logger.exc(e, "Could not flush SD cache")
 
         if result:
             result = [result] if not isinstance(result, list) else result
@@ -202,6 +334,8 @@ class TaskRunner(object):
             self.queue = result + self.queue
 
     def run(self, *tasks):
+        global ctx
+        ctx = self.ctx
         self.queue += tasks
         while self.queue:
             wdt.feed()
@@ -294,6 +428,8 @@ class CrashRecovery(object):
             import co2unit_errors
             co2unit_errors.warning(hw, "CRASH RECOVERY. Running recovery procedure (attempt %d). Watchdog reset? LTE was on: %s; LTE turned off: %s" % (entrycount, lte_was_on, lte_turned_off) )
             co2unit_errors.info(hw, "Run log leading up to this... %s" % (nvs_task_log.read_run_log(),) )
+            # Write them now, since the hang may well come back before shutdown
+            logging.flush()
         except Exception as e:
             _logger.exc(e, "Could not log warning")
 
@@ -330,7 +466,7 @@ class TakeMeasurement(object):
 
         import co2unit_measure
         co2unit_measure.wdt = wdt
-        co2unit_measure.measure_sequence(hw, flash_count=flash_count)
+        co2unit_measure.measure_sequence(hw, flash_count=flash_count, ctx=ctx)
 
         _logger.info("Resetting flash count after recording it")
         pycom.nvs_set("co2_flash_count", flash_count)
@@ -341,11 +477,23 @@ class Communicate(object):
     def run(self):
         import co2unit_comm
         co2unit_comm.wdt = wdt
-        lte, got_updates = co2unit_comm.comm_sequence(hw)
-        return [CheckForUpdates]
+        lte, got_updates = co2unit_comm.comm_sequence(hw, ctx=ctx)
+        # With the acks from the server fresh, and the SD card mounted
+        return [CheckForUpdates, CompactReadings]
 
 nvs_task_log.register(Communicate)
 
+class CompactReadings(object):
+    """ Only run after Communicate, with the acks from the server fresh """
+    def run(self):
+        if ctx.compacted:
+            _logger.info("Readings already compacted this wake")
+            return
+        ctx.compacted = True
+        import co2unit_archive
+        co2unit_archive.wdt = wdt
+        co2unit_archive.compact_sequence(hw, ctx=ctx)
+
 # Updates
 # --------------------------------------------------
 
@@ -362,7 +510,9 @@ class CheckForUpdates(object):
         set_persistent_settings()
         import co2unit_update
         co2unit_update.wdt = wdt
-        updated = co2unit_update.update_sequence(hw)
+        updated = co2unit_update.update_sequence(hw, ctx=ctx)
+        # An update may have patched the configs
+        ctx.invalidate_configs()
         if updated:
             return Communicate
 
@@ -371,6 +521,8 @@ nvs_task_log.register(CheckForUpdates)
 # Scheduling
 # --------------------------------------------------
 
+# {"schedule": [[task, sched_class, *args], ...]}, an object so that
+# conf_patch updates can replace the schedule (see schedule.make_rule)
 SCHEDULE_PATH = "conf/schedule.json"
 
 SCHEDULE_DEFAULT = [
@@ -385,33 +537,142 @@ TASK_STRS = {
         "Communicate": Communicate,
         }
 
+# Order of the tasks in schedule entries packed for NVS (see schedule.pack_entry)
+SCHED_TASKS = ("TakeMeasurement", "Communicate")
+
+# The schedule's timeline in NVS: the signature of the schedule config,
+# and the next fire time of each of its rules (see schedule.Timeline)
+SCHED_SIG_KEY = "sched_sig"
+SCHED_FIRE_KEY = "sched_{:03d}"
+
+# The schedule config read from the schedule file, packed, and the size and
+# mtime of the file it was read from. Number of entries 0 if they do not fit.
+SCHED_FSIZE_KEY = "sched_fsize"
+SCHED_FMTIME_KEY = "sched_fmtime"
+SCHED_N_KEY = "sched_n"
+SCHED_ENTRY_KEY = "sched_c{:03d}"
+
+def load_timeline(sched_cfg, secs):
+    """ The saved timeline of the schedule, or a new one if none fits """
+    import schedule
+    sig = nvs_get_default(SCHED_SIG_KEY)
+    fires = [nvs_get_default(SCHED_FIRE_KEY.format(i)) for i in range(len(sched_cfg))]
+    # The hardware ID sets the unit's delay in jitter windows
+    return schedule.Timeline(sched_cfg, secs, fires, sig, seed=machine.unique_id())
+
+def schedule_file_key():
+    """ (size, mtime) of the schedule file, or None if there is none """
+    import os
+    if not hw:
+        return None
+    try:
+        ctx.prepare_sd(hw)
+    except Exception as e:
+        _logger.exc(e, "Could not read schedule from SD card")
+        return None
+    try:
+        st = os.stat(SCHEDULE_PATH)
+    except OSError:
+        return None
+    return (st[6], st[8])
+
+def read_schedule_cfg(secs, check=True):
+    """ The schedule from the SD card if valid, else SCHEDULE_DEFAULT """
+    import configutil
+    import schedule
+    try:
+        sched_cfg = configutil.read_config_json(SCHEDULE_PATH, {"schedule": SCHEDULE_DEFAULT}).schedule
+        if check:
+            # Without Communicate the unit could never fetch a fixed schedule
+            schedule.validate(sched_cfg, secs, tasks=TASK_STRS, required=("Communicate",))
+        return sched_cfg
+    except Exception as e:
+        _logger.exc(e, "Bad schedule in %s. Using the default.", SCHEDULE_PATH)
+        return SCHEDULE_DEFAULT
+
+def saved_schedule_cfg(secs):
+    """ The schedule config saved in NVS by save_schedule_cfg
+
+    A config that did not pack (e.g. with cron entries) is read from the
+    file again, but not checked again.
+    """
+    import schedule
+    n = nvs_get_default(SCHED_N_KEY, 0)
+    if not n:
+        return read_schedule_cfg(secs, check=False)
+    return [schedule.unpack_entry(nvs_get_default(SCHED_ENTRY_KEY.format(i)), SCHED_TASKS)
+            for i in range(n)]
+
+def save_schedule_cfg(key, sched_cfg):
+    """ Saves a schedule config read from a file with this key """
+    import schedule
+    codes = [schedule.pack_entry(entry, SCHED_TASKS) for entry in sched_cfg]
+    if None in codes:
+        codes = []
+    for i, code in enumerate(codes):
+        pycom.nvs_set(SCHED_ENTRY_KEY.format(i), code)
+    pycom.nvs_set(SCHED_N_KEY, len(codes))
+    pycom.nvs_set(SCHED_FSIZE_KEY, key[0])
+    pycom.nvs_set(SCHED_FMTIME_KEY, key[1])
+
+def load_schedule(secs):
+    """ The schedule config and its timeline, kept in ctx for the wake
+
+    The config is read from the file and checked only when the size or mtime
+    of the file change, and saved in NVS. Until then, it comes from NVS, and
+    the timeline from the fire times in NVS.
+    """
+    key = schedule_file_key()
+    if ctx.schedule and ctx.schedule[0] == key:
+        return ctx.schedule[1], ctx.schedule[2]
+    if not key:
+        sched_cfg = SCHEDULE_DEFAULT
+    elif key == (nvs_get_default(SCHED_FSIZE_KEY), nvs_get_default(SCHED_FMTIME_KEY)):
+        sched_cfg = saved_schedule_cfg(secs)
+    else:
+        sched_cfg = read_schedule_cfg(secs)
+        save_schedule_cfg(key, sched_cfg)
+    timeline = load_timeline(sched_cfg, secs)
+    ctx.schedule = [key, sched_cfg, timeline]
+    return sched_cfg, timeline
+
+def save_timeline(timeline):
+    """ Saves the entries of the timeline that changed, one write each """
+    fires = timeline.rule_fires()
+    for i in timeline.dirty:
+        pycom.nvs_set(SCHED_FIRE_KEY.format(i), fires[i])
+    if len(timeline.dirty) == len(timeline.sched):
+        # All compiled anew, maybe for another schedule
+        pycom.nvs_set(SCHED_SIG_KEY, timeline.sig)
+    timeline.dirty = []
+
 class CheckSchedule(object):
-    def runwith(self, itt, sched_cfg, ett=None):
+    def runwith(self, itt, sched_cfg, ett=None, timeline=None):
         import schedule
+        import timeutil
 
         _logger.info("Current time (interal  RTC): %s", itt)
         _logger.info("Current time (external RTC): %s", ett)
 
-        sched = schedule.Schedule(sched_cfg)
-        for task, task_sched in sched.sched:
+        secs = timeutil.mktime(itt)
+        if timeline is None:
+            timeline = schedule.Timeline(sched_cfg, secs)
+        for task, task_sched in timeline.sched:
             _logger.info("Schedule item: %s, %s", task, task_sched)
 
-        tasks = sched.check(itt)
+        tasks = timeline.due(secs)
         if ett:
-            etasks = sched.check(ett)
+            esecs = timeutil.mktime(ett)
+            etasks = timeline.due(esecs)
             if tasks != etasks:
                 if ett < itt:
                     _logger.info("Scheduled to run %s, but we are early. Going by external time: %s.", tasks, etasks)
                     tasks = etasks
+                    secs = esecs
                 else:
                     _logger.info("Scheduled to run %s, but we are late. Running those tasks.", tasks)
 
-        if ett and ett < itt:
-            etasks = sched.check(ett)
-            if tasks != etasks:
-                _logger.info("Scheduled to run %s, but we are early. Going by external time: %s.", tasks, etasks)
-                tasks = etasks
-
+        timeline.advance(secs)
         _logger.info("Scheduled to run %s", tasks)
 
         task_objs = []
@@ -425,10 +686,14 @@ class CheckSchedule(object):
 
     def run(self):
         import utime
+        import timeutil
         itt = utime.localtime()
         ett = hw.ertc.get_time()
-        hw.sync_to_most_reliable_rtc(reset_ok=True)
-        return self.runwith(itt=itt, ett=ett, sched_cfg=SCHEDULE_DEFAULT)
+        ctx.sync_rtc(hw)
+        sched_cfg, timeline = load_schedule(timeutil.mktime(itt))
+        tasks = self.runwith(itt=itt, ett=ett, sched_cfg=sched_cfg, timeline=timeline)
+        save_timeline(timeline)
+        return tasks
 
 nvs_task_log.register(CheckSchedule)
 
@@ -436,21 +701,26 @@ class SleepUntilScheduled(object):
 
     MIN_DEEPSLEEP_MS = 1000 * 20
 
-    def runwith(self, tt=None, sched_cfg=None):
+    def runwith(self, tt=None, sched_cfg=None, timeline=None):
         import schedule
         import timeutil
 
         _logger.info("Current time: %s", tt)
 
-        sched = schedule.Schedule(sched_cfg)
-        agenda = sched.next(tt)
+        now = timeutil.mktime(tt)
+        if timeline is None:
+            timeline = schedule.Timeline(sched_cfg, now)
+        # Whatever is due now has been run by CheckSchedule (or is skipped)
+        timeline.advance(now)
+        agenda = timeline.agenda()
 
-        for next_tt, task in agenda:
-            secs = timeutil.mktime(next_tt) - timeutil.mktime(tt)
+        for next_secs, task in agenda:
+            next_tt = timeutil.localtime(next_secs)
+            secs = next_secs - now
             _logger.info("At  {next_tt!s:32} (T minus {secs:5d} seconds), {task}".format(next_tt=next_tt, task=task, secs=secs))
 
-        next_tt, task = agenda[0]
-        secs = timeutil.mktime(next_tt) - timeutil.mktime(tt)
+        next_secs, task = agenda[0]
+        secs = next_secs - now
         ms = secs * 1000
 
         # Deep sleep is not really worth it for less than ~30 sec.
@@ -460,6 +730,9 @@ class SleepUntilScheduled(object):
             utime.sleep_ms(ms)
             return [CheckSchedule, SleepUntilScheduled]
 
+        # Records kept in RAM during the wake (see co2unit_errors)
+        logging.flush()
+
         if hw:
             _logger.info("Preparing for shutdown")
             hw.prepare_for_shutdown()
@@ -469,8 +742,17 @@ class SleepUntilScheduled(object):
 
     def run(self):
         import utime
+        import timeutil
         tt = utime.localtime()
-        sched = SCHEDULE_DEFAULT
-        return self.runwith(tt=tt, sched_cfg=SCHEDULE_DEFAULT)
+        secs = timeutil.mktime(tt)
+        sched_cfg, timeline = load_schedule(secs)
+        # Save before deep sleep, which does not return
+        timeline.advance(secs)
+        save_timeline(timeline)
+        return self.runwith(tt=tt, sched_cfg=sched_cfg, timeline=timeline)
 
 nvs_task_log.register(SleepUntilScheduled)
+
+# Tasks added later register after all others, keeping the IDs of the
+# tasks before them in the run logs saved in NVS
+nvs_task_log.register(CompactReadings)
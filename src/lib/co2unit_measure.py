@@ -1,8 +1,8 @@
 import logging
-import machine
 import os
 import time
 
+import co2unit_acquire
 import co2unit_id
 import configutil
 import explorir
@@ -14,6 +14,20 @@ _logger = logging.getLogger("co2unit_measure")
 
 wdt = timeutil.DummyWdt()
 
+MEASURE_CONF_PATH = "conf/ou-measure-config.json"
+MEASURE_CONF_DEFAULTS = {
+        "reading_format": "tsv",    # "tsv", "bin", or "both"
+        "co2_mode": "fixed",        # "fixed" or "adaptive" (see co2unit_settle)
+        "co2_max_reads": 10,        # Hard cap, at most CO2_SLOTS
+        "co2_read_interval_ms": 500,
+        "co2_settle_count": 3,      # Adaptive: stop after this many readings agree
+        "co2_settle_ppm": 20,       # Adaptive: ... within this many ppm
+        }
+
+# Number of CO2 reading columns in each row.
+# Readings not taken (or failed) are stored as None.
+CO2_SLOTS = const(10)
+
 CO2_RAWS = [
             explorir.FIELD_CO2_OUTPUT_FILTERED,
             explorir.FIELD_LED_NORMALIZED_FILTERED,
@@ -22,105 +36,36 @@ CO2_RAWS = [
             explorir.FIELD_SENSOR_TEMPERATURE_FILTERED,
             ]
 
-def read_sensors(hw, flash_count=0):
+def read_sensors(hw, flash_count=0, mc=None):
+    """ Reads all sensors for one measurement
+
+    The sensors are read concurrently (see co2unit_acquire), and the reading
+    includes a trace of how long each phase took.
+    """
+    if mc is None:
+        mc = configutil.Namespace(**MEASURE_CONF_DEFAULTS)
 
     rtime = time.gmtime()
-    chrono = machine.Timer.Chrono()
-    chrono.start()
-
-    # Notes
-    #
-    # Temperature: Reading temperature is asynchronous. You call a method to
-    # start it, and then read it later. Spec says 750 ms max.
-    #
-    # CO2: The sensor needs a little time to boot after power-off before it
-    # will start responding to UART commands. In tests, about 165 ms seems to
-    # work. But even after that, it will return wild readings at first. Need to
-    # take a few readings until they settle.
-    #
-    # Experience shows that it's the first two that are way off, either 0 (min)
-    # or 200010 (the max)
-
-    etemp_reading = None
-    etemp_ms = None
-
-    co2_readings = [None] * 10
-    co2_i = 0
-    co2_ms = None
-
-    # Start temperature readings
-    try:
-        _logger.debug("Starting external temp read. Can take up to 750ms.")
-        etemp = hw.etemp
-        etemp.start_conversion()
-    except Exception as e:
-        _logger.error("Unexpected error starting etemp reading. %s: %s", type(e).__name__, e)
+    trace = co2unit_acquire.Trace(time)
+    result = {}
+    co2_readings = [None] * CO2_SLOTS
 
-    # Give CO2 sensor time to boot up after power-on
-    time.sleep_ms(200)
-
-    # Init communication with CO2 sensor
-    try:
-        _logger.debug("Init CO2 sensor...")
-        co2 = hw.co2
-        co2.set_mode(explorir.MODE_POLLING);
-    except Exception as e:
-        _logger.error("Unexpected error initializing CO2 sensor. %s: %s", type(e).__name__, e)
-
-    def try_read_co2_sensor():
-        try:
-            co2_readings[co2_i] = co2.read_co2()    # [] = will propagate
-            co2_ms = chrono.read_ms()               #    = will NOT propagate
-            _logger.info("CO2 reading #%d: %6d ppm at %4d ms", co2_i, co2_readings[co2_i], co2_ms)
-        except Exception as e:
-            _logger.error("Unexpected error during CO2 sensor reading #%d. %s: %s", co2_i, type(e).__name__, e)
-        finally:
-            co2_i += 1                              #   += will propagate
-
-    # Do throwaway reads of CO2 while waiting for temperature
-    try_read_co2_sensor()
-    time.sleep_ms(500)
-    wdt.feed()
-    try_read_co2_sensor()
-
-    # Read temperature
-    try:
-        _logger.debug("Waiting for external temp read...")
-        while not etemp_reading:
-            etemp_reading = etemp.read_temp_async()
-            etemp_ms = chrono.read_ms()
-            _logger.info("etemp reading : %6.3f C   at %4d ms", etemp_reading, etemp_ms)
-            if not etemp_reading and etemp_ms > 1000:
-                _logger.error("Timeout reading external temp sensor after %d ms", etemp_ms)
-                break
-            time.sleep_ms(5)
-            wdt.feed()
-    except Exception as e:
-        _logger.error("Unexpected error waiting for etemp reading. %s: %s", type(e).__name__, e)
-
-    # Do more reads of CO2 sensor
-    for _ in range(co2_i, len(co2_readings)):
-        time.sleep_ms(500)
-        wdt.feed()
-        try_read_co2_sensor()
-    # co2_ms did not propagate like the others, so get it again
-    co2_ms = chrono.read_ms()
-
-    co2_raws = {field:None for field in CO2_RAWS}
-    try:
-        co2.select_fields(CO2_RAWS)
-        co2_raws = co2.read_fields()
-    except:
-        _logger.exception("Unexpected error reading co2 multi-fields")
+    co2unit_acquire.run_tasks([
+        co2unit_acquire.etemp_task(hw, result, trace),
+        co2unit_acquire.co2_task(hw, co2_readings, CO2_RAWS, mc, result, trace),
+        ], trace, wdt=wdt)
+    _logger.info("CO2: %d readings (%s mode). Phases: %s", result["co2_samples"], mc.co2_mode, trace)
 
     reading = {
             "rtime":    rtime,
             "co2":      co2_readings,
-            "co2_ms":   co2_ms,
-            "etemp":    etemp_reading,
-            "etemp_ms": etemp_ms,
+            "co2_ms":   result["co2_ms"],
+            "co2_samples": result["co2_samples"],
+            "etemp":    result["etemp"],
+            "etemp_ms": result["etemp_ms"],
             "flash_count": flash_count,
-            "co2_raws": co2_raws,
+            "co2_raws": result["co2_raws"],
+            "phases":   trace.phases,
             }
     return reading
 
@@ -144,8 +89,9 @@ def make_row(ou_id, reading):
 
 READING_FILE_MATCH = ("readings-", ".tsv")
 READING_FILE_SIZE_CUTOFF = const(100 * 1024)
+READING_INDEX_PATH = "var/readings-append-index.json"
 
-def store_reading(ou_id, reading_data_dir, reading):
+def store_reading(ou_id, reading_data_dir, reading, index_path=None):
     row = make_row(ou_id, reading)
     row = "\t".join([str(i) for i in row])
 
@@ -157,7 +103,8 @@ def store_reading(ou_id, reading_data_dir, reading):
 
     target = fileutil.prep_append_file(
             dir=reading_data_dir,
-            match=READING_FILE_MATCH, size_limit=READING_FILE_SIZE_CUTOFF)
+            match=READING_FILE_MATCH, size_limit=READING_FILE_SIZE_CUTOFF,
+            index_path=index_path)
 
     _logger.debug("Writing data to %s ...", target)
     with open(target, "at") as f:
@@ -166,17 +113,123 @@ def store_reading(ou_id, reading_data_dir, reading):
     _logger.info("Wrote row to %s: %s\t", target, row)
     return (target, row)
 
-def measure_sequence(hw, flash_count=0):
-    _logger.info("Starting measurement sequence...")
+READING_BIN_MATCH = ("readings-", ".bin")
+READING_BIN_INDEX_PATH = "var/readings-bin-append-index.json"
+READING_BIN_CO2_SLOTS = const(10)
+
+# Header, tag, record format and record buffer of the binary files,
+# built on first use for the unit's ID (see _bin_layout)
+_bin = None
+
+def _bin_layout(ou_id):
+    global _bin
+    key = (ou_id.hw_id, ou_id.site_code)
+    if _bin is None or _bin[0] != key:
+        import co2unit_packed
+        import ubinascii
+        header = co2unit_packed.pack_header(ou_id.hw_id, ou_id.site_code,
+                CO2_RAWS, READING_BIN_CO2_SLOTS)
+        fmt = co2unit_packed.record_fmt(READING_BIN_CO2_SLOTS, len(CO2_RAWS))
+        tag = ubinascii.hexlify(header).decode()
+        _bin = (key, header, tag, fmt, co2unit_packed.new_record_buf(fmt))
+    return _bin
+
+def _bin_target(reading_data_dir, header, tag, index_path):
+    """ The file to append the record to, for a given header
+
+    The append index carries the header as its tag, so the usual case costs
+    no more than for TSV. Without a matching tag, the current file's header
+    is read once and the index saved with the tag.
+    """
+    import seqfile
+    if index_path:
+        target = seqfile.check_append_index(index_path, reading_data_dir,
+                READING_BIN_MATCH, READING_FILE_SIZE_CUTOFF, tag=tag)
+        if target:
+            return "/".join([reading_data_dir, target])
 
-    hw.sync_to_most_reliable_rtc(reset_ok=True)
-    hw.mount_sd_card()
-    os.chdir(hw.SDCARD_MOUNT_POINT)
+    target = fileutil.prep_append_file(
+            dir=reading_data_dir,
+            match=READING_BIN_MATCH, size_limit=READING_FILE_SIZE_CUTOFF,
+            index_path=index_path)
 
-    reading = read_sensors(hw, flash_count=flash_count)
+    # Every record in a file shares the file's header,
+    # so if the ID or layout has changed, start a new file
+    try:
+        with open(target, "rb") as f:
+            existing = f.read(len(header))
+    except OSError:
+        existing = b""
+    if existing and existing != header:
+        prev = target
+        target = "/".join([reading_data_dir,
+            seqfile.next_sequence_filename(prev.split("/")[-1], READING_BIN_MATCH)])
+        _logger.info("%s : header differs from current reading, starting %s", prev, target)
+
+    if index_path:
+        seqfile.save_append_index(index_path, reading_data_dir, target.split("/")[-1], tag)
+    return target
+
+def store_reading_bin(ou_id, reading_data_dir, reading, index_path=None):
+    """ Stores a reading in the fixed-width binary format (see co2unit_packed) """
+    import co2unit_packed
+
+    key, header, tag, fmt, record = _bin_layout(ou_id)
+
+    co2s = reading["co2"]
+    if len(co2s) != READING_BIN_CO2_SLOTS:
+        co2s = (co2s + [None] * READING_BIN_CO2_SLOTS)[:READING_BIN_CO2_SLOTS]
+    co2_raws = [reading["co2_raws"][field] for field in CO2_RAWS]
+    co2unit_packed.pack_record(record, fmt, timeutil.mktime(reading["rtime"]),
+            reading["etemp"], reading["flash_count"], co2s, co2_raws)
+
+    target = _bin_target(reading_data_dir, header, tag, index_path)
+
+    _logger.debug("Writing binary record to %s ...", target)
+    with open(target, "ab") as f:
+        # A new file gets the header first
+        f.seek(0, 2)
+        if f.tell() == 0:
+            f.write(header)
+        f.write(record)
+    _logger.info("Wrote %d-byte record to %s", len(record), target)
+    return (target, record)
+
+def measure_sequence(hw, flash_count=0, ctx=None):
+    """ Takes a reading and stores it
+
+    ctx shares the RTC sync, SD card and configs of the wake with other
+    tasks (see co2unit_main2.WakeContext). Without it, does all that here.
+    """
+    _logger.info("Starting measurement sequence...")
+
+    if ctx:
+        ctx.prepare_sd(hw)
+        read_config = ctx.read_config
+    else:
+        hw.sync_to_most_reliable_rtc(reset_ok=True)
+        hw.mount_sd_card()
+        os.chdir(hw.SDCARD_MOUNT_POINT)
+        read_config = configutil.read_config_json
+
+    mc = read_config(MEASURE_CONF_PATH, MEASURE_CONF_DEFAULTS)
+    reading = read_sensors(hw, flash_count=flash_count, mc=mc)
     _logger.info("Reading: %s", reading)
 
-    ou_id = configutil.read_config_json(co2unit_id.OU_ID_PATH, co2unit_id.OU_ID_DEFAULTS)
+    ou_id = read_config(co2unit_id.OU_ID_PATH, co2unit_id.OU_ID_DEFAULTS)
 
     reading_data_dir = hw.SDCARD_MOUNT_POINT + "/data/readings"
-    return store_reading(ou_id, reading_data_dir, reading)
+    stored = None
+
+    if mc.reading_format in ("bin", "both"):
+        index_path = hw.SDCARD_MOUNT_POINT + "/" + READING_BIN_INDEX_PATH
+        stored = store_reading_bin(ou_id, reading_data_dir, reading, index_path=index_path)
+
+    if mc.reading_format != "bin":
+        if mc.reading_format not in ("tsv", "both"):
+            _logger.warning("Unknown reading_format %r. Storing as TSV.", mc.reading_format)
+        index_path = hw.SDCARD_MOUNT_POINT + "/" + READING_INDEX_PATH
+        stored = store_reading(ou_id, reading_data_dir, reading, index_path=index_path)
+
+    return stored
+
@@ -0,0 +1,164 @@
+"""
+Fixed-width binary format for CO2 readings
+
+This is an optional, more compact alternative to the TSV readings files.
+Each file starts with a header, followed by fixed-width records.
+
+Header (all integers little-endian):
+
+    4 bytes     magic b"CO2R"
+    1 byte      format version (currently 1)
+    1 byte      number of CO2 reading slots per record (n_co2)
+    1+n bytes   hardware id (length-prefixed string)
+    1+n bytes   site code (length-prefixed string)
+    1+n bytes   ExplorIr field codes of the raw fields (length-prefixed string)
+
+Record (48 bytes with 10 CO2 slots and 5 raw fields):
+
+    uint32      reading time, seconds since 1970
+    int16       external temperature in 1/16 C (the sensor's resolution),
+                -32768 if missing
+    uint16      camera flashes observed since last reading
+    uint16 * n  CO2 readings (ppm), see below, 0xffff if missing
+    int32 * n   raw ExplorIr fields, -1 if missing
+
+A CO2 reading below 0x8000 is stored as is. Larger ones are stored in
+tens of ppm with the top bit set, so the sensor's startup reading of
+200010 survives exactly.
+
+This module has no device dependencies,
+so the same code is used by the host-side decoder.
+"""
+
+try:
+    import ustruct as struct
+except ImportError:
+    import struct
+
+MAGIC = b"CO2R"
+VERSION = 1
+
+MISSING_INT = -1
+MISSING_ETEMP = -32768
+MISSING_CO2 = 0xffff
+ETEMP_SCALE = 16
+
+class PackedFormatError(Exception): pass
+
+def _pack_str(s):
+    b = s.encode("utf-8") if isinstance(s, str) else bytes(s)
+    if len(b) > 255:
+        raise PackedFormatError("String too long for header: %r" % s)
+    return bytes([len(b)]) + b
+
+def _unpack_str(data, pos):
+    n = data[pos]
+    pos += 1
+    return str(data[pos:pos+n], "utf-8"), pos + n
+
+def pack_header(hw_id, site_code, raw_fields, n_co2=10):
+    raw_fields = "".join(raw_fields)
+    return MAGIC + bytes([VERSION, n_co2]) \
+            + _pack_str(str(hw_id)) + _pack_str(str(site_code)) + _pack_str(raw_fields)
+
+def unpack_header(data):
+    """ Parses a header from the start of data
+
+    Returns a dictionary describing the file and the length of the header.
+    """
+    if data[0:4] != MAGIC:
+        raise PackedFormatError("Bad magic %r" % (data[0:4],))
+    version = data[4]
+    if version != VERSION:
+        raise PackedFormatError("Unsupported version %d" % version)
+    n_co2 = data[5]
+    pos = 6
+    hw_id, pos = _unpack_str(data, pos)
+    site_code, pos = _unpack_str(data, pos)
+    raw_fields, pos = _unpack_str(data, pos)
+    header = {
+            "version": version,
+            "n_co2": n_co2,
+            "hw_id": hw_id,
+            "site_code": site_code,
+            "raw_fields": list(raw_fields),
+            "record_fmt": record_fmt(n_co2, len(raw_fields)),
+            }
+    return header, pos
+
+def record_fmt(n_co2, n_raws):
+    return "<IhH%dH%di" % (n_co2, n_raws)
+
+def new_record_buf(fmt):
+    return bytearray(struct.calcsize(fmt))
+
+def _int_or_missing(val):
+    return MISSING_INT if val == None else int(val)
+
+def _pack_co2(val):
+    if val == None:
+        return MISSING_CO2
+    val = max(int(val), 0)
+    if val < 0x8000:
+        return val
+    return min(0x8000 | ((val + 5) // 10), MISSING_CO2 - 1)
+
+def _unpack_co2(code):
+    if code == MISSING_CO2:
+        return None
+    if code & 0x8000:
+        return (code & 0x7fff) * 10
+    return code
+
+def _pack_etemp(etemp):
+    if etemp == None:
+        return MISSING_ETEMP
+    return max(-32767, min(int(round(etemp * ETEMP_SCALE)), 32767))
+
+def pack_record(buf, fmt, ts, etemp, flash_count, co2s, raws):
+    """ Packs a record into buf,
+    a bytearray of struct.calcsize(fmt) bytes
+
+    co2s should have exactly the number of slots given in the header.
+    """
+    vals = [_pack_co2(v) for v in co2s] + [_int_or_missing(v) for v in raws]
+    struct.pack_into(fmt, buf, 0, ts, _pack_etemp(etemp), min(flash_count or 0, 0xffff), *vals)
+    return buf
+
+def unpack_records(data):
+    """ Generates (header, record) pairs from the contents of a packed file
+
+    Each record is a tuple (ts, etemp, flash_count, co2s, raws),
+    with missing values as None.
+    """
+    header, pos = unpack_header(data)
+    fmt = header["record_fmt"]
+    size = struct.calcsize(fmt)
+    n_co2 = header["n_co2"]
+
+    while pos + size <= len(data):
+        vals = struct.unpack_from(fmt, data, pos)
+        pos += size
+        ts, etemp, flash_count = vals[0:3]
+        co2s = [_unpack_co2(v) for v in vals[3:3+n_co2]]
+        raws = [None if v == MISSING_INT else v for v in vals[3+n_co2:]]
+        etemp = None if etemp == MISSING_ETEMP else etemp / ETEMP_SCALE
+        yield header, (ts, etemp, flash_count, co2s, raws)
+
+def record_row(header, record, tt):
+    """ Converts a record to the same columns as the TSV format
+
+    tt is the record's time (record[0]) as a time tuple.
+    """
+    ts, etemp, flash_count, co2s, raws = record
+    (YY, MM, DD, hh, mm, ss) = tt[0:6]
+    dateval = "{:04}-{:02}-{:02}".format(YY,MM,DD)
+    timeval = "{:02}:{:02}:{:02}".format(hh,mm,ss)
+    return [
+            header["hw_id"],
+            header["site_code"],
+            dateval,
+            timeval,
+            etemp,
+            flash_count,
+        ] + co2s + raws
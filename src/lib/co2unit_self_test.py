@@ -141,16 +141,18 @@ def led_show_scalar(i, ab):
 class CheckStep(object):
     def __init__(self, flag, suppress_exception=False):
         self.flag = flag
-        self.flag_hex = "0x%04x" % flag
-        self.flag_name = "{:20}".format(flag_name(flag))
         self.suppress_exception = suppress_exception
         self.chrono = machine.Timer.Chrono()
         self.extra_fmt_str = None
         self.extra_args = None
 
+    def label(self):
+        return "0x%04x %-20s" % (self.flag, flag_name(self.flag))
+
     def __enter__(self):
         pycom.rgbled(flag_color(self.flag))
-        _logger.debug("%s %s ...", self.flag_hex, self.flag_name)
+        if _logger.isEnabledFor(logging.DEBUG):
+            _logger.debug("%s ...", self.label())
         self.chrono.start()
 
     def __exit__(self, exc_type, exc_value, traceback):
@@ -159,12 +161,13 @@ class CheckStep(object):
         pycom.rgbled(0x0)
         if exc_type:
             failures |= self.flag
-            _logger.warning(" %s %s failed (%d ms). %s: %s", self.flag_hex, self.flag_name, elapsed, exc_type, exc_value)
+            _logger.warning(" %s failed (%d ms). %s: %s", self.label(), elapsed, exc_type, exc_value)
             if self.suppress_exception and exc_type!=KeyboardInterrupt:
                 return True
         else:
             failures &= ~self.flag
-            _logger.debug("%s %s OK (%d ms)", self.flag_hex, self.flag_name, elapsed)
+            if _logger.isEnabledFor(logging.DEBUG):
+                _logger.debug("%s OK (%d ms)", self.label(), elapsed)
 
 def show_boot_flags():
     _logger.info("pycom.wifi_on_boot():         %s", pycom.wifi_on_boot())
@@ -0,0 +1,43 @@
+"""
+Deciding when to stop reading the CO2 sensor
+
+After power-on, the ExplorIr gives a few wild readings before it settles,
+typically 0 (its min) or 200010 (its max). In "fixed" mode we always take
+the full number of readings. In "adaptive" mode we stop as soon as the last
+few readings are valid and agree within a tolerance.
+
+This module has no device dependencies, so it can be tested with recorded
+sensor traces.
+"""
+
+# Readings the sensor gives while it is still starting up
+CO2_BAD_VALUES = (0, 200010)
+
+def valid_co2(val):
+    return val is not None and val not in CO2_BAD_VALUES
+
+def co2_settled(readings, n, count, tolerance):
+    """ Checks if the last count of the first n readings agree
+
+    They agree if all are valid and within tolerance ppm of each other.
+    A failed or startup reading anywhere in the window means not settled.
+    """
+    if count < 1 or n < count:
+        return False
+    window = readings[n-count:n]
+    for val in window:
+        if not valid_co2(val):
+            return False
+    return max(window) - min(window) <= tolerance
+
+def co2_done(readings, n, mc):
+    """ Checks if we can stop after the first n readings
+
+    mc is the measurement config (see co2unit_measure.MEASURE_CONF_DEFAULTS).
+    The list of readings is the hard cap, whatever co2_max_reads says.
+    """
+    if n >= min(mc.co2_max_reads, len(readings)):
+        return True
+    if mc.co2_mode == "adaptive":
+        return co2_settled(readings, n, mc.co2_settle_count, mc.co2_settle_ppm)
+    return False
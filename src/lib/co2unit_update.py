@@ -20,6 +20,17 @@ UPDATE_STATE_DEFAULTS = {
         "installed": None,
         }
 
+# Optional list of the files in an update, with their sizes and hashes:
+#
+#   {"version": 1, "files": {"flash/lib/fileutil.mpy": [size, "sha256 hex"], ...}}
+#
+# Paths are relative to the update directory.
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 1
+FLASH_ROOT = "/flash"
+
+class UpdateError(Exception): pass
+
 class Namespace(object):
     def __init__(self, **kwargs):
         for k,v in kwargs.items():
@@ -86,16 +97,90 @@ def patch_configs(patches_path):
             wdt.feed()
         _logger.info("New %s: %s", target, targ_dict)
 
+def parse_manifest(text):
+    """ Returns the files of a manifest as a dict {relpath: (size, sha256)} """
+    manifest = json.loads(text)
+    if manifest.get("version") != MANIFEST_VERSION:
+        raise UpdateError("Unsupported manifest version %s" % manifest.get("version"))
+    files = {}
+    for relpath, (size, sha256) in manifest["files"].items():
+        if relpath.startswith("/") or ".." in relpath.split("/"):
+            raise UpdateError("Bad path in manifest: %s" % relpath)
+        files[relpath] = (size, sha256)
+    return files
+
+def read_manifest(subpath):
+    """ Reads the manifest of an update, or returns None if it has none """
+    mpath = subpath + "/" + MANIFEST_NAME
+    if not fileutil.isfile(mpath):
+        return None
+    with open(mpath) as f:
+        return parse_manifest(f.read())
+
+def installed_path(relpath, flash_root=FLASH_ROOT):
+    """ Where a file of an update is installed, or None if it is not copied """
+    if relpath.startswith("flash/"):
+        return flash_root + relpath[5:]
+    return None
+
+def is_installed(relpath, size, sha256, flash_root=FLASH_ROOT):
+    """ Checks if an update file is already in place with the same contents """
+    dest = installed_path(relpath, flash_root)
+    return dest is not None and fileutil.file_matches(dest, size, sha256, wdt=wdt)
+
+def files_to_fetch(files, flash_root=FLASH_ROOT):
+    """ Lists the manifest files that are not already installed """
+    return [relpath for relpath in sorted(files)
+            if not is_installed(relpath, files[relpath][0], files[relpath][1], flash_root)]
+
+def install_from_manifest(subpath, files, flash_root=FLASH_ROOT):
+    """ Copies the files of an update that differ from what is installed
+
+    Every file is checked before anything is copied, so a corrupt or
+    incomplete update leaves the flash untouched. Returns a fileutil.CopyStats.
+    """
+    import utime
+    stats = fileutil.CopyStats()
+    start = utime.ticks_ms()
+    buf = bytearray(fileutil.COPY_BLOCK_SIZE)
+
+    to_copy = []
+    for relpath in sorted(files):
+        dest = installed_path(relpath, flash_root)
+        if dest is None:
+            continue
+        size, sha256 = files[relpath]
+        if fileutil.file_matches(dest, size, sha256, wdt=wdt, buf=buf):
+            _logger.info("%s is unchanged", dest)
+            stats.files_skipped += 1
+            continue
+        src = subpath + "/" + relpath
+        if not fileutil.file_matches(src, size, sha256, wdt=wdt, buf=buf):
+            raise UpdateError("%s is missing or does not match manifest" % src)
+        to_copy.append((src, dest))
+
+    for src, dest in to_copy:
+        fileutil.mkdirs(fileutil.dirname(dest), wdt=wdt)
+        stats.bytes_copied += fileutil.copy_file(src, dest, wdt=wdt, buf=buf)
+        stats.files_copied += 1
+    stats.ms = utime.ticks_diff(utime.ticks_ms(), start)
+    _logger.info("Installed from manifest: %s", stats)
+    return stats
+
 def install_update(upstate, subpath):
 
     try:
         _logger.info("Installing update from %s", subpath)
 
         contents = os.listdir(subpath)
+        files = read_manifest(subpath)
 
-        if "flash" in contents:
+        if files is not None:
+            _logger.info("Copying changed files into flash filesystem...")
+            install_from_manifest(subpath, files)
+        elif "flash" in contents:
             _logger.info("Copying new source into flash filesystem...")
-            fileutil.copy_recursive(subpath+"/flash", "/flash", wdt=wdt)
+            fileutil.copy_recursive(subpath+"/flash", FLASH_ROOT, wdt=wdt, skip_matching=True)
 
         if "conf-patch" in contents:
             patch_configs(subpath + "/conf-patch")
@@ -107,12 +192,15 @@ def install_update(upstate, subpath):
     finally:
         configutil.save_config_json(UPDATE_STATE_PATH, upstate)
 
-def update_sequence(hw):
+def update_sequence(hw, ctx=None):
     _logger.info("Starting check for updates...")
-    hw.sync_to_most_reliable_rtc(reset_ok=True)
-    hw.mount_sd_card()
+    if ctx:
+        ctx.prepare_sd(hw)
+    else:
+        hw.sync_to_most_reliable_rtc(reset_ok=True)
+        hw.mount_sd_card()
+        os.chdir(hw.SDCARD_MOUNT_POINT)
 
-    os.chdir(hw.SDCARD_MOUNT_POINT)
     upstate, new_update = check_for_updates(UPDATES_DIR)
     if new_update:
         return install_update(upstate, new_update)
@@ -144,7 +144,7 @@ class ExplorIr(object):
         return self._multiplier
 
     def set_mode(self, mode):
-        _logger.debug("Switching to mode %d" % mode)
+        _logger.debug("Switching to mode %d", mode)
         cmd = b"K %d\r\n" % mode
         self.uart_cmd_return_int(cmd, expect_code="K", expect_int=mode)
 
@@ -33,6 +33,7 @@ def mkdirs(path, wdt=None):
 
     for i in range(0, len(pathparts)+1):
         curpath = "/".join(pathparts[0:i])
+        if not curpath: continue
         try:
             os.mkdir(curpath)
             if wdt: wdt.feed()
@@ -68,50 +69,238 @@ def rm_recursive(path, wdt=None):
         if "No such file" in str(e):
             _logger.warning("Does not exist %s", path)
 
-def copy_file(src_path, dest_path, block_size=512, wdt=None):
-    buf = bytearray(block_size)
+# Copy buffer size. Flash and SD both do much better with large blocks.
+COPY_BLOCK_SIZE = const(4096)
+TMP_SUFFIX = ".tmp"
+
+class CopyStats(object):
+    """ Counts what a copy did, for logs and benchmarks """
+    def __init__(self):
+        self.files_copied = 0
+        self.files_skipped = 0
+        self.bytes_copied = 0
+        self.ms = 0
+
+    def bytes_per_sec(self):
+        return self.bytes_copied * 1000 // self.ms if self.ms else 0
+
+    def __str__(self):
+        return "%d files copied (%d bytes), %d unchanged, %d ms, %d B/s" % (
+                self.files_copied, self.bytes_copied, self.files_skipped,
+                self.ms, self.bytes_per_sec())
+
+def _replace(tmp_path, dest_path):
+    # FAT cannot rename over an existing file
+    try:
+        os.rename(tmp_path, dest_path)
+    except OSError:
+        os.remove(dest_path)
+        os.rename(tmp_path, dest_path)
+
+def copy_file(src_path, dest_path, block_size=COPY_BLOCK_SIZE, wdt=None, buf=None, size=None):
+    """ Copies a file, returns the number of bytes copied
+
+    The copy is written to a temporary file next to dest_path and renamed
+    over dest_path when complete, so an interrupted copy never leaves a
+    truncated dest_path.
+
+    buf, if given, is used instead of allocating a new block_size buffer.
+    size, if given, copies only the first size bytes. FAT files cannot be
+    truncated, so copying a file onto itself this way is how to cut one.
+    """
+    if buf is None:
+        buf = bytearray(block_size)
     mv = memoryview(buf)
+    tmp_path = dest_path + TMP_SUFFIX
+    total = 0
     with open(src_path, "rb") as src:
-        with open(dest_path, "wb") as dest:
+        with open(tmp_path, "wb") as dest:
             while True:
-                bytes_read = src.readinto(buf)
+                if size is None or size - total >= len(buf):
+                    bytes_read = src.readinto(buf)
+                else:
+                    bytes_read = src.readinto(mv[:size - total])
                 if wdt: wdt.feed()
-                _logger.debug("Read  %4d bytes from %s", bytes_read, src_path)
                 if not bytes_read:
                     break
                 bytes_written = 0
                 while bytes_written != bytes_read:
                     bytes_written += dest.write(mv[bytes_written:bytes_read])
-                    if wdt: wdt.feed()
-                    _logger.debug("Wrote %4d bytes to   %s", bytes_written, dest_path)
-    _logger.info("Copied %s -> %s", src_path, dest_path)
+                total += bytes_read
+    _replace(tmp_path, dest_path)
+    _logger.info("Copied %s -> %s (%d bytes)", src_path, dest_path, total)
+    return total
 
-def copy_recursive(src_path, dest_path, block_size=512, wdt=None):
-    if wdt: wdt.feed()
+def same_contents(src_path, dest_path, block_size=COPY_BLOCK_SIZE, wdt=None, buf=None):
+    """ Checks if two files have the same size and SHA-256 """
     try:
-        contents = os.listdir(src_path)
-    except:
-        contents = None
+        size = file_size(src_path)
+    except OSError:
+        return False
+    if not file_matches(dest_path, size, None):
+        return False
+    return file_sha256(src_path, block_size, wdt, buf) == file_sha256(dest_path, block_size, wdt, buf)
 
-    if contents==None:
-        copy_file(src_path, dest_path, block_size, wdt=wdt)
-        if wdt: wdt.feed()
+def _list_entries(path):
+    """ Lists (name, is_dir) pairs, or returns None if path is not a directory """
+    try:
+        if hasattr(os, "ilistdir"):
+            # One directory read gives the type of each entry too
+            # Type 0 means the filesystem did not say
+            return [(e[0], e[1] == 0x4000 if e[1] else isdir("%s/%s" % (path, e[0])))
+                    for e in os.ilistdir(path)]
+        names = os.listdir(path)
+    except OSError:
+        return None
+    return [(n, isdir("%s/%s" % (path, n))) for n in names]
 
+def copy_recursive(src_path, dest_path, block_size=COPY_BLOCK_SIZE, wdt=None,
+        skip_matching=False, stats=None, buf=None):
+    """ Copies a file or directory tree, returns a CopyStats
+
+    With skip_matching, files whose destination already has the same size
+    and SHA-256 are not rewritten. This saves flash wear on updates that
+    change only a few files.
+    """
+    import utime
+    if stats is None:
+        stats = CopyStats()
+    if buf is None:
+        buf = bytearray(block_size)
+    start = utime.ticks_ms()
+
+    entries = _list_entries(src_path)
+    if entries is None:
+        _copy_one(src_path, dest_path, block_size, wdt, skip_matching, stats, buf)
     else:
-        mkdirs(dest_path, wdt=wdt)
-        for child in contents:
+        _copy_tree(src_path, dest_path, entries, block_size, wdt, skip_matching, stats, buf)
+
+    stats.ms += utime.ticks_diff(utime.ticks_ms(), start)
+    _logger.info("Copied %s -> %s: %s", src_path, dest_path, stats)
+    return stats
+
+def _copy_one(src_path, dest_path, block_size, wdt, skip_matching, stats, buf):
+    if skip_matching and same_contents(src_path, dest_path, block_size, wdt, buf):
+        _logger.debug("Unchanged %s", dest_path)
+        stats.files_skipped += 1
+        return
+    stats.bytes_copied += copy_file(src_path, dest_path, wdt=wdt, buf=buf)
+    stats.files_copied += 1
+
+def _copy_tree(src_path, dest_path, entries, block_size, wdt, skip_matching, stats, buf):
+    mkdirs(dest_path, wdt=wdt)
+    for name, is_dir in entries:
+        if wdt: wdt.feed()
+        src_child = "%s/%s" % (src_path, name)
+        dest_child = "%s/%s" % (dest_path, name)
+        if is_dir:
+            _copy_tree(src_child, dest_child, _list_entries(src_child),
+                    block_size, wdt, skip_matching, stats, buf)
+        else:
+            _copy_one(src_child, dest_child, block_size, wdt, skip_matching, stats, buf)
+
+class SequentialReader(object):
+    """ Reads files front to back through one preallocated buffer
+
+    The file stays open between reads, and is only seeked when asked for an
+    offset other than where the last read ended. Reads return memoryview
+    slices of the buffer, valid until the next read. A full read is the view
+    of the whole buffer, so reading in whole chunks allocates nothing.
+    """
+
+    def __init__(self, buf):
+        self.buf = buf
+        self.mv = memoryview(buf)
+        self.f = None
+        self.path = None
+        self.pos = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self, path, offset=0):
+        """ Positions the reader at offset in path, opening it if need be """
+        if path != self.path:
+            self.close()
+            self.f = open(path, "rb")
+            self.path = path
+            self.pos = 0
+        if offset != self.pos:
+            self.f.seek(offset)
+            self.pos = offset
+
+    def close(self):
+        if self.f:
+            self.f.close()
+        self.f = None
+        self.path = None
+
+    def read(self, nbytes):
+        """ Reads up to nbytes, at most a buffer full, and returns a view of them """
+        mv = self.mv
+        n = self.f.readinto(mv if nbytes >= len(mv) else mv[:nbytes])
+        self.pos += n
+        return mv if n == len(mv) else mv[:n]
+
+    def chunks(self, nbytes, wdt=None):
+        """ Generates views of the next nbytes, a buffer full at a time """
+        while nbytes > 0:
+            chunk = self.read(nbytes)
+            if not chunk:
+                raise Exception("File ended {} bytes early".format(nbytes))
             if wdt: wdt.feed()
-            src_child = "%s/%s" % (src_path, child)
-            dest_child = "%s/%s" % (dest_path, child)
-            copy_recursive(src_child, dest_child, block_size, wdt=wdt)
+            nbytes -= len(chunk)
+            yield chunk
 
 STAT_SIZE_INDEX = const(6)
 
 def file_size(filepath):
     return os.stat(filepath)[STAT_SIZE_INDEX]
 
-def prep_append_file(dir=".", match=('',''), size_limit=100*1024):
+def file_sha256(fpath, block_size=COPY_BLOCK_SIZE, wdt=None, buf=None):
+    """ Returns the SHA-256 of a file's contents, as a hex string """
+    import ubinascii
+    import uhashlib
+    h = uhashlib.sha256()
+    if buf is None:
+        buf = bytearray(block_size)
+    mv = memoryview(buf)
+    with open(fpath, "rb") as f:
+        while True:
+            bytes_read = f.readinto(buf)
+            if wdt: wdt.feed()
+            if not bytes_read:
+                break
+            h.update(mv[:bytes_read])
+    return str(ubinascii.hexlify(h.digest()), "ascii")
+
+def file_matches(fpath, size, sha256, block_size=COPY_BLOCK_SIZE, wdt=None, buf=None):
+    """ Checks that a file exists with the given size and SHA-256
+
+    The size is checked first, so most mismatches do not read the file.
+    With sha256=None, only the size is checked.
+    """
+    try:
+        if file_size(fpath) != size:
+            return False
+    except OSError:
+        return False
+    return sha256 is None or file_sha256(fpath, block_size, wdt=wdt, buf=buf) == sha256
+
+def prep_append_file(dir=".", match=('',''), size_limit=100*1024, index_path=None):
+    if index_path:
+        # Fast path: if the index is good, the directory must already exist
+        target = seqfile.check_append_index(index_path, dir, match, size_limit)
+        if target:
+            return "/".join([dir, target])
+        mkdirs(dirname(index_path))
+
     mkdirs(dir)
     target = seqfile.choose_append_file(dir, match, size_limit)
+    if index_path:
+        seqfile.save_append_index(index_path, dir, target)
     tpath = "/".join([dir, target])
     return tpath
@@ -0,0 +1,86 @@
+"""
+Import profiler: time and heap used by each module import
+
+Wraps builtins.__import__, which needs a firmware built with
+MICROPY_CAN_OVERRIDE_BUILTINS (the Unix port and the ESP32 ports are).
+Each first import of a module is recorded as [name, depth, us, bytes], in
+the order the imports started. Time and heap include the nested imports,
+which follow with a greater depth. The garbage collector is off while the
+profiler is installed, so bytes is everything the import allocated.
+
+From the REPL or a script:
+
+    import importprof
+    importprof.install()
+    import co2unit_main2
+    importprof.uninstall()
+    importprof.report()
+
+This module has no device dependencies.
+"""
+
+import gc
+import sys
+import utime
+
+try:
+    import builtins
+except ImportError:
+    import ubuiltins as builtins
+
+records = []
+
+_orig_import = None
+_depth = 0
+
+def _profiled_import(name, *args):
+    global _depth
+    if name in sys.modules:
+        return _orig_import(name, *args)
+
+    rec = [name, _depth, 0, 0]
+    records.append(rec)
+    _depth += 1
+    alloc = gc.mem_alloc()
+    start = utime.ticks_us()
+    try:
+        return _orig_import(name, *args)
+    finally:
+        rec[2] = utime.ticks_diff(utime.ticks_us(), start)
+        rec[3] = gc.mem_alloc() - alloc
+        _depth -= 1
+        # Built-in modules never show up in sys.modules. Not interesting.
+        if name not in sys.modules:
+            records.remove(rec)
+
+def install():
+    """ Starts recording imports, clearing earlier records """
+    global _orig_import
+    if _orig_import:
+        return
+    del records[:]
+    gc.collect()
+    gc.disable()
+    _orig_import = builtins.__import__
+    builtins.__import__ = _profiled_import
+
+def uninstall():
+    global _orig_import
+    if not _orig_import:
+        return
+    builtins.__import__ = _orig_import
+    _orig_import = None
+    gc.enable()
+
+def imported():
+    """ Names of the modules imported while installed """
+    return [rec[0] for rec in records]
+
+def report(out=None):
+    out = out or sys.stdout
+    print("{:32} {:>10} {:>10}".format("module", "ms", "bytes"), file=out)
+    for name, depth, us, nbytes in records:
+        print("{:32} {:10.1f} {:10d}".format("  " * depth + name, us / 1000, nbytes), file=out)
+    top = [rec for rec in records if rec[1] == 0]
+    print("{:32} {:10.1f} {:10d}".format("total (%d modules)" % len(records),
+        sum([rec[2] for rec in top]) / 1000, sum([rec[3] for rec in top])), file=out)
@@ -1,9 +1,16 @@
 # MicroPython reimplementation of Python's logging library
 #
-# Copied unmodified from the micropython-lib repository
-#   (no code changes, only added this header)
+# Copied from the micropython-lib repository
 #   https://github.com/micropython/micropython-lib/blob/master/logging/logging.py
 #
+# Added: handlers (Handler, Logger.addHandler, flush), for sinks besides the
+# stream, each with its own level. See co2unit_errors for one.
+#
+# Added: calls at disabled levels cost next to nothing. Each logger caches the
+# lowest level that its stream or handlers take, and its methods for lower
+# levels are a no-op function. Set levels with setLevel and basicConfig, not
+# by assigning, so the cache follows.
+#
 # Original library is MIT licensed, as noted in setup.py
 #   https://github.com/micropython/micropython-lib/blob/master/logging/setup.py
 #
@@ -27,12 +34,79 @@ _level_dict = {
 
 _stream = sys.stderr
 
+class Handler:
+    """ A sink for log records, with its own level
+
+    Gets the records of the loggers it is added to at its level or above,
+    whatever the level of the logger or the stream.
+    """
+
+    level = NOTSET
+
+    def setLevel(self, level):
+        self.level = level
+        _update_all()
+
+    def emit(self, level, name, msg, exc=None):
+        pass
+
+    def flush(self):
+        pass
+
+# Every handler added to a logger, for flush()
+_handlers = []
+
+def _noop(*args, **kwargs):
+    pass
+
+_LEVEL_METHODS = (
+    (DEBUG, "debug"),
+    (INFO, "info"),
+    (WARNING, "warning"),
+    (ERROR, "error"),
+    (CRITICAL, "critical"),
+)
+
 class Logger:
 
     level = NOTSET
+    handlers = ()
+    # Lowest level that the stream or a handler takes (see _update)
+    _min = NOTSET
 
     def __init__(self, name):
         self.name = name
+        self._update()
+
+    def _update(self):
+        """ Caches the lowest level taken and binds no-ops below it """
+        lowest = self.level or _level
+        for h in self.handlers:
+            lowest = min(lowest, h.level)
+        self._min = lowest
+        for level, name in _LEVEL_METHODS:
+            if level < lowest:
+                setattr(self, name, _noop)
+            else:
+                try:
+                    delattr(self, name)
+                except AttributeError:
+                    pass
+
+    def addHandler(self, handler):
+        if not self.handlers:
+            self.handlers = []
+        self.handlers.append(handler)
+        if handler not in _handlers:
+            _handlers.append(handler)
+        self._update()
+
+    def removeHandler(self, handler):
+        if handler in self.handlers:
+            self.handlers.remove(handler)
+        if handler in _handlers:
+            _handlers.remove(handler)
+        self._update()
 
     def _level_str(self, level):
         l = _level_dict.get(level)
@@ -42,17 +116,25 @@ class Logger:
 
     def setLevel(self, level):
         self.level = level
+        self._update()
 
     def isEnabledFor(self, level):
-        return level >= (self.level or _level)
+        return level >= self._min
 
-    def log(self, level, msg, *args):
+    def log(self, level, msg, *args, exc=None):
+        if level < self._min:
+            return
         if level >= (self.level or _level):
             _stream.write("%s:%s:" % (self._level_str(level), self.name))
             if not args:
                 print(msg, file=_stream)
             else:
                 print(msg % args, file=_stream)
+            if exc:
+                sys.print_exception(exc, _stream)
+        for h in self.handlers:
+            if level >= h.level:
+                h.emit(level, self.name, msg % args if args else msg, exc)
 
     def debug(self, msg, *args):
         self.log(DEBUG, msg, *args)
@@ -70,8 +152,7 @@ class Logger:
         self.log(CRITICAL, msg, *args)
 
     def exc(self, e, msg, *args):
-        self.log(ERROR, msg, *args)
-        sys.print_exception(e, _stream)
+        self.log(ERROR, msg, *args, exc=e)
 
     def exception(self, msg, *args):
         self.exc(sys.exc_info()[1], msg, *args)
@@ -93,9 +174,19 @@ def info(msg, *args):
 def debug(msg, *args):
     getLogger(None).debug(msg, *args)
 
+def _update_all():
+    for l in _loggers.values():
+        l._update()
+
+def flush():
+    """ Flushes every handler, e.g. before deep sleep """
+    for h in _handlers:
+        h.flush()
+
 def basicConfig(level=INFO, filename=None, stream=None, format=None):
     global _level, _stream
     _level = level
+    _update_all()
     if stream:
         _stream = stream
     if filename is not None:
@@ -38,6 +38,9 @@ class MockMachine(object):
         self._deepsleep_called = True
         self._deepsleep_time_ms = time_ms
 
+    def unique_id(self):
+        return b"\x00\x00\x00\x00\x00\x00"
+
 class MockUtime(object):
 
     def __init__(self):
@@ -77,6 +80,10 @@ class MockPycom(object):
 class MockCo2UnitHw(object):
     def __init__(self):
         self._prepare_for_shutdown_called = False
+        self._flush_sd_cache_calls = 0
 
     def prepare_for_shutdown(self):
         self._prepare_for_shutdown_called = True
+
+    def flush_sd_cache(self):
+        self._flush_sd_cache_calls += 1
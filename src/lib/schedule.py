@@ -2,10 +2,22 @@ import utime
 
 import timeutil
 
+MINUTES_PER_DAY = const(24 * 60)
+DAY_SECS = const(24 * 60 * 60)
+
+# A task whose time has passed still runs if we wake up this late. Before
+# timelines, Schedule.check() ran a task only in the minute it was due, so
+# a wake delayed past that minute (e.g. by a long Communicate) skipped it.
+DUE_GRACE_SECS = const(5 * 60)
+
+# Each rule has max_gap_secs, the longest it can go between fires (or more).
+# A saved fire further ahead than that means the clock went back.
+
 class ByMinute(object):
     def __init__(self, divisor, offset=0):
         self.divisor = divisor
         self.offset = offset
+        self.max_gap_secs = max(divisor, 60) * 60
 
     def __str__(self):
         return "ByMinute({divisor}, offset={offset})".format(**self.__dict__)
@@ -22,10 +34,19 @@ class ByMinute(object):
         next_tt = (yy, mo, dd, hh, next_minutes, 0, 0, 0)
         return timeutil.normalize(next_tt)
 
+    def next_secs(self, secs):
+        """ Like next(), in seconds since the epoch """
+        if 60 % self.divisor or self.offset >= self.divisor:
+            # Does not repeat evenly across hours
+            return timeutil.mktime(self.next(timeutil.localtime(secs)))
+        m = secs // 60
+        return (m - (m - self.offset) % self.divisor + self.divisor) * 60
+
 class ByTimeOfDay(object):
     def __init__(self, hour, minute):
         self.hour = hour
         self.minute = minute
+        self.max_gap_secs = DAY_SECS
 
     def __str__(self):
         return "ByTimeOfDay({hour:02d}:{minute:02d})".format(**self.__dict__)
@@ -43,16 +64,252 @@ class ByTimeOfDay(object):
 
         return timeutil.normalize(next_tt)
 
+    def next_secs(self, secs):
+        """ Like next(), in seconds since the epoch """
+        target = self.hour * 60 + self.minute
+        if target >= MINUTES_PER_DAY:
+            return timeutil.mktime(self.next(timeutil.localtime(secs)))
+        m = secs // 60
+        day_start = m - m % MINUTES_PER_DAY
+        if m % MINUTES_PER_DAY >= target:
+            day_start += MINUTES_PER_DAY
+        return (day_start + target) * 60
+
 class ScheduleException(Exception): pass
 
+def djb2(data):
+    """ A 24-bit djb2 hash of a str or bytes
+
+    Small enough that it never grows past a small int on the device.
+    """
+    if isinstance(data, str):
+        data = data.encode()
+    h = 5381
+    for c in data:
+        h = ((h * 33) ^ c) & 0xffffff
+    return h
+
+class SecsRule(object):
+    """ Base of rules that work in seconds: check() and next() use next_secs() """
+
+    def check(self, tt):
+        secs = timeutil.mktime(tt)
+        secs -= secs % 60
+        return self.next_secs(secs - 1) < secs + 60
+
+    def next(self, tt):
+        return timeutil.localtime(self.next_secs(timeutil.mktime(tt)))
+
+def next_in(values, v):
+    """ The first of sorted values that is v or more, or None """
+    for x in values:
+        if x >= v:
+            return x
+    return None
+
+def parse_cron_field(field, lo, hi):
+    """ Sorted values of a cron field: *, n, a-b, */s, a-b/s, n/s or a list """
+    values = []
+    for part in field.split(","):
+        span, *stepped = part.split("/", 1)
+        try:
+            step = int(stepped[0]) if stepped else 1
+            if span == "*":
+                a, b = lo, hi
+            elif "-" in span:
+                a, b = [int(v) for v in span.split("-")]
+            else:
+                a = int(span)
+                b = hi if stepped else a
+        except ValueError:
+            raise ScheduleException("Bad cron field %r" % field)
+        if a < lo or b > hi or a > b or step < 1:
+            raise ScheduleException("Cron field %r out of range %d-%d" % (field, lo, hi))
+        values.extend(range(a, b + 1, step))
+    return sorted(set(values))
+
+# Enough to get past any month or weekday a cron rule can wait for, but
+# not forever for one that never fires (February 30th)
+CRON_MAX_STEPS = const(1000)
+
+class Cron(SecsRule):
+    """ A rule like a line of crontab: "minute hour day month weekday"
+
+    Each field is *, a number, a range a-b, a step */s or a-b/s, or a comma
+    list of those. Weekdays are 0-7, Sunday being 0 or 7. As in cron, if both
+    day and weekday are restricted, a day that matches either will do.
+
+    next_secs() jumps to the next allowed month, day, hour and minute in
+    turn, rather than trying every minute.
+    """
+
+    def __init__(self, expr):
+        fields = expr.split()
+        if len(fields) != 5:
+            raise ScheduleException("Cron rule needs 5 fields: %r" % expr)
+        self.expr = expr
+        self.minutes = parse_cron_field(fields[0], 0, 59)
+        self.hours = parse_cron_field(fields[1], 0, 23)
+        self.days = parse_cron_field(fields[2], 1, 31)
+        self.months = parse_cron_field(fields[3], 1, 12)
+        self.weekdays = sorted(set([d % 7 for d in parse_cron_field(fields[4], 0, 7)]))
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+        if len(self.months) < 12 or not self.any_day:
+            # February 29th only comes every 4 (or 8) years
+            self.max_gap_secs = DATES_MAX_YEARS * 366 * DAY_SECS
+        elif not self.any_weekday:
+            self.max_gap_secs = 7 * DAY_SECS
+        elif len(self.hours) < 24:
+            self.max_gap_secs = DAY_SECS
+        else:
+            self.max_gap_secs = 60 * 60
+
+    def __str__(self):
+        return "Cron(\"{}\")".format(self.expr)
+
+    def day_matches(self, dd, days):
+        # 1970-01-01 was a Thursday, weekday 4 counting from Sunday
+        in_days = dd in self.days
+        in_weekdays = (days + 4) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return in_days and in_weekdays
+        return in_days or in_weekdays
+
+    def next_secs(self, secs):
+        """ The first fire after the minute of secs """
+        m = secs // 60 + 1
+        days, m = divmod(m, MINUTES_PER_DAY)
+        hh, mm = divmod(m, 60)
+        for _ in range(CRON_MAX_STEPS):
+            yy, mo, dd = timeutil.civil_from_days(days)
+            if mo not in self.months:
+                mo = next_in(self.months, mo + 1)
+                if mo is None:
+                    yy, mo = yy + 1, self.months[0]
+                days = timeutil.days_from_civil(yy, mo, 1)
+                hh = mm = 0
+                continue
+            if not self.day_matches(dd, days):
+                if self.any_weekday:
+                    # Jump to the next allowed day of the month
+                    next_dd = next_in(self.days, dd + 1)
+                    if next_dd is None or next_dd > timeutil.days_in_month(yy, mo):
+                        next_dd = timeutil.days_in_month(yy, mo) + 1
+                    days += next_dd - dd
+                else:
+                    days += 1
+                hh = mm = 0
+                continue
+            h = next_in(self.hours, hh)
+            if h is not None:
+                minute = next_in(self.minutes, mm) if h == hh else self.minutes[0]
+                if minute is None:
+                    h = next_in(self.hours, hh + 1)
+                    minute = self.minutes[0]
+                if h is not None:
+                    return ((days * 24 + h) * 60 + minute) * 60
+            days += 1
+            hh = mm = 0
+        raise ScheduleException("%s never fires" % self)
+
+class Jitter(SecsRule):
+    """ Fires a rule later by a fixed delay of less than window_secs
+
+    The delay is a hash of seed, e.g. the unit's hardware ID, so each unit
+    fires at its own time in the window, and always the same one.
+    """
+
+    def __init__(self, rule, window_secs, seed):
+        self.rule = rule
+        self.delay = djb2(seed) % window_secs if window_secs > 0 else 0
+        self.max_gap_secs = rule.max_gap_secs
+
+    def __str__(self):
+        return "{} + {}s".format(self.rule, self.delay)
+
+    def next_secs(self, secs):
+        """ The first fire after secs """
+        return self.rule.next_secs(secs - self.delay) + self.delay
+
+def parse_month_day(md):
+    mo, dd = [int(v) for v in md.split("-")]
+    if not (1 <= mo <= 12 and 1 <= dd <= 31):
+        raise ScheduleException("Bad date %r, expected MM-DD" % md)
+    return (mo, dd)
+
+# A rule outside its dates for this many years in a row never fires
+DATES_MAX_YEARS = const(8)
+
+class Dates(SecsRule):
+    """ Fires a rule only from one date to another every year, inclusive
+
+    Dates are "MM-DD". If the end is before the start, the range wraps over
+    new year ("11-01" to "02-28" is the winter).
+    """
+
+    def __init__(self, rule, start, end):
+        self.rule = rule
+        self.start = parse_month_day(start)
+        self.end = parse_month_day(end)
+        self.max_gap_secs = 366 * DAY_SECS + rule.max_gap_secs
+
+    def __str__(self):
+        return "{} from {:02d}-{:02d} to {:02d}-{:02d}".format(self.rule, *(self.start + self.end))
+
+    def active(self, md):
+        if self.start <= self.end:
+            return self.start <= md <= self.end
+        return md >= self.start or md <= self.end
+
+    def next_secs(self, secs):
+        for _ in range(DATES_MAX_YEARS):
+            fire = self.rule.next_secs(secs)
+            yy, mo, dd = timeutil.civil_from_days(fire // (MINUTES_PER_DAY * 60))
+            if self.active((mo, dd)):
+                return fire
+            # Skip to the next start date
+            if (mo, dd) > self.start:
+                yy += 1
+            secs = timeutil.days_from_civil(yy, *self.start) * MINUTES_PER_DAY * 60 - 1
+        raise ScheduleException("%s never fires" % self)
+
 SCHED_STRS = {
         "minutes": ByMinute,
         "daily": ByTimeOfDay,
+        "cron": Cron,
         }
 
+def make_rule(task, sched_class, args, seed=b""):
+    """ The rule of a schedule entry [task, sched_class, *args, {options}]
+
+    Options go in a dict after the args:
+
+        "jitter_mins": 30               fire up to 30 minutes late, by a
+                                        delay fixed for the unit (Jitter)
+        "dates": ["04-01", "09-30"]     fire only between these dates (Dates)
+
+    seed tells units apart for the jitter, e.g. machine.unique_id().
+    """
+    opts = {}
+    if args and isinstance(args[-1], dict):
+        opts = args[-1]
+        args = args[:-1]
+    if sched_class not in SCHED_STRS:
+        raise ScheduleException("Unknown schedule class %r for %s" % (sched_class, task))
+    for key in opts:
+        if key not in ("jitter_mins", "dates"):
+            raise ScheduleException("Unknown schedule option %r for %s" % (key, task))
+    rule = SCHED_STRS[sched_class](*args)
+    if opts.get("jitter_mins"):
+        rule = Jitter(rule, opts["jitter_mins"] * 60, seed + task.encode())
+    if opts.get("dates"):
+        rule = Dates(rule, *opts["dates"])
+    return rule
+
 class Schedule(object):
-    def __init__(self, sched):
-        self.sched = [[task, SCHED_STRS[sched_class](*args)]
+    def __init__(self, sched, seed=b""):
+        self.sched = [[task, make_rule(task, sched_class, args, seed)]
                 for task, sched_class, *args in sched]
 
     def check(self, tt):
@@ -63,3 +320,141 @@ class Schedule(object):
                     for task, task_sched in self.sched]
         agenda.sort()
         return agenda
+
+def validate(sched, secs, tasks=None, required=()):
+    """ Raises ScheduleException if a schedule config would not work
+
+    Each entry must be a list [task, sched_class, *args] whose rule builds and
+    fires after secs. If tasks is given, the task must be one of them. Each
+    task in required must have at least one entry.
+    """
+    if not isinstance(sched, list) or not sched:
+        raise ScheduleException("Schedule must be a non-empty list, not %r" % (sched,))
+    for entry in sched:
+        if not isinstance(entry, list) or len(entry) < 2 or not isinstance(entry[0], str):
+            raise ScheduleException("Bad schedule entry %r" % (entry,))
+        if tasks is not None and entry[0] not in tasks:
+            raise ScheduleException("Unknown task in schedule entry %r" % (entry,))
+        try:
+            rule = make_rule(entry[0], entry[1], entry[2:])
+            rule.next_secs(secs)
+        except (TypeError, ValueError) as e:
+            raise ScheduleException("Bad schedule entry %r: %s" % (entry, e))
+    for task in required:
+        if task not in [entry[0] for entry in sched]:
+            raise ScheduleException("Schedule has no %s entry" % task)
+
+# Schedule entries packed into an int each, small enough to save in NVS:
+# task (2 bits), sched class (1 bit), two args and jitter_mins (9 bits each)
+PACK_CLASSES = ("minutes", "daily")
+
+def pack_entry(entry, tasks):
+    """ The entry as an int, or None if it does not fit
+
+    Only "minutes" and "daily" entries with two args under 512, and no
+    options but a jitter_mins under 512, fit. tasks is a tuple of task
+    names, one of the first four of which must be the entry's.
+    """
+    task, sched_class, *args = entry
+    jitter = 0
+    if args and isinstance(args[-1], dict):
+        opts = args[-1]
+        args = args[:-1]
+        if list(opts) != ["jitter_mins"]:
+            return None
+        jitter = opts["jitter_mins"]
+        if not isinstance(jitter, int) or not 0 < jitter < 512:
+            return None
+    if task not in tasks[0:4] or sched_class not in PACK_CLASSES or len(args) != 2:
+        return None
+    for v in args:
+        if not isinstance(v, int) or not 0 <= v < 512:
+            return None
+    code = tasks.index(task) << 1 | PACK_CLASSES.index(sched_class)
+    return ((code << 9 | args[0]) << 9 | args[1]) << 9 | jitter
+
+def unpack_entry(code, tasks):
+    """ The entry that pack_entry packed into code """
+    jitter = code & 0x1ff
+    b = (code >> 9) & 0x1ff
+    a = (code >> 18) & 0x1ff
+    code >>= 27
+    entry = [tasks[code >> 1], PACK_CLASSES[code & 1], a, b]
+    if jitter:
+        entry.append({"jitter_mins": jitter})
+    return entry
+
+def signature(sched):
+    """ A 24-bit hash of a schedule config (djb2 of its repr) """
+    return djb2(repr(sched))
+
+class Timeline(object):
+    """ A schedule compiled to a sorted table of [fire secs, rule index]
+
+    Each rule is in the table once, with the time it fires next, so the
+    first entry is always the next thing to do. Moving past a time only
+    pops the entries due by then and pushes their rules' next fire times,
+    with integer arithmetic instead of time tuples.
+
+    fires are the fire times of each rule from a saved timeline, and sig
+    the signature of the schedule they were saved for. Those are used as
+    they are, without working out any rule's next fire. Any that are
+    missing, for another schedule, or more than the rule's max_gap_secs
+    ahead (the clock went back) are compiled again. The rule indexes in
+    dirty have changed since. seed is for rules with jitter (see make_rule).
+    """
+
+    def __init__(self, sched, secs, fires=None, sig=None, seed=b""):
+        self.sig = signature(sched)
+        self.sched = Schedule(sched, seed).sched
+        self.fires = []
+        self.dirty = []
+        if sig != self.sig or not fires or len(fires) != len(self.sched):
+            fires = [None] * len(self.sched)
+        for i, (task, rule) in enumerate(self.sched):
+            fire = fires[i]
+            if fire is None or fire > secs + rule.max_gap_secs:
+                # First fire at or after the start of this minute
+                fire = rule.next_secs(secs - 60)
+                self.dirty.append(i)
+            self.fires.append([fire, i])
+        self.fires.sort()
+
+    def rule_fires(self):
+        """ Fire times by rule index, as given to __init__ """
+        fires = [None] * len(self.sched)
+        for fire, i in self.fires:
+            fires[i] = fire
+        return fires
+
+    def due(self, secs):
+        """ Tasks due at secs, at most DUE_GRACE_SECS late, in firing order
+
+        A task more than DUE_GRACE_SECS late is skipped until its next fire.
+        """
+        tasks = []
+        for fire, i in self.fires:
+            if fire > secs:
+                break
+            if secs - fire <= DUE_GRACE_SECS:
+                tasks.append(self.sched[i][0])
+        return tasks
+
+    def advance(self, secs):
+        """ Pops the entries up to secs, returning the tasks that were due """
+        tasks = self.due(secs)
+        fires = self.fires
+        while fires and fires[0][0] <= secs:
+            i = fires.pop(0)[1]
+            entry = [self.sched[i][1].next_secs(secs), i]
+            j = len(fires)
+            while j > 0 and fires[j-1] > entry:
+                j -= 1
+            fires.insert(j, entry)
+            if i not in self.dirty:
+                self.dirty.append(i)
+        return tasks
+
+    def agenda(self):
+        """ [fire secs, task] of each rule, soonest first """
+        return [[fire, self.sched[i][0]] for fire, i in self.fires]
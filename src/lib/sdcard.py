@@ -1,9 +1,21 @@
 # Driver for SD card access over SPI
 #
-# Copied unmodified from the pycom-micropython-sigfox repository
-#   (no code changes, only added this header)
+# Copied from the pycom-micropython-sigfox repository
 #   https://github.com/pycom/pycom-micropython-sigfox/blob/master/drivers/sdcard/sdcard.py
 #
+# Modified here:
+#   - Polling for responses and busy waits reads into tokenbuf instead of
+#     allocating a bytes object per byte polled (write, write_token).
+#   - After init, the SPI clock steps up through a configurable ramp of
+#     baudrates, no higher than the rate in the card's CSD (TRAN_SPEED).
+#     Each step re-reads the CSD and checks its CRC7.
+#   - writeblocks keeps a CMD25 multiple-block write open, so that writes
+#     to adjacent blocks in separate calls go out as one run. The run ends
+#     with a stop token on any other command, or on sync (ioctl or sync()).
+#   - ioctl and sync methods for the block device protocol.
+#   - Sector count of CSD version 2.0 cards: 1024 sectors per C_SIZE unit
+#     (the original multiplied by 2014).
+#
 # Although this file is present in the Pycom firmware sources, it is not
 # available for import in the firmware on the FiPy. So, we have to put a copy
 # in lib/
@@ -53,11 +65,45 @@ _TOKEN_CMD25 = const(0xfc)
 _TOKEN_STOP_TRAN = const(0xfd)
 _TOKEN_DATA = const(0xfe)
 
+# SPI clock for identification, and then the steps up after init. Each step
+# is checked by reading the CSD again before going on to the next.
+INIT_BAUDRATE = const(100000)
+RAMP_BAUDRATES = (1320000, 5000000, 10000000)
+
+# TRAN_SPEED in the CSD: rate unit (100 kbit/s to 100 Mbit/s), and a time
+# value from 1.0 to 8.0 that multiplies it, in tenths
+_TRAN_UNITS = (100000, 1000000, 10000000, 100000000)
+_TRAN_VALUES = (0, 10, 12, 13, 15, 20, 25, 30, 35, 40, 45, 50, 55, 60, 70, 80)
+
+def crc7(data):
+    """ CRC7 of SD commands and registers, as in the last byte >> 1 """
+    crc = 0
+    for byte in data:
+        for bit in range(8):
+            crc <<= 1
+            if ((byte << bit) ^ crc) & 0x80:
+                crc ^= 0x09
+        crc &= 0x7f
+    return crc
+
+def tran_speed(byte):
+    """ Maximum data rate in bit/s from the TRAN_SPEED byte of a CSD, or 0 """
+    unit = byte & 0x7
+    if unit >= len(_TRAN_UNITS):
+        return 0
+    return _TRAN_UNITS[unit] // 10 * _TRAN_VALUES[(byte >> 3) & 0xf]
+
 
 class SDCard:
-    def __init__(self, spi, cs):
+    def __init__(self, spi, cs, ramp=RAMP_BAUDRATES):
         self.spi = spi
         self.cs = cs
+        self.ramp = ramp
+        self.baudrate = 0
+        self.rated_baudrate = 0
+        self.csd = None
+        # Block after the last written in the open CMD25 run, or -1 if none
+        self.run_next = -1
 
         self.cmdbuf = bytearray(6)
         self.dummybuf = bytearray(512)
@@ -70,6 +116,7 @@ class SDCard:
         self.init_card()
 
     def init_spi(self, baudrate):
+        self.baudrate = baudrate
         try:
             master = self.spi.MASTER
         except AttributeError:
@@ -84,7 +131,8 @@ class SDCard:
         self.cs.init(self.cs.OUT, value=1)
 
         # init SPI bus; use low data rate for initialisation
-        self.init_spi(100000)
+        self.init_spi(INIT_BAUDRATE)
+        self.run_next = -1
 
         # clock card at least 100 cycles with cs high
         for i in range(16):
@@ -107,13 +155,13 @@ class SDCard:
             raise OSError("couldn't determine SD card version")
 
         # get the number of sectors
-        # CMD9: response R2 (R1 byte + 16-byte block read)
-        if self.cmd(9, 0, 0, 0, False) != 0:
+        csd = self.read_csd()
+        if csd is None:
             raise OSError("no response from SD card")
-        csd = bytearray(16)
-        self.readinto(csd)
+        self.csd = csd
+        self.rated_baudrate = tran_speed(csd[3])
         if csd[0] & 0xc0 == 0x40: # CSD version 2.0
-            self.sectors = ((csd[8] << 8 | csd[9]) + 1) * 2014
+            self.sectors = ((csd[8] << 8 | csd[9]) + 1) * 1024
         elif csd[0] & 0xc0 == 0x00: # CSD version 1.0 (old, <=2GB)
             c_size = csd[6] & 0b11 | csd[7] << 2 | (csd[8] & 0b11000000) << 4
             c_size_mult = ((csd[9] & 0b11) << 1) | csd[10] >> 7
@@ -127,7 +175,35 @@ class SDCard:
             raise OSError("can't set 512 block size")
 
         # set to high data rate now that it's initialised
-        self.init_spi(1320000)
+        self.ramp_up()
+
+    def read_csd(self):
+        """ The 16-byte CSD register, or None if the card does not answer """
+        # CMD9: response R2 (R1 byte + 16-byte block read)
+        if self.cmd(9, 0, 0, 0, False) != 0:
+            self.cs(1)
+            return None
+        csd = bytearray(16)
+        self.readinto(csd)
+        return csd
+
+    def ramp_up(self):
+        """ Steps the SPI clock up the ramp, up to the card's rated speed
+
+        Stays at the last rate at which a CSD read came back intact: the same
+        as read at init, and with a good CRC7. A CMD13 alone can pass at a
+        rate too high to carry data.
+        """
+        good = self.baudrate
+        for baudrate in self.ramp:
+            if self.rated_baudrate and baudrate > self.rated_baudrate:
+                break
+            self.init_spi(baudrate)
+            csd = self.read_csd()
+            if csd != self.csd or crc7(csd[:15]) != csd[15] >> 1:
+                self.init_spi(good)
+                break
+            good = baudrate
 
     def init_card_v1(self):
         for i in range(_CMD_TIMEOUT):
@@ -156,10 +232,10 @@ class SDCard:
         # create and send the command
         buf = self.cmdbuf
         buf[0] = 0x40 | cmd
-        buf[1] = arg >> 24
-        buf[2] = arg >> 16
-        buf[3] = arg >> 8
-        buf[4] = arg
+        buf[1] = arg >> 24 & 0xff
+        buf[2] = arg >> 16 & 0xff
+        buf[3] = arg >> 8 & 0xff
+        buf[4] = arg & 0xff
         buf[5] = crc
         self.spi.write(buf)
 
@@ -206,45 +282,71 @@ class SDCard:
         self.cs(1)
         self.spi.write(b'\xff')
 
+    def wait_ready(self):
+        # the card holds the line low while busy
+        tokenbuf = self.tokenbuf
+        while True:
+            self.spi.readinto(tokenbuf, 0xff)
+            if tokenbuf[0] != 0:
+                return
+
     def write(self, token, buf):
         self.cs(0)
 
         # send: start of block, data, checksum
-        self.spi.read(1, token)
+        self.spi.readinto(self.tokenbuf, token)
         self.spi.write(buf)
         self.spi.write(b'\xff')
         self.spi.write(b'\xff')
 
         # check the response
-        if (self.spi.read(1, 0xff)[0] & 0x1f) != 0x05:
+        self.spi.readinto(self.tokenbuf, 0xff)
+        if (self.tokenbuf[0] & 0x1f) != 0x05:
             self.cs(1)
             self.spi.write(b'\xff')
             return
 
         # wait for write to finish
-        while self.spi.read(1, 0xff)[0] == 0:
-            pass
+        self.wait_ready()
 
         self.cs(1)
         self.spi.write(b'\xff')
 
     def write_token(self, token):
         self.cs(0)
-        self.spi.read(1, token)
+        self.spi.readinto(self.tokenbuf, token)
         self.spi.write(b'\xff')
         # wait for write to finish
-        while self.spi.read(1, 0xff)[0] == 0x00:
-            pass
+        self.wait_ready()
 
         self.cs(1)
         self.spi.write(b'\xff')
 
+    def end_run(self):
+        """ Ends the open CMD25 run, if any, with a stop token """
+        if self.run_next >= 0:
+            self.run_next = -1
+            self.write_token(_TOKEN_STOP_TRAN)
+
+    def sync(self):
+        self.end_run()
+
+    def ioctl(self, op, arg):
+        if op == 3: # sync
+            self.end_run()
+        elif op == 4: # number of blocks
+            return self.sectors
+        elif op == 5: # block size
+            return 512
+        return 0
+
     def count(self):
         return self.sectors
 
     def readblocks(self, block_num, buf):
         nblocks = len(buf) // 512
         assert nblocks and not len(buf) % 512, 'Buffer length is invalid'
+        self.end_run()
         if nblocks == 1:
             # CMD17: set read address for single block
             if self.cmd(17, block_num * self.cdv, 0) != 0:
@@ -267,22 +369,20 @@ class SDCard:
     def writeblocks(self, block_num, buf):
         nblocks, err = divmod(len(buf), 512)
         assert nblocks and not err, 'Buffer length is invalid'
-        if nblocks == 1:
-            # CMD24: set write address for single block
-            if self.cmd(24, block_num * self.cdv, 0) != 0:
-                raise OSError(5) # EIO
-
-            # send the data
-            self.write(_TOKEN_DATA, buf)
-        else:
+        if block_num != self.run_next:
+            # not adjacent to the open run: end it and start another
+            self.end_run()
             # CMD25: set write address for first block
             if self.cmd(25, block_num * self.cdv, 0) != 0:
                 raise OSError(5) # EIO
-            # send the data
-            offset = 0
-            mv = memoryview(buf)
-            while nblocks:
-                self.write(_TOKEN_CMD25, mv[offset : offset + 512])
-                offset += 512
-                nblocks -= 1
-            self.write_token(_TOKEN_STOP_TRAN)
+        self.run_next = block_num + nblocks
+        # send the data
+        if nblocks == 1:
+            self.write(_TOKEN_CMD25, buf)
+            return
+        offset = 0
+        mv = memoryview(buf)
+        while nblocks:
+            self.write(_TOKEN_CMD25, mv[offset : offset + 512])
+            offset += 512
+            nblocks -= 1
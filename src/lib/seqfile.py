@@ -1,3 +1,4 @@
+import json
 import logging
 import os
 
@@ -68,3 +69,97 @@ def choose_append_file(dir=".", match=('',''), size_limit=100*1024):
             _logger.info("%s : beginning new file. %s was over size threshold (%d / %d bytes)", target, prev, size, size_limit)
 
     return target
+
+# Append index
+# --------------------------------------------------
+#
+# Listing and sorting a directory with years of sequence files is slow on the
+# SD card. The append index remembers the current target file of a directory,
+# so that choosing the target usually takes only a couple of stat calls.
+#
+# The index is only a cache. If it looks wrong in any way, we fall back to a
+# full directory scan, which rewrites the index. It holds no size: appends do
+# not update it, so the target is stat'ed each time instead.
+#
+# The index can also carry a tag for what the target file holds (e.g. the
+# header of a binary file). Writers that pass a tag only get the target from
+# the index if the tag matches.
+
+def _load_append_index(index_path):
+    try:
+        with open(index_path) as f:
+            index = json.load(f)
+        idir, target = index[0:2]
+        return idir, target, (index[2] if len(index) > 2 else None)
+    except Exception as e:
+        _logger.debug("%s : could not read append index. %s: %s", index_path, type(e).__name__, e)
+        return None
+
+def read_append_index(index_path):
+    index = _load_append_index(index_path)
+    return index[0:2] if index else None
+
+def save_append_index(index_path, dir, target, tag=None):
+    try:
+        index = [dir, target]
+        if tag is not None:
+            index.append(tag)
+        with open(index_path, "w") as f:
+            f.write(json.dumps(index))
+        _logger.debug("%s : saved append index %s/%s", index_path, dir, target)
+    except Exception as e:
+        _logger.warning("%s : could not save append index. %s: %s", index_path, type(e).__name__, e)
+
+def _stat_size(path):
+    try:
+        return os.stat(path)[ST_SIZE_INDEX]
+    except OSError:
+        return None
+
+def check_append_index(index_path, dir=".", match=('',''), size_limit=100*1024, tag=None):
+    """ Chooses the append target from the index, without listing the directory
+
+    Returns None if the index is missing or does not agree with the filesystem,
+    or if tag is given and the index does not carry the same one.
+    """
+    index = _load_append_index(index_path)
+    if not index:
+        return None
+
+    idir, target, itag = index
+    if tag is not None and itag != tag:
+        _logger.info("%s : append index tag differs (%s). Not using it", index_path, itag)
+        return None
+    prefix, suffix = match
+    if idir != dir or not target.startswith(prefix) or not target.endswith(suffix):
+        _logger.info("%s : append index does not match %s/%s0000%s. Rescanning", index_path, dir, prefix, suffix)
+        return None
+
+    try:
+        index_num = extract_sequence_number(target, match)
+        next_target = next_sequence_filename(target, match)
+    except Exception:
+        _logger.info("%s : append index target %s is not a sequence file. Rescanning", index_path, target)
+        return None
+
+    # A newer file in the sequence means someone else has written here
+    if _stat_size("/".join([dir, next_target])) != None:
+        _logger.info("%s : %s exists, append index is stale. Rescanning", index_path, next_target)
+        return None
+
+    size = _stat_size("/".join([dir, target]))
+    if size == None:
+        # Fresh file that has not been written yet, right after the one
+        # before it rolled over. If that one is gone too, it has disappeared.
+        if index_num and _stat_size("/".join([dir, make_sequence_filename(index_num - 1, match)])) == None:
+            _logger.info("%s : %s has disappeared. Rescanning", index_path, target)
+            return None
+        size = 0
+
+    if size < size_limit:
+        _logger.debug("%s : using current target file (from index)", target)
+        return target
+
+    _logger.info("%s : beginning new file. %s was over size threshold (%d / %d bytes)", next_target, target, size, size_limit)
+    save_append_index(index_path, dir, next_target, tag)
+    return next_target
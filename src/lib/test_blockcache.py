@@ -0,0 +1,116 @@
+import unittest
+import logging
+
+import blockcache
+
+# Suppress logging
+logging.getLogger("blockcache").setLevel(logging.CRITICAL)
+
+class RamBlockDev(object):
+    """ Block device in RAM, logging the blocks read and written """
+
+    def __init__(self, nblocks):
+        self.data = bytearray(nblocks * 512)
+        self.nblocks = nblocks
+        self.reads = []
+        self.writes = []
+        self.syncs = 0
+        self.deinits = 0
+
+    def readblocks(self, block_num, buf):
+        n = len(buf) // 512
+        buf[:] = self.data[block_num*512:(block_num+n)*512]
+        self.reads.extend(range(block_num, block_num + n))
+
+    def writeblocks(self, block_num, buf):
+        n = len(buf) // 512
+        self.data[block_num*512:(block_num+n)*512] = buf
+        self.writes.extend(range(block_num, block_num + n))
+
+    def ioctl(self, op, arg):
+        if op == 2:
+            self.deinits += 1
+        if op == 3:
+            self.syncs += 1
+        if op == 4:
+            return self.nblocks
+        if op == 5:
+            return 512
+        return 0
+
+def block(value, n=1):
+    return bytearray([value]) * (512 * n)
+
+class TestBlockCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dev = RamBlockDev(64)
+        self.cache = blockcache.BlockCache(self.dev, slots=4)
+
+    def read(self, block_num, n=1):
+        buf = bytearray(512 * n)
+        self.cache.readblocks(block_num, buf)
+        return buf
+
+    def test_read_hits(self):
+        self.dev.data[512:1024] = block(7)
+        self.assertEqual(self.read(1), block(7))
+        self.assertEqual(self.read(1), block(7))
+        self.assertEqual(self.dev.reads, [1])
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_rewrites_go_back_once(self):
+        # Like appends to a file: FAT block, directory block, data block
+        for i in range(10):
+            self.cache.writeblocks(1, block(i))
+            self.cache.writeblocks(5, block(i))
+            self.cache.writeblocks(20, block(i))
+            self.cache.ioctl(3, 0)
+        self.assertEqual(self.dev.writes, [])
+        self.assertEqual(self.read(5), block(9))
+        self.cache.flush()
+        self.assertEqual(self.dev.writes, [1, 5, 20])
+        self.assertEqual(self.dev.data[5*512:6*512], block(9))
+        self.assertEqual(self.dev.syncs, 1)
+        # Clean now, nothing more to write
+        self.cache.flush()
+        self.assertEqual(self.dev.writes, [1, 5, 20])
+
+    def test_lru_eviction(self):
+        for b in [1, 2, 3, 4]:
+            self.cache.writeblocks(b, block(b))
+        self.read(1)
+        # Evicts 2, the least recently used, writing it back
+        self.cache.writeblocks(10, block(10))
+        self.assertEqual(self.dev.writes, [2])
+        self.assertEqual(self.read(2), block(2))
+        self.assertEqual(self.dev.reads, [2])
+        # ... which evicted 3
+        self.assertEqual(self.dev.writes, [2, 3])
+        self.assertEqual(self.cache.writebacks, 2)
+
+    def test_multiblock_bypass(self):
+        self.cache.writeblocks(11, block(1))
+        # Reads see the newer cached block over the device's copy
+        self.assertEqual(self.read(10, 3), block(0) + block(1) + block(0))
+        self.assertEqual(self.dev.reads, [10, 11, 12])
+        # Writes go to the device, and update the cached copy
+        self.cache.writeblocks(10, block(2, 3))
+        self.assertEqual(self.dev.writes, [10, 11, 12])
+        self.assertEqual(self.read(11), block(2))
+        self.cache.flush()
+        self.assertEqual(self.dev.writes, [10, 11, 12])
+
+    def test_flush_on_sync(self):
+        cache = blockcache.BlockCache(self.dev, slots=4, flush_on_sync=True)
+        cache.writeblocks(3, block(3))
+        cache.ioctl(3, 0)
+        self.assertEqual(self.dev.writes, [3])
+
+    def test_ioctl(self):
+        self.assertEqual(self.cache.ioctl(4, 0), 64)
+        self.assertEqual(self.cache.ioctl(5, 0), 512)
+        self.cache.writeblocks(3, block(3))
+        self.cache.ioctl(2, 0)
+        self.assertEqual(self.dev.writes, [3])
+        self.assertEqual(self.dev.deinits, 1)
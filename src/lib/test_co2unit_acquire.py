@@ -0,0 +1,153 @@
+import unittest
+import logging
+
+import configutil
+import co2unit_acquire
+
+# Suppress logging
+logging.getLogger("co2unit_acquire").setLevel(logging.CRITICAL)
+
+class VirtualClock(object):
+    """ Clock that only moves when someone sleeps """
+
+    def __init__(self):
+        self.ms = 0
+        self.sleeps = []
+
+    def ticks_ms(self):
+        return self.ms
+
+    def ticks_diff(self, a, b):
+        return a - b
+
+    def sleep_ms(self, ms):
+        self.sleeps.append(ms)
+        self.ms += ms
+
+class FakeEtemp(object):
+    def __init__(self, clock, ready_ms, value=21.5):
+        self.clock = clock
+        self.ready_ms = ready_ms
+        self.value = value
+        self.polls = 0
+
+    def start_conversion(self):
+        self.started = self.clock.ms
+
+    def read_temp_async(self):
+        self.polls += 1
+        if self.clock.ms - self.started < self.ready_ms:
+            return None
+        return self.value
+
+class FakeCo2(object):
+    def __init__(self, clock, trace):
+        self.clock = clock
+        self.trace = list(trace)
+        self.read_times = []
+
+    def set_mode(self, mode):
+        self.mode = mode
+
+    def read_co2(self):
+        self.read_times.append(self.clock.ms)
+        val = self.trace.pop(0)
+        if val is None:
+            raise Exception("No response")
+        return val
+
+    def select_fields(self, fields):
+        self.fields = fields
+
+    def read_fields(self):
+        return {f: 1 for f in self.fields}
+
+class FakeHw(object):
+    pass
+
+def config(**kwargs):
+    mc = {
+        "co2_mode": "fixed",
+        "co2_max_reads": 10,
+        "co2_read_interval_ms": 500,
+        "co2_settle_count": 3,
+        "co2_settle_ppm": 20,
+        }
+    mc.update(kwargs)
+    return configutil.Namespace(**mc)
+
+CO2_TRACE = [0, 200010, 452, 455, 450, 451, 449, 450, 452, 450]
+
+class TestAcquire(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = VirtualClock()
+        self.hw = FakeHw()
+        self.hw.etemp = FakeEtemp(self.clock, ready_ms=600)
+        self.hw.co2 = FakeCo2(self.clock, CO2_TRACE)
+
+    def run_acquire(self, mc):
+        trace = co2unit_acquire.Trace(self.clock)
+        result = {}
+        readings = [None] * 10
+        co2unit_acquire.run_tasks([
+            co2unit_acquire.etemp_task(self.hw, result, trace),
+            co2unit_acquire.co2_task(self.hw, readings, ["Z", "h"], mc, result, trace),
+            ], trace)
+        return trace, result, readings
+
+    def phase(self, trace, name):
+        for p in trace.phases:
+            if p[0] == name:
+                return p[1:]
+        return None
+
+    def test_fixed(self):
+        trace, result, readings = self.run_acquire(config())
+        self.assertEqual(readings, CO2_TRACE)
+        self.assertEqual(result["co2_samples"], 10)
+        self.assertEqual(result["etemp"], 21.5)
+        self.assertEqual(result["co2_raws"], {"Z": 1, "h": 1})
+        # Reads are on schedule, after the boot delay
+        self.assertEqual(self.hw.co2.read_times, [200 + 500 * i for i in range(10)])
+        # Temperature conversion ran alongside, not after
+        self.assertEqual(self.phase(trace, "etemp conv"), (0, 750))
+        self.assertEqual(self.phase(trace, "co2 reads"), (200, 4700))
+        self.assertEqual(self.clock.ms, 4700)
+
+    def test_adaptive_is_shorter(self):
+        trace, result, readings = self.run_acquire(config(co2_mode="adaptive"))
+        self.assertEqual(result["co2_samples"], 5)
+        self.assertEqual(readings[5:], [None] * 5)
+        # 4700 ms in fixed mode
+        self.assertEqual(self.clock.ms, 2200)
+        self.assertEqual(result["etemp"], 21.5)
+
+    def test_no_busy_wait(self):
+        self.run_acquire(config())
+        # Sleeps only between deadlines, never in tiny steps
+        self.assertTrue(min(self.clock.sleeps) >= co2unit_acquire.ETEMP_POLL_MS)
+        self.assertTrue(self.hw.etemp.polls <= 2)
+
+    def test_etemp_timeout(self):
+        self.hw.etemp = FakeEtemp(self.clock, ready_ms=5000)
+        trace, result, readings = self.run_acquire(config())
+        self.assertEqual(result["etemp"], None)
+        self.assertEqual(result["co2_samples"], 10)
+        self.assertTrue(self.phase(trace, "etemp read")[1] <= co2unit_acquire.ETEMP_TIMEOUT_MS + co2unit_acquire.ETEMP_POLL_MS)
+
+    def test_sensor_errors(self):
+        del self.hw.etemp
+        self.hw.co2 = FakeCo2(self.clock, [None, 450, 450, 450, 450, 450, 450, 450, 450, 450])
+        trace, result, readings = self.run_acquire(config(co2_mode="adaptive"))
+        self.assertEqual(result["etemp"], None)
+        self.assertEqual(readings[:4], [None, 450, 450, 450])
+        self.assertEqual(result["co2_samples"], 4)
+
+    def test_no_co2_sensor(self):
+        del self.hw.co2
+        trace, result, readings = self.run_acquire(config())
+        self.assertEqual(readings, [None] * 10)
+        self.assertEqual((result["co2_samples"], result["co2_ms"]), (0, None))
+        self.assertEqual(result["co2_raws"], {"Z": None, "h": None})
+        self.assertEqual(result["etemp"], 21.5)
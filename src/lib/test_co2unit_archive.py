@@ -0,0 +1,251 @@
+import os
+
+import unittest
+import logging
+
+import co2unit_archive
+import fileutil
+import timeutil
+
+# Suppress logging
+logging.getLogger("co2unit_archive").setLevel(logging.CRITICAL)
+logging.getLogger("configutil").setLevel(logging.CRITICAL)
+logging.getLogger("fileutil").setLevel(logging.CRITICAL)
+
+TEST_DIR = "test_tmp_archive"
+READINGS_DIR = TEST_DIR + "/data/readings"
+ARCHIVE_DIR = TEST_DIR + "/data/archive"
+STATE_PATH = TEST_DIR + "/var/compact-state.json"
+
+def row(date, time, etemp, co2s, site_code="varanger-03"):
+    fields = ["co2unit-30aea42a50bc", site_code, date, time, etemp, 1] + co2s + [400, 31000, 29000, 150, 2310]
+    return "\t".join([str(v) for v in fields]) + "\n"
+
+def write_readings(fname, rows):
+    with open(READINGS_DIR + "/" + fname, "wt") as f:
+        for r in rows:
+            f.write(r)
+
+def ts(date, time="00:00:00"):
+    return timeutil.mktime(timeutil.parse_time(date + " " + time))
+
+class TestSegments(unittest.TestCase):
+
+    def setUp(self):
+        fileutil.rm_recursive(TEST_DIR)
+        fileutil.mkdirs(TEST_DIR)
+
+    def tearDown(self):
+        fileutil.rm_recursive(TEST_DIR)
+
+    def test_parse_row(self):
+        hw_id, site_code, month, record = co2unit_archive.parse_row(row("2019-07-31", "13:00:10", 23.4375, [680, 700]))
+        self.assertEqual((hw_id, site_code, month), ("co2unit-30aea42a50bc", "varanger-03", "2019-07"))
+        self.assertEqual(record, (ts("2019-07-31", "13:00:10"), 23.4375, 1, [680, 700], [400, 31000, 29000, 150, 2310]))
+        # Missing values, and a line cut short
+        record = co2unit_archive.parse_row(row("2019-07-31", "13:00:10", None, [680, None]))[3]
+        self.assertEqual((record[1], record[3]), (None, [680, -1]))
+        self.assertEqual(co2unit_archive.parse_row("co2unit-30aea42a50bc\tvaranger-03\t2019-07"), None)
+
+    def test_roundtrip_and_index(self):
+        rows = [co2unit_archive.parse_row(r)[3] for r in [
+            row("2019-07-31", "13:00:10", 23.5, [680, 700]),
+            row("2019-07-31", "13:30:10", None, [690]),
+            row("2019-07-31", "14:00:10", 24.5, [None, None, 710]),
+            ]]
+        path = TEST_DIR + "/a.col"
+        with open(path, "wb") as f:
+            f.write(co2unit_archive.pack_segment("readings-0000.tsv", "hw", "site", rows))
+            f.write(co2unit_archive.pack_segment("readings-0001.tsv", "hw", "site", rows[0:1]))
+
+        with open(path, "rb") as f:
+            segs = list(co2unit_archive.segments(f))
+            self.assertEqual([s["source"] for s in segs], ["readings-0000.tsv", "readings-0001.tsv"])
+            seg = segs[0]
+            self.assertEqual((seg["rows"], seg["n_co2"], seg["n_raws"]), (3, 3, 5))
+            self.assertEqual((seg["ts_first"], seg["ts_last"]), (rows[0][0], rows[2][0]))
+            self.assertEqual(seg["index"]["etemp"], (23.5, 24.5, 24.0, 2))
+            # Row means 690, 690 and 710
+            vmin, vmax, mean, count = seg["index"]["co2"]
+            self.assertEqual((vmin, vmax, count), (690.0, 710.0, 3))
+            self.assertTrue(abs(mean - 696.667) < 0.001)
+            self.assertEqual(seg["index"]["co2_1"], (700.0, 700.0, 700.0, 1))
+            self.assertEqual(co2unit_archive.read_column(f, seg, "ts"), [r[0] for r in rows])
+            self.assertEqual(co2unit_archive.read_column(f, seg, "etemp"), [23.5, None, 24.5])
+            self.assertEqual(co2unit_archive.read_column(f, seg, "co2_2"), [None, None, 710])
+            self.assertEqual(co2unit_archive.read_column(f, seg, "raw_4"), [2310, 2310, 2310])
+
+    def test_cut_short(self):
+        rows = [co2unit_archive.parse_row(row("2019-07-31", "13:00:10", 23.5, [680]))[3]]
+        data = co2unit_archive.pack_segment("readings-0000.tsv", "hw", "site", rows)
+        path = TEST_DIR + "/a.col"
+        # Columns cut short, then the header itself
+        for size in [len(data) - 1, 20]:
+            with open(path, "wb") as f:
+                f.write(data + data[0:size])
+            with open(path, "rb") as f:
+                with self.assertRaises(co2unit_archive.ArchiveFormatError):
+                    list(co2unit_archive.segments(f))
+            self.assertEqual(co2unit_archive.archived(path), ({("readings-0000.tsv", "hw", "site"): 1}, len(data)))
+
+class TestCompact(unittest.TestCase):
+
+    def setUp(self):
+        fileutil.rm_recursive(TEST_DIR)
+        fileutil.mkdirs(READINGS_DIR)
+        # Two files across a month boundary, and the open one
+        write_readings("readings-0000.tsv", [
+            row("2019-07-31", "23:00:10", 20.0, [600]),
+            row("2019-07-31", "23:30:10", 21.0, [700]),
+            ])
+        write_readings("readings-0001.tsv", [
+            row("2019-08-01", "00:00:10", 22.0, [800]),
+            row("2019-08-01", "00:30:10", 23.0, [900, 1000]),
+            ])
+        write_readings("readings-0002.tsv", [
+            row("2019-08-01", "01:00:10", 30.0, [1200]),
+            ])
+
+    def tearDown(self):
+        fileutil.rm_recursive(TEST_DIR)
+
+    def compact(self, acked=None, max_files=4):
+        return co2unit_archive.compact(READINGS_DIR, ARCHIVE_DIR, STATE_PATH, acked, max_files)
+
+    def test_compact_closed_files(self):
+        self.assertEqual(self.compact(max_files=1), (["readings-0000.tsv"], []))
+        self.assertEqual(self.compact(), (["readings-0001.tsv"], []))
+        self.assertEqual(self.compact(), ([], []))
+        self.assertEqual(sorted(os.listdir(ARCHIVE_DIR)), ["readings-2019-07.col", "readings-2019-08.col"])
+        # Nothing acknowledged yet, so all are kept
+        self.assertEqual(len(os.listdir(READINGS_DIR)), 3)
+        self.assertEqual(co2unit_archive.uncompacted(READINGS_DIR, STATE_PATH), [READINGS_DIR + "/readings-0002.tsv"])
+
+    def test_remove_acknowledged(self):
+        self.assertEqual(self.compact(acked="readings-0001.tsv"),
+                (["readings-0000.tsv", "readings-0001.tsv"], ["readings-0000.tsv"]))
+        self.assertEqual(self.compact(acked="readings-0002.tsv"), ([], ["readings-0001.tsv"]))
+        self.assertEqual(os.listdir(READINGS_DIR), ["readings-0002.tsv"])
+
+    def test_not_removed_before_compacted(self):
+        self.assertEqual(self.compact(acked="readings-0002.tsv", max_files=1),
+                (["readings-0000.tsv"], ["readings-0000.tsv"]))
+        self.assertEqual(sorted(os.listdir(READINGS_DIR)), ["readings-0001.tsv", "readings-0002.tsv"])
+
+    def test_rerun_after_crash(self):
+        # Archived, but stopped before saving the state
+        co2unit_archive.compact_file(READINGS_DIR + "/readings-0000.tsv", ARCHIVE_DIR)
+        self.compact()
+        with open(ARCHIVE_DIR + "/readings-2019-07.col", "rb") as f:
+            self.assertEqual(len(list(co2unit_archive.segments(f))), 1)
+
+    def test_rerun_after_crash_between_sites(self):
+        write_readings("readings-0000.tsv", [
+            row("2019-07-31", "23:00:10", 20.0, [600]),
+            row("2019-07-31", "23:30:10", 21.0, [700], site_code="varanger-04"),
+            ])
+        # Only the first site's segment was written
+        rows = [co2unit_archive.parse_row(row("2019-07-31", "23:00:10", 20.0, [600]))[3]]
+        fileutil.mkdirs(ARCHIVE_DIR)
+        with open(ARCHIVE_DIR + "/readings-2019-07.col", "wb") as f:
+            f.write(co2unit_archive.pack_segment("readings-0000.tsv", "co2unit-30aea42a50bc", "varanger-03", rows))
+        self.compact()
+        with open(ARCHIVE_DIR + "/readings-2019-07.col", "rb") as f:
+            self.assertEqual([s["site_code"] for s in co2unit_archive.segments(f)], ["varanger-03", "varanger-04"])
+
+    def test_segment_per_run(self):
+        write_readings("readings-0000.tsv", [
+            row("2019-07-31", "23:00:10", 20.0, [600]),
+            row("2019-07-31", "23:10:10", 20.0, [600], site_code="varanger-04"),
+            row("2019-07-31", "23:20:10", 21.0, [700]),
+            row("2019-07-31", "23:30:10", 21.0, [700, 710]),
+            ])
+        path = READINGS_DIR + "/readings-0000.tsv"
+        self.assertEqual(co2unit_archive.compact_file(path, ARCHIVE_DIR), 4)
+        with open(ARCHIVE_DIR + "/readings-2019-07.col", "rb") as f:
+            segs = list(co2unit_archive.segments(f))
+            self.assertEqual([(s["site_code"], s["rows"], s["n_co2"]) for s in segs],
+                    [("varanger-03", 1, 1), ("varanger-04", 1, 1), ("varanger-03", 2, 2)])
+            self.assertEqual(co2unit_archive.read_column(f, segs[2], "co2_1"), [None, 710])
+        self.assertTrue(co2unit_archive.check_file(path, ARCHIVE_DIR))
+
+        # Stopped after the first two segments: only the last is written again
+        with open(ARCHIVE_DIR + "/readings-2019-07.col", "rb") as f:
+            whole = f.read()
+        segs_end = len(whole) - len(co2unit_archive.pack_segment("readings-0000.tsv",
+            "co2unit-30aea42a50bc", "varanger-03",
+            [co2unit_archive.parse_row(row("2019-07-31", "23:20:10", 21.0, [700]))[3],
+             co2unit_archive.parse_row(row("2019-07-31", "23:30:10", 21.0, [700, 710]))[3]]))
+        with open(ARCHIVE_DIR + "/readings-2019-07.col", "wb") as f:
+            f.write(whole[:segs_end])
+        self.assertEqual(co2unit_archive.compact_file(path, ARCHIVE_DIR), 2)
+        with open(ARCHIVE_DIR + "/readings-2019-07.col", "rb") as f:
+            self.assertEqual(f.read(), whole)
+
+    def test_skipped_lines_kept(self):
+        cut = row("2019-07-31", "23:30:10", 21.0, [700])[0:30]
+        write_readings("readings-0000.tsv", [
+            row("2019-07-31", "23:00:10", 20.0, [600]),
+            "not a row\n",
+            "\n",
+            cut,
+            ])
+        self.assertEqual(self.compact(acked="readings-0001.tsv"),
+                (["readings-0000.tsv", "readings-0001.tsv"], ["readings-0000.tsv"]))
+        with open(ARCHIVE_DIR + "/skipped/readings-0000.tsv") as f:
+            self.assertEqual(f.read(), "not a row\n" + cut + "\n")
+
+    def test_not_removed_unless_skipped_kept(self):
+        write_readings("readings-0000.tsv", [
+            row("2019-07-31", "23:00:10", 20.0, [600]),
+            "not a row\n",
+            ])
+        path = READINGS_DIR + "/readings-0000.tsv"
+        self.compact()
+        self.assertTrue(co2unit_archive.check_file(path, ARCHIVE_DIR))
+        os.remove(ARCHIVE_DIR + "/skipped/readings-0000.tsv")
+        self.assertFalse(co2unit_archive.check_file(path, ARCHIVE_DIR))
+        # Compacted again before removal, without writing the rows twice
+        self.assertEqual(self.compact(acked="readings-0001.tsv"), ([], ["readings-0000.tsv"]))
+        self.assertTrue(fileutil.isfile(ARCHIVE_DIR + "/skipped/readings-0000.tsv"))
+        self.assertEqual(co2unit_archive.summarize("co2", archive_dir=ARCHIVE_DIR).count, 3)
+
+    def test_rerun_after_append_cut_short(self):
+        co2unit_archive.compact_file(READINGS_DIR + "/readings-0000.tsv", ARCHIVE_DIR)
+        path = ARCHIVE_DIR + "/readings-2019-07.col"
+        with open(path, "rb") as f:
+            data = f.read()
+        with open(path, "wb") as f:
+            f.write(data[:-3])
+        self.compact()
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), data)
+
+    def test_not_removed_unless_whole(self):
+        self.compact()
+        path = ARCHIVE_DIR + "/readings-2019-08.col"
+        with open(path, "rb") as f:
+            data = f.read()
+        with open(path, "wb") as f:
+            f.write(data[:-3])
+        self.assertFalse(co2unit_archive.check_file(READINGS_DIR + "/readings-0001.tsv", ARCHIVE_DIR))
+        # Summaries skip the bad segment until it is compacted again
+        self.assertEqual(co2unit_archive.summarize("co2", archive_dir=ARCHIVE_DIR).count, 2)
+        self.assertEqual(self.compact(acked="readings-0002.tsv"), ([], ["readings-0000.tsv", "readings-0001.tsv"]))
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), data)
+
+    def test_summarize(self):
+        self.compact()
+        pending = co2unit_archive.uncompacted(READINGS_DIR, STATE_PATH)
+        def summary(column, since=None, until=None):
+            s = co2unit_archive.summarize(column, since, until, ARCHIVE_DIR, pending)
+            return (s.min, s.max, s.mean(), s.count)
+
+        self.assertEqual(summary("etemp"), (20.0, 30.0, 23.2, 5))
+        self.assertEqual(summary("co2"), (600, 1200, 850.0, 5))
+        # Whole segments from the index, partial ones from their columns
+        self.assertEqual(summary("etemp", since=ts("2019-08-01")), (22.0, 30.0, 25.0, 3))
+        self.assertEqual(summary("etemp", ts("2019-07-31", "23:10:00"), ts("2019-08-01", "00:10:00")), (21.0, 22.0, 21.5, 2))
+        self.assertEqual(summary("co2_1"), (1000, 1000, 1000.0, 1))
+        self.assertEqual(summary("etemp", since=ts("2019-09-01")), (None, None, None, 0))
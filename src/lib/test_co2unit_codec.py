@@ -0,0 +1,68 @@
+import uio
+
+import unittest
+
+import co2unit_codec
+
+DATA = b"".join([
+    b"co2unit-30aea42a50bc\tvaranger-03\t2019-07-31\t13:00:10\t23.4375\t1\t680\t700\n",
+    b"co2unit-30aea42a50bc\tvaranger-03\t2019-07-31\t13:30:10\t23.4375\t1\t690\t700\n",
+    b"co2unit-30aea42a50bc\tvaranger-03\t2019-08-01\t00:00:10\t23.5\t1\t690\n",
+    b"co2unit-30aea42a50bc\tvaranger-03\t2019-08-01\t00:30:10\t23.5\t1\t690\t700\t710\n",
+    ])
+
+class TestTsvDelta(unittest.TestCase):
+
+    def test_repeated_fields(self):
+        encoded = co2unit_codec.encode("tsvdelta", DATA)
+        lines = encoded.split(b"\n")
+        self.assertEqual(lines[1], b"\x01\t\x01\t\x01\t13:30:10\t\x01\t1\t690\t\x01")
+        self.assertEqual(lines[3], b"\x01\t\x01\t\x01\t00:30:10\t\x01\t1\t\x01\t700\t710")
+        self.assertTrue(len(encoded) < len(DATA) * 2 / 3)
+        self.assertEqual(co2unit_codec.decode("tsvdelta", encoded), DATA)
+
+    def test_writes_split_lines(self):
+        out = uio.BytesIO()
+        enc = co2unit_codec.encoder("tsvdelta", out)
+        for i in range(0, len(DATA), 7):
+            enc.write(memoryview(DATA)[i:i+7])
+        enc.finish()
+        self.assertEqual(out.getvalue(), co2unit_codec.encode("tsvdelta", DATA))
+
+    def test_partial_last_line(self):
+        data = DATA + b"co2unit-30aea42a50bc\tvara"
+        self.assertEqual(co2unit_codec.decode("tsvdelta", co2unit_codec.encode("tsvdelta", data)), data)
+        # A batch may also start mid-line
+        data = DATA[50:]
+        self.assertEqual(co2unit_codec.decode("tsvdelta", co2unit_codec.encode("tsvdelta", data)), data)
+
+    def test_escapes(self):
+        data = b"\x01\t\x02x\tab\n\x01\t\x02x\tab\n\n\n"
+        encoded = co2unit_codec.encode("tsvdelta", data)
+        self.assertEqual(encoded.split(b"\n")[0], b"\x02\x01\t\x02\x02x\tab")
+        self.assertEqual(co2unit_codec.decode("tsvdelta", encoded), data)
+
+class TestDeflate(unittest.TestCase):
+
+    def test_roundtrip(self):
+        if not co2unit_codec.can_encode("deflate"):
+            return
+        encoded = co2unit_codec.encode("deflate", DATA)
+        self.assertTrue(len(encoded) < len(DATA) / 2)
+        self.assertEqual(co2unit_codec.decode("deflate", encoded), DATA)
+
+class TestNegotiate(unittest.TestCase):
+
+    def test_pick(self):
+        self.assertEqual(co2unit_codec.pick(["deflate", "tsvdelta"]), "deflate")
+        self.assertEqual(co2unit_codec.pick(["deflate", "tsvdelta"], ["tsvdelta"]), "tsvdelta")
+        self.assertEqual(co2unit_codec.pick(["lz4"]), None)
+        self.assertEqual(co2unit_codec.pick([""]), None)
+
+    def test_unknown(self):
+        self.assertFalse(co2unit_codec.can_encode("lz4"))
+        with self.assertRaises(ValueError):
+            co2unit_codec.encoder("lz4", uio.BytesIO())
+        with self.assertRaises(ValueError):
+            co2unit_codec.decode("lz4", b"")
+
@@ -0,0 +1,125 @@
+import os
+import uio
+
+import unittest
+import logging
+
+import co2unit_errors
+import fileutil
+
+# Suppress logging
+logging.getLogger("errors").setLevel(logging.CRITICAL)
+logging.getLogger("co2unit_errors").setLevel(logging.CRITICAL)
+logging.getLogger("test_errors").setLevel(logging.CRITICAL)
+
+TEST_DIR = "test_tmp_errors"
+
+class FakeHw(object):
+    SDCARD_MOUNT_POINT = TEST_DIR
+
+    def __init__(self):
+        self.mounts = 0
+
+    def power_peripherals(self, value=None):
+        return True
+
+    def sync_to_most_reliable_rtc(self, reset_ok=False):
+        pass
+
+    def mount_sd_card(self):
+        self.mounts += 1
+
+def drained(ring):
+    f = uio.BytesIO()
+    ring.drain(f)
+    return f.getvalue()
+
+class TestErrorRing(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = logging.getLogger("test_errors")
+
+    def tearDown(self):
+        for h in list(self.logger.handlers):
+            self.logger.removeHandler(h)
+
+    def test_write_wraps(self):
+        ring = co2unit_errors.ErrorRing(size=8)
+        ring.write(b"abcde")
+        self.assertEqual(drained(ring), b"abcde")
+        ring.write(b"fghij")
+        self.assertEqual(ring.pending(), 5)
+        self.assertEqual(drained(ring), b"fghij")
+        self.assertEqual(ring.pending(), 0)
+        self.assertEqual(drained(ring), b"")
+
+    def test_overflow_drops_oldest_records(self):
+        ring = co2unit_errors.ErrorRing(size=16)
+        ring.write(b"first line\n")
+        ring.write(b"second\n")
+        ring.write(b"third\n")
+        self.assertEqual(ring.dropped(), 8)
+        self.assertEqual(drained(ring), b"----- 11 bytes of records dropped\nsecond\nthird\n")
+
+    def test_records_and_levels(self):
+        ring = co2unit_errors.ErrorRing(size=512, level=logging.WARNING)
+        self.logger.addHandler(ring)
+        # The stream is at CRITICAL for this logger, but the ring has its own level
+        self.logger.info("not kept")
+        self.logger.warning("kept %d", 1)
+        try:
+            raise ValueError("boom")
+        except ValueError as e:
+            self.logger.exc(e, "failed")
+        lines = drained(ring).decode().split("\n")
+        self.assertTrue(lines[0].startswith("----- "))
+        self.assertTrue(lines[0].endswith(" WARN  kept 1"))
+        self.assertTrue(lines[1].endswith(" EXC   failed"))
+        self.assertTrue("ValueError" in lines[-2])
+
+    def test_stamped_at_flush(self):
+        import time
+        ring = co2unit_errors.ErrorRing(size=512)
+        self.logger.addHandler(ring)
+        self.logger.warning("before sync")
+        unsynced = drained(ring).decode()
+        self.assertTrue(unsynced.startswith("----- T"))
+
+        self.logger.warning("before sync")
+        now_ticks = time.ticks_ms()
+        # The RTC says 2019-06-01 12:00:00, 5 s after the record
+        ring.stamp(1559390400, time.ticks_add(now_ticks, 5000))
+        line = drained(ring).decode()
+        self.assertEqual(len(line), len(unsynced))
+        self.assertTrue(line.startswith("----- 2019-06-01 11:59:55"))
+        self.assertTrue(line.endswith(" WARN  before sync\n"))
+
+class TestFlush(unittest.TestCase):
+
+    def setUp(self):
+        fileutil.rm_recursive(TEST_DIR)
+        self.ring = co2unit_errors.ring
+        self.ring.flushed = self.ring.end
+
+    def tearDown(self):
+        fileutil.rm_recursive(TEST_DIR)
+        self.ring.hw = None
+
+    def test_one_mount_per_flush(self):
+        hw = FakeHw()
+        co2unit_errors.info(hw, "one")
+        co2unit_errors.warning(hw, "two")
+        self.assertEqual(hw.mounts, 0)
+        logging.flush()
+        self.assertEqual(hw.mounts, 1)
+
+        files = os.listdir(TEST_DIR + "/errors")
+        self.assertEqual(len(files), 1)
+        with open(TEST_DIR + "/errors/" + files[0]) as f:
+            lines = f.read().split("\n")
+        self.assertTrue(lines[0].endswith(" INFO  one"))
+        self.assertTrue(lines[1].endswith(" WARN  two"))
+
+        # Nothing new, nothing to do
+        logging.flush()
+        self.assertEqual(hw.mounts, 1)
@@ -1,5 +1,11 @@
 import sys
 
+try:
+    import uos as os
+except ImportError:
+    import os
+
+import json
 import unittest
 import logging
 
@@ -13,6 +19,9 @@ logging.getLogger("main").setLevel(logging.CRITICAL)
 logging.getLogger("main").exception = lambda *args: None
 logging.getLogger("main").exc = lambda *args: None
 
+# Before any test replaces the task log
+REGISTRY = list(main.nvs_task_log.registry)
+
 class TestNoopWdt(unittest.TestCase):
     def test_noop_wdt(self):
         wdt = main.NoopWdt()
@@ -39,6 +48,22 @@ class TestMainWrapper(unittest.TestCase):
         self.assertTrue(main.machine._deepsleep_called)
         self.assertEqual(main.machine._deepsleep_time_ms, main.LAST_RESORT_DEEPSLEEP_MS)
 
+    def test_records_flushed_before_sleep(self):
+        class CountingHandler(logging.Handler):
+            flushes = 0
+            def flush(self):
+                self.flushes += 1
+        handler = CountingHandler()
+        logger = logging.getLogger("test_main_wrapper")
+        logger.addHandler(handler)
+        try:
+            with main.MainWrapper():
+                pass
+        finally:
+            logger.removeHandler(handler)
+        self.assertEqual(handler.flushes, 1)
+        self.assertTrue(main.machine._deepsleep_called)
+
     def test_keyboard_interrupt(self):
         with self.assertRaises(KeyboardInterrupt):
             with main.MainWrapper():
@@ -148,6 +173,107 @@ class TestTaskRunner(unittest.TestCase):
         runner.run(returnlist, last_task)
         self.assertEqual(runner.history, [returnlist,nexta,nextb,last_task])
 
+    def test_flush_sd_cache_after_failed_task(self):
+        class Ok(object):
+            def run(self): pass
+        class Fail(object):
+            def run(self): raise Exception()
+
+        main.hw = mock_apis.MockCo2UnitHw()
+        try:
+            main.TaskRunner().run(Ok, Ok)
+            self.assertEqual(main.hw._flush_sd_cache_calls, 0)
+            main.TaskRunner().run(Ok, Fail, Ok)
+            self.assertEqual(main.hw._flush_sd_cache_calls, 1)
+        finally:
+            main.hw = None
+
+    def test_compact_once_per_wake(self):
+        import co2unit_archive
+        calls = []
+        orig = co2unit_archive.compact_sequence
+        co2unit_archive.compact_sequence = lambda hw, ctx=None: calls.append(ctx)
+        try:
+            main.TaskRunner().run(main.CompactReadings, main.CompactReadings)
+            self.assertEqual(len(calls), 1)
+            # A new wake compacts again
+            main.TaskRunner().run(main.CompactReadings)
+            self.assertEqual(len(calls), 2)
+        finally:
+            co2unit_archive.compact_sequence = orig
+
+    def test_compact_not_schedulable(self):
+        self.assertFalse("CompactReadings" in main.TASK_STRS)
+
+class FakeSdHw(object):
+    SDCARD_MOUNT_POINT = "."
+
+    def __init__(self):
+        self.syncs = 0
+        self.mounts = 0
+
+    def sync_to_most_reliable_rtc(self, reset_ok=False):
+        self.syncs += 1
+
+    def mount_sd_card(self):
+        self.mounts += 1
+
+class TestWakeContext(unittest.TestCase):
+
+    def setUp(self):
+        import configutil
+        self.reads = []
+        self.orig_read = configutil.read_config_json
+        def counting_read(path, defaults={}):
+            self.reads.append(path)
+            return configutil.Namespace(**defaults)
+        configutil.read_config_json = counting_read
+
+    def tearDown(self):
+        import configutil
+        configutil.read_config_json = self.orig_read
+
+    def test_prepare_sd_once(self):
+        hw = FakeSdHw()
+        ctx = main.WakeContext()
+        ctx.prepare_sd(hw)
+        ctx.prepare_sd(hw)
+        self.assertEqual((hw.syncs, hw.mounts), (1, 1))
+
+    def test_sync_rtc_counts_for_prepare(self):
+        hw = FakeSdHw()
+        ctx = main.WakeContext()
+        ctx.sync_rtc(hw)
+        ctx.prepare_sd(hw)
+        self.assertEqual((hw.syncs, hw.mounts), (1, 1))
+
+    def test_configs_read_once(self):
+        ctx = main.WakeContext()
+        a = ctx.read_config("conf/a.json", {"x": 1})
+        self.assertIs(ctx.read_config("conf/a.json", {"x": 1}), a)
+        ctx.read_config("conf/b.json")
+        self.assertEqual(self.reads, ["conf/a.json", "conf/b.json"])
+        ctx.invalidate_configs()
+        ctx.read_config("conf/a.json", {"x": 1})
+        self.assertEqual(self.reads, ["conf/a.json", "conf/b.json", "conf/a.json"])
+
+    def test_shared_by_tasks_of_runner(self):
+        hw = FakeSdHw()
+        class SdTask(object):
+            def run(self):
+                main.ctx.prepare_sd(hw)
+                main.ctx.read_config("conf/a.json")
+
+        runner = main.TaskRunner()
+        runner.run(SdTask, SdTask)
+        self.assertEqual(len(runner.history), 2)
+        self.assertEqual((hw.syncs, hw.mounts), (1, 1))
+        self.assertEqual(self.reads, ["conf/a.json"])
+
+        # A new wake starts afresh
+        main.TaskRunner().run(SdTask)
+        self.assertEqual((hw.syncs, hw.mounts), (2, 2))
+
 class TestPycomNvsWithDefault(unittest.TestCase):
     def setUp(self):
         main.pycom = mock_apis.MockPycom()
@@ -304,6 +430,174 @@ class TestSleepUntilScheduled(unittest.TestCase):
                         ["Communicate", 'daily', 3, 15],
                     ])
 
+class TestScheduleTimeline(unittest.TestCase):
+
+    SCHED_CFG = [
+            ["TakeMeasurement", 'minutes', 30, 0],
+            ["Communicate", 'daily', 3, 15],
+            ]
+
+    def setUp(self):
+        class CountingPycom(mock_apis.MockPycom):
+            sets = 0
+            def nvs_set(self, key, val):
+                self.sets += 1
+                mock_apis.MockPycom.nvs_set(self, key, val)
+        main.pycom = CountingPycom()
+
+    def secs(self, iso):
+        return timeutil.mktime(timeutil.parse_time(iso))
+
+    def test_save_and_load(self):
+        now = self.secs("2020-08-27 07:30:05")
+        timeline = main.load_timeline(self.SCHED_CFG, now)
+        self.assertEqual(sorted(timeline.dirty), [0, 1])
+        main.save_timeline(timeline)
+
+        loaded = main.load_timeline(self.SCHED_CFG, now)
+        self.assertEqual(loaded.dirty, [])
+        self.assertEqual(loaded.agenda(), timeline.agenda())
+
+    def test_one_write_per_fired_rule(self):
+        now = self.secs("2020-08-27 07:30:05")
+        main.save_timeline(main.load_timeline(self.SCHED_CFG, now))
+
+        timeline = main.load_timeline(self.SCHED_CFG, now)
+        sets = main.pycom.sets
+        timeline.advance(now)
+        main.save_timeline(timeline)
+        self.assertEqual(main.pycom.sets, sets + 1)
+        self.assertEqual(main.load_timeline(self.SCHED_CFG, now).agenda()[0],
+                [self.secs("2020-08-27 08:00:00"), "TakeMeasurement"])
+
+    def test_changed_schedule_compiles_anew(self):
+        now = self.secs("2020-08-27 07:30:05")
+        main.save_timeline(main.load_timeline(self.SCHED_CFG, now))
+        timeline = main.load_timeline(self.SCHED_CFG[1:], now)
+        self.assertEqual(timeline.dirty, [0])
+
+    def test_check_then_sleep(self):
+        timeline = main.load_timeline(self.SCHED_CFG, self.secs("2020-08-27 07:30:05"))
+        tasks = main.CheckSchedule().runwith(
+                itt=timeutil.parse_time("2020-08-27 07:30:05"),
+                sched_cfg=self.SCHED_CFG, timeline=timeline)
+        self.assertEqual(tasks, [main.TakeMeasurement])
+
+        # The measurement is done. Still in the same minute, it is not due again.
+        tasks = main.CheckSchedule().runwith(
+                itt=timeutil.parse_time("2020-08-27 07:30:40"),
+                sched_cfg=self.SCHED_CFG, timeline=timeline)
+        self.assertEqual(tasks, [])
+
+SCHED_TEST_DIR = "test_tmp_schedule"
+
+class TestScheduleFile(unittest.TestCase):
+
+    def setUp(self):
+        import configutil
+        import fileutil
+        self.orig_read = configutil.read_config_json
+        self.home = os.getcwd()
+        fileutil.mkdirs(SCHED_TEST_DIR + "/conf")
+        main.pycom = mock_apis.MockPycom()
+        main.hw = FakeSdHw()
+        main.hw.SDCARD_MOUNT_POINT = self.home + "/" + SCHED_TEST_DIR
+        main.ctx = main.WakeContext()
+        self.now = timeutil.mktime(timeutil.parse_time("2020-08-27 07:30:05"))
+
+    def tearDown(self):
+        import configutil
+        import fileutil
+        configutil.read_config_json = self.orig_read
+        os.chdir(self.home)
+        fileutil.rm_recursive(SCHED_TEST_DIR)
+        main.hw = None
+
+    def write_schedule(self, text):
+        with open(self.home + "/" + SCHED_TEST_DIR + "/" + main.SCHEDULE_PATH, "w") as f:
+            f.write(text)
+
+    def test_default_without_file(self):
+        sched_cfg, timeline = main.load_schedule(self.now)
+        self.assertEqual(sched_cfg, main.SCHEDULE_DEFAULT)
+        self.assertEqual(main.hw.mounts, 1)
+
+    def test_default_without_hw(self):
+        main.hw = None
+        sched_cfg, timeline = main.load_schedule(self.now)
+        self.assertEqual(sched_cfg, main.SCHEDULE_DEFAULT)
+
+    def test_from_file_once_per_change(self):
+        self.write_schedule('{"schedule": [["TakeMeasurement", "minutes", 10, 0], ["Communicate", "daily", 3, 15]]}')
+        sched_cfg, timeline = main.load_schedule(self.now)
+        self.assertEqual(sched_cfg, [["TakeMeasurement", "minutes", 10, 0], ["Communicate", "daily", 3, 15]])
+        self.assertEqual(timeline.agenda()[0][0], self.now - 5)
+        self.assertIs(main.load_schedule(self.now)[1], timeline)
+
+        self.write_schedule('{"schedule": [["TakeMeasurement", "minutes", 15, 0], ["Communicate", "daily", 3, 15, {"jitter_mins": 10}]]}')
+        sched_cfg, timeline = main.load_schedule(self.now)
+        self.assertEqual(sched_cfg[0], ["TakeMeasurement", "minutes", 15, 0])
+
+    def count_reads(self):
+        import configutil
+        reads = []
+        orig_read = self.orig_read
+        def counting_read(path, defaults={}):
+            reads.append(path)
+            return orig_read(path, defaults)
+        configutil.read_config_json = counting_read
+        return reads
+
+    def next_wake(self):
+        os.chdir(self.home)
+        main.ctx = main.WakeContext()
+        return main.load_schedule(self.now)
+
+    def test_saved_in_nvs(self):
+        cfg = [["TakeMeasurement", "minutes", 10, 0], ["Communicate", "daily", 3, 15, {"jitter_mins": 30}]]
+        self.write_schedule('{"schedule": %s}' % json.dumps(cfg))
+        reads = self.count_reads()
+        sched_cfg, timeline = main.load_schedule(self.now)
+        main.save_timeline(timeline)
+        self.assertEqual(len(reads), 1)
+
+        # Unchanged file: from NVS, without reading the file
+        sched_cfg, timeline = self.next_wake()
+        self.assertEqual(sched_cfg, cfg)
+        self.assertEqual(timeline.dirty, [])
+        self.assertEqual(len(reads), 1)
+
+        # Changed file: read again
+        cfg[0][2] = 15
+        self.write_schedule('{"schedule": %s, "changed": 1}' % json.dumps(cfg))
+        sched_cfg, timeline = self.next_wake()
+        self.assertEqual(sched_cfg, cfg)
+        self.assertEqual(len(reads), 2)
+
+    def test_not_packed_read_from_file(self):
+        cfg = [["TakeMeasurement", "cron", "*/10 * * * *"], ["Communicate", "daily", 3, 15]]
+        self.write_schedule('{"schedule": %s}' % json.dumps(cfg))
+        reads = self.count_reads()
+        main.load_schedule(self.now)
+        sched_cfg, timeline = self.next_wake()
+        self.assertEqual(sched_cfg, cfg)
+        self.assertEqual(len(reads), 2)
+
+    def test_invalid_falls_back_to_default(self):
+        for text in [
+                '{"schedule": [["Dance", "minutes", 10, 0]]}',
+                '{"schedule": [["TakeMeasurement", "minutes", 10, 0]]}',
+                '{"schedule": [["TakeMeasurement", "hourly", 10]]}',
+                '{"schedule": [["TakeMeasurement", "cron", "0 0 30 2 *"]]}',
+                '{"schedule": []}',
+                '{"schedule": ',
+                ]:
+            os.chdir(self.home)
+            self.write_schedule(text)
+            main.ctx = main.WakeContext()
+            sched_cfg, timeline = main.load_schedule(self.now)
+            self.assertEqual(sched_cfg, main.SCHEDULE_DEFAULT, text)
+
 class TestPersistentTaskLog(unittest.TestCase):
 
     class TaskA(object):
@@ -337,6 +631,13 @@ class TestPersistentTaskLog(unittest.TestCase):
         self.assertEqual(ti._unpack_event(packed), (None, None, 0))
         self.assertEqual(ti._unpack_event(None), (None, None, 0))
 
+    def test_task_ids(self):
+        # The IDs in the run logs saved in NVS must not change with an update
+        self.assertEqual([t.__name__ for t in REGISTRY], [
+            "BootUp", "InitPeripherals", "CrashRecovery", "QuickSelfTest",
+            "LteTest", "TakeMeasurement", "Communicate", "CheckForUpdates",
+            "CheckSchedule", "SleepUntilScheduled", "CompactReadings"])
+
     def test_pack_unregistered(self):
         ti = main.NvsTaskLog()
         packed = ti._pack_event(self.TaskA,None,0)
@@ -494,3 +795,85 @@ class TestPersistentTaskLog(unittest.TestCase):
             (FailTask, "START", 1),
             (FailTask, "FAIL", 1),
             ])
+
+    def test_one_nvs_write_per_event(self):
+
+        class CountingPycom(mock_apis.MockPycom):
+            def __init__(self):
+                mock_apis.MockPycom.__init__(self)
+                self.sets = 0
+            def nvs_set(self, key, val):
+                self.sets += 1
+                mock_apis.MockPycom.nvs_set(self, key, val)
+
+        main.pycom = CountingPycom()
+        ti = main.NvsTaskLog()
+        ti.register(self.TaskA)
+        ti.register(self.TaskB)
+        ti.read_run_log()
+
+        for i in range(0, ti.LOG_LEN * 3):
+            sets = main.pycom.sets
+            ti.record_start(self.TaskA if i % 3 else self.TaskB)
+            self.assertEqual(main.pycom.sets, sets + 1)
+
+    def test_ring_wraps_and_persists(self):
+
+        ti = main.NvsTaskLog()
+        ti.register(self.TaskA)
+        ti.register(self.TaskB)
+
+        # More events than the 8-bit sequence number can count
+        for i in range(0, 300):
+            ti.record_start(self.TaskA)
+            ti.record_ok(self.TaskA)
+        ti.record_start(self.TaskB)
+        ti.record_start(self.TaskB)
+
+        log = ti.read_run_log()
+        self.assertEqual(len(log), ti.LOG_LEN)
+        self.assertEqual(log[-1], (self.TaskB, "START", 2))
+        self.assertEqual(log[-2], (self.TaskA, "OK", 1))
+
+        # Create a fresh one
+        ti = main.NvsTaskLog()
+        ti.register(self.TaskA)
+        ti.register(self.TaskB)
+        self.assertEqual(ti.read_run_log(), log)
+
+        # Repetitions count up on the newest event only
+        ti.record_start(self.TaskB)
+        self.assertEqual(ti.read_run_log()[-1], (self.TaskB, "START", 3))
+
+    def test_upgrade_from_list_layout(self):
+        import ustruct
+
+        # Log as written by older code: "hBB" events, oldest first
+        old = [(0, 1, 1), (0, 2, 1), (1, 1, 3)]
+        for i, event in enumerate(old):
+            packed = ustruct.unpack("I", ustruct.pack("hBB", *event))[0]
+            main.pycom.nvs_set("task_log_{:03d}".format(i), packed)
+
+        ti = main.NvsTaskLog()
+        ti.register(self.TaskA)
+        ti.register(self.TaskB)
+        self.assertEqual(ti.read_run_log(), [
+            (self.TaskA, "START", 1),
+            (self.TaskA, "OK", 1),
+            (self.TaskB, "START", 3),
+            ])
+        self.assertEqual(main.pycom.nvs_get(ti.FORMAT_KEY), ti.FORMAT_RING)
+
+        ti.record_start(self.TaskB)
+        ti.record_ok(self.TaskB)
+
+        # Create a fresh one
+        ti = main.NvsTaskLog()
+        ti.register(self.TaskA)
+        ti.register(self.TaskB)
+        self.assertEqual(ti.read_run_log(), [
+            (self.TaskA, "START", 1),
+            (self.TaskA, "OK", 1),
+            (self.TaskB, "START", 4),
+            (self.TaskB, "OK", 1),
+            ])
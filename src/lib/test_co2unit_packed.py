@@ -0,0 +1,77 @@
+import unittest
+
+import timeutil
+import co2unit_packed
+
+RAW_FIELDS = ['Z', 'd', 'o', 'h', 'v']
+
+def pack_file(hw_id, site_code, readings):
+    header = co2unit_packed.pack_header(hw_id, site_code, RAW_FIELDS, 10)
+    fmt = co2unit_packed.record_fmt(10, len(RAW_FIELDS))
+    data = header
+    for reading in readings:
+        buf = co2unit_packed.new_record_buf(fmt)
+        data += co2unit_packed.pack_record(buf, fmt, *reading)
+    return data
+
+class TestPackedFormat(unittest.TestCase):
+
+    def test_header_roundtrip(self):
+        header = co2unit_packed.pack_header("co2unit-30aea42a50bc", "varanger-03", RAW_FIELDS, 10)
+        parsed, length = co2unit_packed.unpack_header(header + b"trailing")
+        self.assertEqual(length, len(header))
+        self.assertEqual(parsed["hw_id"], "co2unit-30aea42a50bc")
+        self.assertEqual(parsed["site_code"], "varanger-03")
+        self.assertEqual(parsed["raw_fields"], RAW_FIELDS)
+        self.assertEqual(parsed["n_co2"], 10)
+
+    def test_bad_header(self):
+        with self.assertRaises(co2unit_packed.PackedFormatError):
+            co2unit_packed.unpack_header(b"XXXX\x01\x0a")
+        with self.assertRaises(co2unit_packed.PackedFormatError):
+            co2unit_packed.unpack_header(b"CO2R\x63\x0a")
+
+    def test_record_roundtrip(self):
+        ts = timeutil.mktime(timeutil.parse_time("2019-07-31 13:00:10"))
+        co2s = [0, 200010, 710, 710, 700, 690, 700, 700, 700, 700]
+        raws = [229, 32274, 31179, 32989, 18373]
+        data = pack_file("hw", "site", [
+            (ts, 23.4375, 1, co2s, raws),
+            (ts + 1800, None, 0, [None] * 10, [None] * 5),
+            ])
+
+        records = [rec for header, rec in co2unit_packed.unpack_records(data)]
+        self.assertEqual(records, [
+            (ts, 23.4375, 1, co2s, raws),
+            (ts + 1800, None, 0, [None] * 10, [None] * 5),
+            ])
+
+    def test_ignore_partial_record(self):
+        data = pack_file("hw", "site", [(0, 1.0, 0, [1] * 10, [2] * 5)])
+        records = list(co2unit_packed.unpack_records(data + b"\x00\x01\x02"))
+        self.assertEqual(len(records), 1)
+
+    def test_row_matches_tsv_columns(self):
+        tt = timeutil.parse_time("2019-07-31 13:00:10")
+        ts = timeutil.mktime(tt)
+        co2s = [680, 700, 710, 710, 700, 690, 700, 700, 700, 700]
+        data = pack_file("co2unit-30aea42a50bc", "varanger-03", [
+            (ts, 23.4375, 1, co2s, [None] * 5)])
+
+        header, rec = next(co2unit_packed.unpack_records(data))
+        row = co2unit_packed.record_row(header, rec, timeutil.localtime(rec[0]))
+        self.assertEqual("\t".join([str(i) for i in row]),
+                "co2unit-30aea42a50bc\tvaranger-03\t2019-07-31\t13:00:10\t23.4375\t1\t"
+                "680\t700\t710\t710\t700\t690\t700\t700\t700\t700\t"
+                "None\tNone\tNone\tNone\tNone")
+
+    def test_smaller_than_tsv(self):
+        fmt = co2unit_packed.record_fmt(10, len(RAW_FIELDS))
+        self.assertEqual(len(co2unit_packed.new_record_buf(fmt)), 48)
+
+    def test_large_co2_and_etemp(self):
+        data = pack_file("hw", "site", [(0, -3.3, 0, [32767, 32768, 40003, 200010, 999999] + [None] * 5, [None] * 5)])
+        header, rec = next(co2unit_packed.unpack_records(data))
+        self.assertEqual(rec[3][0:5], [32767, 32770, 40000, 200010, 327660])
+        # Rounded to the sensor's 1/16 C
+        self.assertEqual(rec[1], -3.3125)
@@ -0,0 +1,76 @@
+import unittest
+
+import configutil
+import co2unit_settle
+
+# CO2 readings as recorded in readings files, one list per measurement.
+# Startup readings (0 and 200010) are from units right after power-on.
+TRACES = [
+    # (trace, samples taken in adaptive mode with default settings)
+    ([680, 700, 710, 710, 700, 690, 700, 700, 700, 700], 4),
+    ([800, 810, 810, 800, 850, 850, 850, 840, 840, 830], 3),
+    ([770, 780, 750, 740, 740, 740, 740, 740, 740, 740], 5),
+    ([690, 660, 660, 660, 690, 690, 680, 680, 680, 680], 4),
+    ([0, 200010, 452, 455, 450, 451, 449, 450, 452, 450], 5),
+    ([200010, 0, 0, 610, 615, 612, 611, 610, 612, 613], 6),
+    # Never settles within 20 ppm: hits the cap
+    ([500, 540, 580, 620, 660, 700, 740, 780, 820, 860], 10),
+]
+
+def config(**kwargs):
+    mc = {
+        "co2_mode": "adaptive",
+        "co2_max_reads": 10,
+        "co2_settle_count": 3,
+        "co2_settle_ppm": 20,
+        }
+    mc.update(kwargs)
+    return configutil.Namespace(**mc)
+
+def replay(trace, mc):
+    """ Reads from a trace the way co2unit_measure.read_sensors does """
+    readings = [None] * 10
+    n = 0
+    # Two readings are always taken while waiting for the temperature sensor
+    for _ in range(2):
+        readings[n] = trace[n]
+        n += 1
+    while not co2unit_settle.co2_done(readings, n, mc):
+        readings[n] = trace[n]
+        n += 1
+    return readings, n
+
+class TestCo2Settle(unittest.TestCase):
+
+    def test_traces(self):
+        for trace, expected in TRACES:
+            readings, n = replay(trace, config())
+            self.assertEqual(n, expected)
+            self.assertEqual(readings[:n], trace[:n])
+            self.assertEqual(readings[n:], [None] * (10 - n))
+
+    def test_fixed_mode_reads_all(self):
+        for trace, _ in TRACES:
+            self.assertEqual(replay(trace, config(co2_mode="fixed"))[1], 10)
+
+    def test_hard_cap(self):
+        readings, n = replay(TRACES[-1][0], config(co2_max_reads=6))
+        self.assertEqual(n, 6)
+        # The list of slots caps readings even if the config asks for more
+        readings, n = replay(TRACES[-1][0], config(co2_max_reads=50))
+        self.assertEqual(n, 10)
+
+    def test_bad_values_never_settle(self):
+        self.assertFalse(co2unit_settle.co2_settled([0, 0, 0], 3, 3, 20))
+        self.assertFalse(co2unit_settle.co2_settled([200010] * 3, 3, 3, 20))
+        self.assertFalse(co2unit_settle.co2_settled([450, None, 450, 450], 4, 3, 20))
+        self.assertTrue(co2unit_settle.co2_settled([450, None, 450, 450, 450], 5, 3, 20))
+
+    def test_window_is_first_n(self):
+        readings = [450, 450, 450, None, None]
+        self.assertTrue(co2unit_settle.co2_settled(readings, 3, 3, 20))
+        self.assertFalse(co2unit_settle.co2_settled(readings, 2, 3, 20))
+
+    def test_tolerance(self):
+        self.assertTrue(co2unit_settle.co2_settled([600, 620, 610], 3, 3, 20))
+        self.assertFalse(co2unit_settle.co2_settled([600, 621, 610], 3, 3, 20))
@@ -0,0 +1,118 @@
+import json
+import os
+
+import unittest
+import logging
+
+import co2unit_update
+import fileutil
+
+# Suppress logging
+logging.getLogger("co2unit_update").setLevel(logging.CRITICAL)
+logging.getLogger("fileutil").setLevel(logging.CRITICAL)
+
+TEST_DIR = "test_tmp_update"
+FLASH_ROOT = TEST_DIR + "/flash"
+UPDATE_DIR = TEST_DIR + "/updates/update-0001"
+
+ABC_SHA256 = "ba7816bf8f01cfea414140de5dae2223b00361a396177a9cb410ff61f20015ad"
+
+def write_file(fpath, content):
+    fileutil.mkdirs(fileutil.dirname(fpath))
+    with open(fpath, "wb") as f:
+        f.write(content)
+
+def entry(content):
+    write_file(TEST_DIR + "/entry", content)
+    return [len(content), fileutil.file_sha256(TEST_DIR + "/entry")]
+
+def manifest_json(files):
+    return json.dumps({"version": co2unit_update.MANIFEST_VERSION, "files": files})
+
+class TestFileHash(unittest.TestCase):
+
+    def setUp(self):
+        fileutil.rm_recursive(TEST_DIR)
+
+    def tearDown(self):
+        fileutil.rm_recursive(TEST_DIR)
+
+    def test_sha256(self):
+        write_file(TEST_DIR + "/abc", b"abc")
+        self.assertEqual(fileutil.file_sha256(TEST_DIR + "/abc"), ABC_SHA256)
+        # Same across block boundaries
+        self.assertEqual(fileutil.file_sha256(TEST_DIR + "/abc", block_size=2), ABC_SHA256)
+
+    def test_file_matches(self):
+        write_file(TEST_DIR + "/abc", b"abc")
+        self.assertTrue(fileutil.file_matches(TEST_DIR + "/abc", 3, ABC_SHA256))
+        self.assertFalse(fileutil.file_matches(TEST_DIR + "/abc", 4, ABC_SHA256))
+        self.assertFalse(fileutil.file_matches(TEST_DIR + "/abc", 3, "0" * 64))
+        self.assertFalse(fileutil.file_matches(TEST_DIR + "/missing", 3, ABC_SHA256))
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        fileutil.rm_recursive(TEST_DIR)
+
+    def tearDown(self):
+        fileutil.rm_recursive(TEST_DIR)
+
+    def test_parse(self):
+        files = co2unit_update.parse_manifest(manifest_json({"flash/main.py": [3, ABC_SHA256]}))
+        self.assertEqual(files, {"flash/main.py": (3, ABC_SHA256)})
+
+    def test_parse_rejects(self):
+        with self.assertRaises(co2unit_update.UpdateError):
+            co2unit_update.parse_manifest(json.dumps({"version": 99, "files": {}}))
+        with self.assertRaises(co2unit_update.UpdateError):
+            co2unit_update.parse_manifest(manifest_json({"flash/../x": [3, ABC_SHA256]}))
+
+    def test_files_to_fetch(self):
+        write_file(FLASH_ROOT + "/main.py", b"same")
+        write_file(FLASH_ROOT + "/lib/a.mpy", b"old")
+        files = {
+                "flash/main.py": entry(b"same"),
+                "flash/lib/a.mpy": entry(b"new"),
+                "flash/lib/b.mpy": entry(b"added"),
+                "conf-patch/ou-id.json": entry(b"{}"),
+                }
+        fetch = co2unit_update.files_to_fetch(files, flash_root=FLASH_ROOT)
+        self.assertEqual(fetch, ["conf-patch/ou-id.json", "flash/lib/a.mpy", "flash/lib/b.mpy"])
+
+    def test_install_changed_only(self):
+        write_file(FLASH_ROOT + "/main.py", b"same")
+        write_file(FLASH_ROOT + "/lib/a.mpy", b"old")
+        files = {
+                "flash/main.py": entry(b"same"),
+                "flash/lib/a.mpy": entry(b"new"),
+                "flash/lib/sub/b.mpy": entry(b"added"),
+                }
+        # Unchanged main.py was never downloaded
+        write_file(UPDATE_DIR + "/flash/lib/a.mpy", b"new")
+        write_file(UPDATE_DIR + "/flash/lib/sub/b.mpy", b"added")
+        co2unit_update.install_from_manifest(UPDATE_DIR, files, flash_root=FLASH_ROOT)
+
+        for relpath, (size, sha256) in files.items():
+            self.assertTrue(fileutil.file_matches(co2unit_update.installed_path(relpath, FLASH_ROOT), size, sha256))
+
+    def test_install_corrupt_leaves_flash(self):
+        write_file(FLASH_ROOT + "/lib/a.mpy", b"old")
+        files = {
+                "flash/lib/a.mpy": entry(b"new"),
+                "flash/lib/b.mpy": entry(b"added"),
+                }
+        write_file(UPDATE_DIR + "/flash/lib/a.mpy", b"new")
+        write_file(UPDATE_DIR + "/flash/lib/b.mpy", b"addeX")
+        with self.assertRaises(co2unit_update.UpdateError):
+            co2unit_update.install_from_manifest(UPDATE_DIR, files, flash_root=FLASH_ROOT)
+        with open(FLASH_ROOT + "/lib/a.mpy", "rb") as f:
+            self.assertEqual(f.read(), b"old")
+        self.assertFalse(fileutil.isfile(FLASH_ROOT + "/lib/b.mpy"))
+
+    def test_read_manifest(self):
+        fileutil.mkdirs(UPDATE_DIR)
+        self.assertEqual(co2unit_update.read_manifest(UPDATE_DIR), None)
+        write_file(UPDATE_DIR + "/" + co2unit_update.MANIFEST_NAME,
+                manifest_json({"flash/main.py": [3, ABC_SHA256]}).encode())
+        self.assertEqual(co2unit_update.read_manifest(UPDATE_DIR), {"flash/main.py": (3, ABC_SHA256)})
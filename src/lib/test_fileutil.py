@@ -0,0 +1,157 @@
+import os
+
+import unittest
+import logging
+
+import fileutil
+
+# Suppress logging
+logging.getLogger("fileutil").setLevel(logging.CRITICAL)
+
+TEST_DIR = "test_tmp_fileutil"
+SRC_DIR = TEST_DIR + "/src"
+DEST_DIR = TEST_DIR + "/dest"
+
+def write_file(fpath, content):
+    fileutil.mkdirs(fileutil.dirname(fpath))
+    with open(fpath, "wb") as f:
+        f.write(content)
+
+def read_file(fpath):
+    with open(fpath, "rb") as f:
+        return f.read()
+
+class TestCopy(unittest.TestCase):
+
+    def setUp(self):
+        fileutil.rm_recursive(TEST_DIR)
+        write_file(SRC_DIR + "/main.py", b"main")
+        write_file(SRC_DIR + "/lib/a.mpy", b"a" * 10000)
+        write_file(SRC_DIR + "/lib/sub/b.mpy", b"b" * 100)
+
+    def tearDown(self):
+        fileutil.rm_recursive(TEST_DIR)
+
+    def test_copy_file(self):
+        fileutil.mkdirs(DEST_DIR)
+        n = fileutil.copy_file(SRC_DIR + "/lib/a.mpy", DEST_DIR + "/a.mpy", block_size=3000)
+        self.assertEqual(n, 10000)
+        self.assertEqual(read_file(DEST_DIR + "/a.mpy"), b"a" * 10000)
+        # Temp file is renamed into place
+        self.assertEqual(os.listdir(DEST_DIR), ["a.mpy"])
+
+    def test_copy_file_replaces(self):
+        write_file(DEST_DIR + "/main.py", b"old contents")
+        fileutil.copy_file(SRC_DIR + "/main.py", DEST_DIR + "/main.py")
+        self.assertEqual(read_file(DEST_DIR + "/main.py"), b"main")
+
+    def test_copy_file_size(self):
+        path = SRC_DIR + "/lib/a.mpy"
+        self.assertEqual(fileutil.copy_file(path, path, block_size=3000, size=7000), 7000)
+        self.assertEqual(read_file(path), b"a" * 7000)
+        self.assertEqual(fileutil.copy_file(path, path, size=0), 0)
+        self.assertEqual(read_file(path), b"")
+
+    def test_copy_recursive(self):
+        stats = fileutil.copy_recursive(SRC_DIR, DEST_DIR)
+        self.assertEqual(stats.files_copied, 3)
+        self.assertEqual(stats.bytes_copied, 10104)
+        self.assertEqual(read_file(DEST_DIR + "/lib/sub/b.mpy"), b"b" * 100)
+
+    def test_skip_matching(self):
+        fileutil.copy_recursive(SRC_DIR, DEST_DIR)
+        write_file(SRC_DIR + "/lib/sub/b.mpy", b"c" * 100)     # Same size, new contents
+        write_file(SRC_DIR + "/main.py", b"main2")
+
+        stats = fileutil.copy_recursive(SRC_DIR, DEST_DIR, skip_matching=True)
+        self.assertEqual(stats.files_copied, 2)
+        self.assertEqual(stats.files_skipped, 1)
+        self.assertEqual(stats.bytes_copied, 105)
+        self.assertEqual(read_file(DEST_DIR + "/lib/sub/b.mpy"), b"c" * 100)
+        self.assertEqual(read_file(DEST_DIR + "/main.py"), b"main2")
+
+    def test_same_contents(self):
+        write_file(DEST_DIR + "/main.py", b"main")
+        self.assertTrue(fileutil.same_contents(SRC_DIR + "/main.py", DEST_DIR + "/main.py"))
+        self.assertFalse(fileutil.same_contents(SRC_DIR + "/main.py", DEST_DIR + "/missing.py"))
+        write_file(DEST_DIR + "/main.py", b"mAin")
+        self.assertFalse(fileutil.same_contents(SRC_DIR + "/main.py", DEST_DIR + "/main.py"))
+
+def heap_allocated(fn):
+    """ Bytes of heap that fn() allocates, with the collector held off """
+    import gc
+    gc.collect()
+    gc.disable()
+    try:
+        before = gc.mem_alloc()
+        fn()
+        return gc.mem_alloc() - before
+    finally:
+        gc.enable()
+
+class TestSequentialReader(unittest.TestCase):
+
+    CONTENT = bytes(range(256)) * 40
+
+    def setUp(self):
+        fileutil.rm_recursive(TEST_DIR)
+        write_file(SRC_DIR + "/a.tsv", self.CONTENT)
+        write_file(SRC_DIR + "/b.tsv", b"b" * 100)
+
+    def tearDown(self):
+        fileutil.rm_recursive(TEST_DIR)
+
+    def test_read(self):
+        with fileutil.SequentialReader(bytearray(1000)) as reader:
+            reader.open(SRC_DIR + "/a.tsv", 0)
+            self.assertEqual(bytes(reader.read(10)), self.CONTENT[0:10])
+            # Carries on without a seek
+            f = reader.f
+            reader.open(SRC_DIR + "/a.tsv", 10)
+            self.assertEqual(bytes(reader.read(5000)), self.CONTENT[10:1010])
+            self.assertTrue(reader.f is f)
+            # Seeks back
+            reader.open(SRC_DIR + "/a.tsv", 3)
+            self.assertEqual(bytes(reader.read(3)), self.CONTENT[3:6])
+            # Another file
+            reader.open(SRC_DIR + "/b.tsv", 50)
+            self.assertEqual(bytes(reader.read(1000)), b"b" * 50)
+            self.assertEqual(len(reader.read(1000)), 0)
+        self.assertTrue(reader.f is None)
+
+    def test_chunks(self):
+        with fileutil.SequentialReader(bytearray(1000)) as reader:
+            reader.open(SRC_DIR + "/a.tsv", 500)
+            chunks = [bytes(c) for c in reader.chunks(2600)]
+            self.assertEqual([len(c) for c in chunks], [1000, 1000, 600])
+            self.assertEqual(b"".join(chunks), self.CONTENT[500:3100])
+
+            reader.open(SRC_DIR + "/b.tsv")
+            with self.assertRaises(Exception):
+                for c in reader.chunks(200):
+                    pass
+
+    def test_chunks_do_not_allocate(self):
+        import gc
+        if not hasattr(gc, "mem_alloc"):
+            raise unittest.SkipTest("No gc.mem_alloc in this port")
+        # The counter does see what is allocated
+        kept = []
+        self.assertTrue(heap_allocated(lambda: kept.append(bytearray(1000))) >= 1000)
+
+        def read_chunks(reader, nchunks):
+            reader.open(SRC_DIR + "/a.tsv", 0)
+            chunks = reader.chunks(nchunks * len(reader.buf))
+            next(chunks)
+            def read_rest():
+                for c in chunks:
+                    pass
+            return heap_allocated(read_rest)
+
+        # Reading 38 more chunks costs nothing more: each is a view of the
+        # whole buffer (slices would take 16 bytes or more each)
+        with fileutil.SequentialReader(bytearray(256)) as reader:
+            few = read_chunks(reader, 2)
+            many = read_chunks(reader, 40)
+            self.assertEqual(reader.pos, 40 * 256)
+        self.assertTrue(many - few < 32, "%d bytes more for 38 chunks" % (many - few))
@@ -0,0 +1,62 @@
+import unittest
+import logging
+
+class ListHandler(logging.Handler):
+    def __init__(self, level):
+        self.level = level
+        self.records = []
+
+    def emit(self, level, name, msg, exc=None):
+        self.records.append((level, msg))
+
+class NullStream(object):
+    def write(self, s):
+        pass
+
+class TestDisabledLevels(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (logging._level, logging._stream)
+        logging.basicConfig(level=logging.INFO, stream=NullStream())
+        self.logger = logging.getLogger("test_logging")
+        self.logger.setLevel(logging.NOTSET)
+
+    def tearDown(self):
+        for h in list(self.logger.handlers):
+            self.logger.removeHandler(h)
+        self.logger.setLevel(logging.NOTSET)
+        logging.basicConfig(level=self.saved[0], stream=self.saved[1])
+
+    def test_disabled_methods_are_noops(self):
+        self.assertIs(self.logger.debug, logging._noop)
+        self.assertFalse(self.logger.isEnabledFor(logging.DEBUG))
+        self.assertTrue(self.logger.info is not logging._noop)
+        self.assertTrue(self.logger.isEnabledFor(logging.INFO))
+
+    def test_set_level(self):
+        self.logger.setLevel(logging.DEBUG)
+        self.assertTrue(self.logger.debug is not logging._noop)
+        self.logger.setLevel(logging.ERROR)
+        self.assertIs(self.logger.warning, logging._noop)
+        self.assertTrue(self.logger.error is not logging._noop)
+
+    def test_basic_config(self):
+        logging.basicConfig(level=logging.DEBUG)
+        self.assertTrue(self.logger.isEnabledFor(logging.DEBUG))
+        logging.basicConfig(level=logging.WARNING)
+        self.assertIs(self.logger.info, logging._noop)
+
+    def test_handler_level_enables(self):
+        h = ListHandler(logging.DEBUG)
+        self.logger.addHandler(h)
+        self.logger.debug("to the handler %d", 1)
+        self.assertEqual(h.records, [(logging.DEBUG, "to the handler 1")])
+
+        h.setLevel(logging.WARNING)
+        self.assertIs(self.logger.debug, logging._noop)
+        self.logger.info("to the stream only")
+        self.assertEqual(len(h.records), 1)
+
+        self.logger.removeHandler(h)
+        self.logger.warning("to nobody but the stream")
+        self.assertEqual(len(h.records), 1)
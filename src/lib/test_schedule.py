@@ -153,3 +153,291 @@ class TestScheduleCalculations(unittest.TestCase):
             [parse_time("2020-08-27 03:30:00"), "TakeMeasurement"],
             [parse_time("2020-08-28 03:15:00"), "Communicate"],
             ])
+
+class TestNextSecs(unittest.TestCase):
+
+    def assertSameAsNext(self, sched):
+        start = timeutil.mktime(parse_time("2020-02-28 22:00:00"))
+        for secs in range(start, start + 2 * 24 * 60 * 60, 7 * 60 + 30):
+            for s in [secs, secs - secs % 60]:
+                expected = timeutil.mktime(sched.next(timeutil.localtime(s)))
+                self.assertEqual(sched.next_secs(s), expected, "%s at %s" % (sched, s))
+
+    def test_by_minute(self):
+        self.assertSameAsNext(schedule.ByMinute(5))
+        self.assertSameAsNext(schedule.ByMinute(30))
+        self.assertSameAsNext(schedule.ByMinute(15, offset=2))
+
+    def test_by_minute_uneven(self):
+        self.assertSameAsNext(schedule.ByMinute(7))
+        self.assertSameAsNext(schedule.ByMinute(45, offset=10))
+
+    def test_by_time_of_day(self):
+        self.assertSameAsNext(schedule.ByTimeOfDay(3, 15))
+        self.assertSameAsNext(schedule.ByTimeOfDay(0, 0))
+        self.assertSameAsNext(schedule.ByTimeOfDay(23, 59))
+
+SCHED_CFG = [
+        ["TakeMeasurement", 'minutes', 30, 0],
+        ["Communicate", 'daily', 3, 15],
+        ]
+
+def secs(iso):
+    return timeutil.mktime(parse_time(iso))
+
+class TestTimeline(unittest.TestCase):
+
+    def test_signature(self):
+        sig = schedule.signature(SCHED_CFG)
+        self.assertEqual(sig, schedule.signature([list(rule) for rule in SCHED_CFG]))
+        self.assertTrue(0 <= sig < 2**24)
+        self.assertTrue(sig != schedule.signature(SCHED_CFG[0:1]))
+
+    def test_due_in_minute(self):
+        tl = schedule.Timeline(SCHED_CFG, secs("2020-08-27 07:30:05"))
+        self.assertEqual(tl.due(secs("2020-08-27 07:30:05")), ["TakeMeasurement"])
+        tl = schedule.Timeline(SCHED_CFG, secs("2020-08-27 07:31:00"))
+        self.assertEqual(tl.due(secs("2020-08-27 07:31:00")), [])
+
+    def test_advance(self):
+        tl = schedule.Timeline(SCHED_CFG, secs("2020-08-27 07:30:05"))
+        tl.dirty = []
+        self.assertEqual(tl.advance(secs("2020-08-27 07:30:05")), ["TakeMeasurement"])
+        self.assertEqual(tl.agenda(), [
+            [secs("2020-08-27 08:00:00"), "TakeMeasurement"],
+            [secs("2020-08-28 03:15:00"), "Communicate"],
+            ])
+        self.assertEqual(tl.dirty, [0])
+        self.assertEqual(tl.advance(secs("2020-08-27 07:30:30")), [])
+
+    def test_late_wake(self):
+        tl = schedule.Timeline(SCHED_CFG, secs("2020-08-27 07:29:00"))
+        self.assertEqual(tl.due(secs("2020-08-27 07:33:00")), ["TakeMeasurement"])
+        # Too late; skip it
+        self.assertEqual(tl.advance(secs("2020-08-27 07:40:00")), [])
+        self.assertEqual(tl.agenda()[0], [secs("2020-08-27 08:00:00"), "TakeMeasurement"])
+
+    def test_saved_fires(self):
+        now = secs("2020-08-27 07:30:05")
+        tl = schedule.Timeline(SCHED_CFG, now)
+        tl.advance(now)
+        fires = tl.rule_fires()
+
+        sig = schedule.signature(SCHED_CFG)
+        reloaded = schedule.Timeline(SCHED_CFG, now + 10, fires, sig)
+        self.assertEqual(reloaded.dirty, [])
+        self.assertEqual(reloaded.agenda(), tl.agenda())
+
+        # Clock went back a day: saved times are too far ahead
+        reloaded = schedule.Timeline(SCHED_CFG, now - 24 * 60 * 60, fires, sig)
+        self.assertEqual(sorted(reloaded.dirty), [0, 1])
+        self.assertEqual(reloaded.agenda()[0], [secs("2020-08-26 07:30:00"), "TakeMeasurement"])
+
+        # Saved for another schedule
+        reloaded = schedule.Timeline(SCHED_CFG, now, fires, sig + 1)
+        self.assertEqual(sorted(reloaded.dirty), [0, 1])
+
+    def test_saved_fires_not_compiled(self):
+        now = secs("2020-08-27 07:30:05")
+        cfg = SCHED_CFG + [["Communicate", "cron", "0 12 * * 1-5", {"jitter_mins": 30}]]
+        tl = schedule.Timeline(cfg, now)
+        fires = tl.rule_fires()
+
+        calls = []
+        def counting(cls):
+            orig = cls.next_secs
+            def next_secs(self, secs):
+                calls.append(cls)
+                return orig(self, secs)
+            return orig, next_secs
+        classes = [schedule.ByMinute, schedule.ByTimeOfDay, schedule.Cron]
+        saved = []
+        try:
+            for cls in classes:
+                orig, patched = counting(cls)
+                saved.append(orig)
+                cls.next_secs = patched
+            reloaded = schedule.Timeline(cfg, now + 60, fires, schedule.signature(cfg))
+        finally:
+            for cls, orig in zip(classes, saved):
+                cls.next_secs = orig
+        self.assertEqual(calls, [])
+        self.assertEqual(reloaded.agenda(), tl.agenda())
+
+    def test_many_rules_same_as_check(self):
+        cfg = [["T%02d" % i, 'minutes', [5, 10, 12, 15, 20, 30, 60][i % 7], i % 5] for i in range(35)]
+        cfg += [["D%02d" % i, 'daily', i, 3 * i] for i in range(5)]
+        sched = schedule.Schedule(cfg)
+        now = secs("2020-08-27 00:00:00")
+        tl = schedule.Timeline(cfg, now)
+        end = now + 24 * 60 * 60
+        while now < end:
+            self.assertEqual(tl.advance(now), sched.check(timeutil.localtime(now)))
+            now = tl.agenda()[0][0] + 5
+
+def scan_next(sched, secs):
+    """ The next fire by checking every minute, the slow way """
+    secs = secs - secs % 60 + 60
+    while not sched.check(timeutil.localtime(secs)):
+        secs += 60
+    return secs
+
+class TestPackEntry(unittest.TestCase):
+
+    TASKS = ("TakeMeasurement", "Communicate")
+
+    def test_roundtrip(self):
+        for entry in [
+                ["TakeMeasurement", "minutes", 30, 0],
+                ["Communicate", "daily", 23, 59],
+                ["Communicate", "daily", 3, 15, {"jitter_mins": 30}],
+                ["TakeMeasurement", "minutes", 511, 511, {"jitter_mins": 511}],
+                ]:
+            code = schedule.pack_entry(entry, self.TASKS)
+            self.assertTrue(0 <= code < 2**30)
+            self.assertEqual(schedule.unpack_entry(code, self.TASKS), entry)
+
+    def test_does_not_fit(self):
+        for entry in [
+                ["TakeMeasurement", "cron", "*/10 * * * *"],
+                ["TakeMeasurement", "minutes", 30],
+                ["TakeMeasurement", "minutes", 512, 0],
+                ["Communicate", "daily", 3, 15, {"jitter_mins": 0}],
+                ["Communicate", "daily", 3, 15, {"dates": ["04-01", "09-30"]}],
+                ["Dance", "minutes", 30, 0],
+                ]:
+            self.assertEqual(schedule.pack_entry(entry, self.TASKS), None)
+
+class TestValidate(unittest.TestCase):
+
+    def test_valid(self):
+        schedule.validate(SCHED_CFG, secs("2020-08-27 00:00:00"), tasks=["TakeMeasurement", "Communicate"])
+
+    def test_invalid(self):
+        now = secs("2020-08-27 00:00:00")
+        for cfg in [
+                [],
+                {"TakeMeasurement": 30},
+                [["TakeMeasurement"]],
+                [["TakeMeasurement", "minutes", "x"]],
+                [["TakeMeasurement", "minutes", 30, 0, 1, 2]],
+                [["TakeMeasurement", "cron", "0 0 30 2 *"]],
+                [["Dance", "minutes", 30]],
+                ]:
+            with self.assertRaises(schedule.ScheduleException):
+                schedule.validate(cfg, now, tasks=["TakeMeasurement", "Communicate"])
+
+    def test_required(self):
+        now = secs("2020-08-27 00:00:00")
+        schedule.validate(SCHED_CFG, now, required=["Communicate"])
+        with self.assertRaises(schedule.ScheduleException):
+            schedule.validate([["TakeMeasurement", "minutes", 30]], now, required=["Communicate"])
+
+class TestCron(unittest.TestCase):
+
+    def test_str(self):
+        self.assertEqual(str(schedule.Cron("15 3 * * *")), 'Cron("15 3 * * *")')
+
+    def test_fields(self):
+        sched = schedule.Cron("*/20 1-3,22 5/10 * 7")
+        self.assertEqual(sched.minutes, [0, 20, 40])
+        self.assertEqual(sched.hours, [1, 2, 3, 22])
+        self.assertEqual(sched.days, [5, 15, 25])
+        self.assertEqual(sched.months, list(range(1, 13)))
+        self.assertEqual(sched.weekdays, [0])
+
+    def test_bad_exprs(self):
+        for expr in ["15 3 * *", "60 * * * *", "* 24 * * *", "* * 0 * *", "*/0 * * * *", "a * * * *", "5-1 * * * *"]:
+            with self.assertRaises(schedule.ScheduleException):
+                schedule.Cron(expr)
+
+    def test_daily(self):
+        sched = schedule.Cron("15 3 * * *")
+        self.assertEqual(sched.next_secs(secs("2020-08-27 03:14:59")), secs("2020-08-27 03:15:00"))
+        self.assertEqual(sched.next_secs(secs("2020-08-27 03:15:00")), secs("2020-08-28 03:15:00"))
+        self.assertEqual(sched.next_secs(secs("2020-12-31 12:00:00")), secs("2021-01-01 03:15:00"))
+
+    def test_weekday(self):
+        # 2020-08-27 was a Thursday
+        sched = schedule.Cron("0 12 * * 1")
+        self.assertEqual(sched.next_secs(secs("2020-08-27 12:00:00")), secs("2020-08-31 12:00:00"))
+
+    def test_day_or_weekday(self):
+        # As in cron: the 1st of the month or any Sunday
+        sched = schedule.Cron("0 0 1 * 0")
+        self.assertEqual(sched.next_secs(secs("2020-08-27 00:00:00")), secs("2020-08-30 00:00:00"))
+        self.assertEqual(sched.next_secs(secs("2020-08-30 00:00:00")), secs("2020-09-01 00:00:00"))
+
+    def test_leap_day(self):
+        sched = schedule.Cron("30 6 29 2 *")
+        self.assertEqual(sched.next_secs(secs("2021-03-01 00:00:00")), secs("2024-02-29 06:30:00"))
+
+    def test_never(self):
+        with self.assertRaises(schedule.ScheduleException):
+            schedule.Cron("0 0 30 2 *").next_secs(secs("2020-08-27 00:00:00"))
+
+    def test_same_as_scan(self):
+        exprs = ["*/7 * * * *", "5,35 */6 * * *", "0 9-17 * * 1-5", "45 23 31 * *", "0 0 * 3,9 6", "10 4 15-16 * 0"]
+        for expr in exprs:
+            sched = schedule.Cron(expr)
+            now = secs("2020-02-27 22:00:00")
+            for _ in range(40):
+                expected = scan_next(sched, now)
+                self.assertEqual(sched.next_secs(now), expected, "%s at %s" % (expr, now))
+                now = expected + 17
+
+class TestJitter(unittest.TestCase):
+
+    def test_delay_per_seed(self):
+        delays = [schedule.Jitter(schedule.ByTimeOfDay(3, 15), 1800, ("unit-%d" % i).encode()).delay for i in range(20)]
+        self.assertEqual(delays, [schedule.Jitter(schedule.ByTimeOfDay(3, 15), 1800, ("unit-%d" % i).encode()).delay for i in range(20)])
+        self.assertTrue(all([0 <= d < 1800 for d in delays]))
+        self.assertTrue(len(set(delays)) > 10)
+
+    def test_next_secs(self):
+        sched = schedule.Jitter(schedule.ByTimeOfDay(3, 15), 1800, b"unit-1")
+        fire = secs("2020-08-27 03:15:00") + sched.delay
+        self.assertEqual(sched.next_secs(fire - 1), fire)
+        self.assertEqual(sched.next_secs(fire), fire + 24 * 60 * 60)
+        self.assertTrue(sched.check(timeutil.localtime(fire)))
+        self.assertFalse(sched.check(timeutil.localtime(fire + 60)))
+
+    def test_from_config(self):
+        cfg = [["Communicate", 'daily', 3, 15, {"jitter_mins": 30}]]
+        fires = set()
+        for i in range(10):
+            tl = schedule.Timeline(cfg, secs("2020-08-27 00:00:00"), seed=("unit-%d" % i).encode())
+            fire = tl.agenda()[0][0]
+            self.assertTrue(secs("2020-08-27 03:15:00") <= fire < secs("2020-08-27 03:45:00"))
+            fires.add(fire)
+        self.assertTrue(len(fires) > 5)
+
+    def test_unknown_option(self):
+        with self.assertRaises(schedule.ScheduleException):
+            schedule.Schedule([["Communicate", 'daily', 3, 15, {"jitter": 30}]])
+
+class TestDates(unittest.TestCase):
+
+    def test_summer(self):
+        sched = schedule.Dates(schedule.ByTimeOfDay(12, 0), "04-01", "09-30")
+        self.assertEqual(sched.next_secs(secs("2020-08-27 13:00:00")), secs("2020-08-28 12:00:00"))
+        self.assertEqual(sched.next_secs(secs("2020-09-30 13:00:00")), secs("2021-04-01 12:00:00"))
+        self.assertEqual(sched.next_secs(secs("2021-01-15 13:00:00")), secs("2021-04-01 12:00:00"))
+
+    def test_winter_wraps(self):
+        sched = schedule.Dates(schedule.ByMinute(30), "11-01", "02-28")
+        self.assertEqual(sched.next_secs(secs("2020-12-31 23:45:00")), secs("2021-01-01 00:00:00"))
+        self.assertEqual(sched.next_secs(secs("2021-02-28 23:30:00")), secs("2021-11-01 00:00:00"))
+
+    def test_from_config(self):
+        cfg = [
+                ["TakeMeasurement", 'minutes', 30, 0],
+                ["TakeMeasurement", 'cron', "*/10 * * * *", {"dates": ["06-01", "08-31"]}],
+                ]
+        tl = schedule.Timeline(cfg, secs("2020-05-31 23:55:00"))
+        self.assertEqual(tl.agenda(), [
+            [secs("2020-06-01 00:00:00"), "TakeMeasurement"],
+            [secs("2020-06-01 00:00:00"), "TakeMeasurement"],
+            ])
+        tl = schedule.Timeline(cfg, secs("2020-09-01 00:05:00"))
+        self.assertEqual(tl.agenda()[1], [secs("2021-06-01 00:00:00"), "TakeMeasurement"])
@@ -0,0 +1,117 @@
+import os
+
+import unittest
+import logging
+
+import fileutil
+import seqfile
+
+# Suppress logging
+logging.getLogger("seqfile").setLevel(logging.CRITICAL)
+logging.getLogger("fileutil").setLevel(logging.CRITICAL)
+
+TEST_DIR = "test_tmp_seqfile"
+DATA_DIR = TEST_DIR + "/data"
+INDEX_PATH = TEST_DIR + "/var/index.json"
+MATCH = ("readings-", ".tsv")
+
+def write_file(fpath, nbytes):
+    with open(fpath, "at") as f:
+        f.write("x" * nbytes)
+
+class TestSequenceNames(unittest.TestCase):
+
+    def test_last_file(self):
+        files = ["readings-0001.tsv", "other.txt", "readings-0000.tsv"]
+        self.assertEqual(seqfile.last_file_in_sequence(files, MATCH), "readings-0001.tsv")
+        self.assertEqual(seqfile.last_file_in_sequence(["other.txt"], MATCH), None)
+
+    def test_next_name(self):
+        self.assertEqual(seqfile.next_sequence_filename("readings-0009.tsv", MATCH), "readings-0010.tsv")
+
+class TestAppendIndex(unittest.TestCase):
+
+    def setUp(self):
+        fileutil.rm_recursive(TEST_DIR)
+        fileutil.mkdirs(DATA_DIR)
+
+    def tearDown(self):
+        fileutil.rm_recursive(TEST_DIR)
+
+    def prep(self, size_limit=100):
+        return fileutil.prep_append_file(DATA_DIR, MATCH, size_limit, index_path=INDEX_PATH)
+
+    def test_fresh_dir(self):
+        self.assertEqual(self.prep(), DATA_DIR + "/readings-0000.tsv")
+        self.assertEqual(seqfile.read_append_index(INDEX_PATH), (DATA_DIR, "readings-0000.tsv"))
+
+    def test_index_hit(self):
+        write_file(DATA_DIR + "/readings-0000.tsv", 10)
+        self.prep()
+        self.assertEqual(seqfile.check_append_index(INDEX_PATH, DATA_DIR, MATCH, 100), "readings-0000.tsv")
+
+        # Index is trusted without a listdir, even if a scan would disagree
+        write_file(DATA_DIR + "/readings-0005.tsv", 10)
+        self.assertEqual(self.prep(), DATA_DIR + "/readings-0000.tsv")
+
+    def test_rollover(self):
+        self.prep()
+        write_file(DATA_DIR + "/readings-0000.tsv", 150)
+        self.assertEqual(self.prep(), DATA_DIR + "/readings-0001.tsv")
+        self.assertEqual(seqfile.read_append_index(INDEX_PATH), (DATA_DIR, "readings-0001.tsv"))
+
+        # Next file not written yet, index should still be good
+        self.assertEqual(self.prep(), DATA_DIR + "/readings-0001.tsv")
+
+    def test_stale_next_file_exists(self):
+        self.prep()
+        write_file(DATA_DIR + "/readings-0000.tsv", 10)
+        write_file(DATA_DIR + "/readings-0001.tsv", 10)
+        write_file(DATA_DIR + "/readings-0002.tsv", 10)
+        self.assertEqual(seqfile.check_append_index(INDEX_PATH, DATA_DIR, MATCH, 100), None)
+        self.assertEqual(self.prep(), DATA_DIR + "/readings-0002.tsv")
+        self.assertEqual(seqfile.read_append_index(INDEX_PATH), (DATA_DIR, "readings-0002.tsv"))
+
+    def test_index_has_no_size(self):
+        self.prep()
+        write_file(DATA_DIR + "/readings-0000.tsv", 50)
+        self.prep()
+        with open(INDEX_PATH) as f:
+            self.assertEqual(f.read(), '["%s", "readings-0000.tsv"]' % DATA_DIR)
+        # Indexes from before, with a size, still work
+        with open(INDEX_PATH, "w") as f:
+            f.write('["%s", "readings-0000.tsv", 10]' % DATA_DIR)
+        self.assertEqual(seqfile.check_append_index(INDEX_PATH, DATA_DIR, MATCH, 100), "readings-0000.tsv")
+
+    def test_stale_file_removed(self):
+        write_file(DATA_DIR + "/readings-0001.tsv", 50)
+        write_file(DATA_DIR + "/readings-0003.tsv", 50)
+        self.prep()
+        os.remove(DATA_DIR + "/readings-0003.tsv")
+        self.assertEqual(self.prep(), DATA_DIR + "/readings-0001.tsv")
+
+    def test_tag(self):
+        self.prep()
+        seqfile.save_append_index(INDEX_PATH, DATA_DIR, "readings-0000.tsv", "hdr1")
+        self.assertEqual(seqfile.read_append_index(INDEX_PATH), (DATA_DIR, "readings-0000.tsv"))
+        self.assertEqual(seqfile.check_append_index(INDEX_PATH, DATA_DIR, MATCH, 100, tag="hdr1"), "readings-0000.tsv")
+        self.assertEqual(seqfile.check_append_index(INDEX_PATH, DATA_DIR, MATCH, 100, tag="hdr2"), None)
+        # Writers without a tag still use the index
+        self.assertEqual(seqfile.check_append_index(INDEX_PATH, DATA_DIR, MATCH, 100), "readings-0000.tsv")
+
+        # The tag goes on to the next file
+        write_file(DATA_DIR + "/readings-0000.tsv", 150)
+        self.assertEqual(seqfile.check_append_index(INDEX_PATH, DATA_DIR, MATCH, 100, tag="hdr1"), "readings-0001.tsv")
+        self.assertEqual(seqfile.check_append_index(INDEX_PATH, DATA_DIR, MATCH, 100, tag="hdr1"), "readings-0001.tsv")
+
+    def test_index_for_other_dir(self):
+        self.prep()
+        self.assertEqual(seqfile.check_append_index(INDEX_PATH, TEST_DIR + "/other", MATCH, 100), None)
+
+    def test_corrupt_index(self):
+        write_file(DATA_DIR + "/readings-0002.tsv", 10)
+        fileutil.mkdirs(fileutil.dirname(INDEX_PATH))
+        with open(INDEX_PATH, "w") as f:
+            f.write("{not json")
+        self.assertEqual(self.prep(), DATA_DIR + "/readings-0002.tsv")
+        self.assertEqual(seqfile.read_append_index(INDEX_PATH), (DATA_DIR, "readings-0002.tsv"))
@@ -4,6 +4,11 @@ import utime
 
 import timeutil
 
+try:
+    import calendar
+except ImportError:
+    calendar = None
+
 class TestParseAndFormat(unittest.TestCase):
 
     def test_parse_time(self):
@@ -60,3 +65,59 @@ class TestCalendarFns(unittest.TestCase):
         self.rollover_trial(
                 (2020,12,31,23,59,60,0,0),
                 (2021,1,1,0,0,0,0,0))
+
+class TestClosedFormCalendar(unittest.TestCase):
+
+    def test_known_time(self):
+        self.assertEqual(timeutil.utc_mktime((2020, 8, 27, 1, 53, 24, 0, 0)), 1598493204)
+        # Thursday, 240th day of a leap year
+        self.assertEqual(timeutil.utc_localtime(1598493204), (2020, 8, 27, 1, 53, 24, 3, 240))
+        self.assertEqual(timeutil.utc_localtime(0), (1970, 1, 1, 0, 0, 0, 3, 1))
+
+    def test_rollover(self):
+        for tti, tte in [
+                [(2020, 12, 31, 23, 59, 60), (2021, 1, 1, 0, 0, 0)],
+                [(2020, 2, 30, 0, 0, 0), (2020, 3, 1, 0, 0, 0)],
+                [(2020, 3, 0, 0, 0, 0), (2020, 2, 29, 0, 0, 0)],
+                [(2021, 0, 1, 0, 0, 0), (2020, 12, 1, 0, 0, 0)],
+                [(2020, 26, 1, 0, 0, 0), (2022, 2, 1, 0, 0, 0)],
+                [(2020, 8, 27, 1, 70, 0), (2020, 8, 27, 2, 10, 0)],
+                ]:
+            self.assertEqual(timeutil.utc_localtime(timeutil.utc_mktime(tti))[0:6], tte)
+
+    def test_every_day_1970_to_2100(self):
+        # Walk the calendar one day at a time
+        days = 0
+        wd = 3
+        yd = 1
+        yy, mo, dd = 1970, 1, 1
+        while yy <= 2100:
+            ts = days * 86400 + 45296
+            tt = (yy, mo, dd, 12, 34, 56, wd, yd)
+            self.assertEqual(timeutil.days_from_civil(yy, mo, dd), days)
+            self.assertEqual(timeutil.civil_from_days(days), (yy, mo, dd))
+            self.assertEqual(timeutil.utc_mktime(tt), ts)
+            self.assertEqual(timeutil.utc_localtime(ts), tt)
+
+            days += 1
+            wd = (wd + 1) % 7
+            yd += 1
+            dd += 1
+            if dd > timeutil.days_in_month(yy, mo):
+                dd = 1
+                mo += 1
+            if mo > 12:
+                mo = 1
+                yy += 1
+                yd = 1
+
+    @unittest.skipIf(calendar is None, "No calendar module (CPython only)")
+    def test_every_day_against_calendar(self):
+        for yy in range(1970, 2101):
+            self.assertEqual(timeutil.isleapyear(yy), calendar.isleap(yy))
+            for mo in range(1, 13):
+                for dd in range(1, calendar.monthrange(yy, mo)[1] + 1):
+                    tt = (yy, mo, dd, 23, 59, 59)
+                    ts = calendar.timegm(tt)
+                    self.assertEqual(timeutil.utc_mktime(tt), ts)
+                    self.assertEqual(timeutil.utc_localtime(ts)[0:7], tt + (calendar.weekday(yy, mo, dd),))
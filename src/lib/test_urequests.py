@@ -0,0 +1,291 @@
+import gc
+import unittest
+
+import urequests
+
+class FakeSocket(object):
+    """ Socket that answers from a list of canned responses """
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.sent = b""
+        self.closed = False
+        self._rx = b""
+        self._pos = 0
+        self.max_read = 0
+
+    def connect(self, addr):
+        pass
+
+    def write(self, b):
+        if self.closed:
+            raise OSError("write to closed socket")
+        if isinstance(b, str):
+            b = b.encode()
+        self.sent += bytes(b)
+        # A blank line ends the request head; queue up the next response
+        if self.sent.endswith(b"\r\n\r\n") and not self._unread() and self.responses:
+            self._rx = self.responses.pop(0)
+            self._pos = 0
+        return len(b)
+
+    def _unread(self):
+        return len(self._rx) - self._pos
+
+    def _take(self, n):
+        # Slices only what is asked for, so reads do not copy the whole response
+        data = self._rx[self._pos:self._pos+n]
+        self._pos += len(data)
+        return data
+
+    def readline(self):
+        pos = self._rx.find(b"\n", self._pos)
+        pos = len(self._rx) if pos == -1 else pos + 1
+        return self._take(pos - self._pos)
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            n = self._unread()
+        return self._take(n)
+
+    def readinto(self, buf):
+        n = min(len(buf), self._unread())
+        self.max_read = max(self.max_read, len(buf))
+        buf[:n] = memoryview(self._rx)[self._pos:self._pos+n]
+        self._pos += n
+        return n
+
+    def close(self):
+        self.closed = True
+
+class FakeUsocket(object):
+
+    def __init__(self):
+        self.sockets = []
+        self.lookups = 0
+        self.next_responses = []
+
+    def getaddrinfo(self, host, port):
+        self.lookups += 1
+        return [(0, 0, 0, "", (host, port))]
+
+    def socket(self, *args):
+        s = FakeSocket(self.next_responses)
+        self.next_responses = []
+        self.sockets.append(s)
+        return s
+
+def response(body, headers=b"", version=b"HTTP/1.1", status=b"200 OK"):
+    return version + b" " + status + b"\r\n" + headers \
+            + b"Content-Length: %d\r\n\r\n" % len(body) + body
+
+class TestKeepAlivePool(unittest.TestCase):
+
+    def setUp(self):
+        self.real_usocket = urequests.usocket
+        self.usocket = FakeUsocket()
+        urequests.usocket = self.usocket
+        urequests.close_pool()
+        urequests.clear_dns_cache()
+
+    def tearDown(self):
+        urequests.close_pool()
+        urequests.clear_dns_cache()
+        urequests.usocket = self.real_usocket
+
+    def test_no_keep_alive(self):
+        self.usocket.next_responses = [b"HTTP/1.0 200 OK\r\n\r\nhello"]
+        resp = urequests.request("GET", "http://example.com/a")
+        self.assertEqual(resp.content, b"hello")
+        self.assertTrue(self.usocket.sockets[0].closed)
+        self.assertIn(b"GET /a HTTP/1.0\r\n", self.usocket.sockets[0].sent)
+
+    def test_reuse_connection(self):
+        self.usocket.next_responses = [response(b"one"), response(b"two")]
+        resp = urequests.request("GET", "http://example.com:8080/a", keep_alive=True)
+        self.assertEqual(resp.content, b"one")
+        resp = urequests.request("PUT", "http://example.com:8080/b", data=b"xyz", keep_alive=True)
+        self.assertEqual(resp.content, b"two")
+
+        self.assertEqual(len(self.usocket.sockets), 1)
+        self.assertEqual(self.usocket.lookups, 1)
+        self.assertFalse(self.usocket.sockets[0].closed)
+        self.assertIn(b"PUT /b HTTP/1.1\r\n", self.usocket.sockets[0].sent)
+
+    def test_server_closes(self):
+        self.usocket.next_responses = [response(b"one", b"Connection: close\r\n")]
+        urequests.request("GET", "http://example.com/a", keep_alive=True).content
+        self.assertTrue(self.usocket.sockets[0].closed)
+
+        self.usocket.next_responses = [response(b"two")]
+        resp = urequests.request("GET", "http://example.com/a", keep_alive=True)
+        self.assertEqual(resp.content, b"two")
+        self.assertEqual(len(self.usocket.sockets), 2)
+        # DNS is still cached
+        self.assertEqual(self.usocket.lookups, 1)
+
+    def test_unread_response_not_pooled(self):
+        self.usocket.next_responses = [response(b"one")]
+        resp = urequests.request("GET", "http://example.com/a", keep_alive=True)
+        resp.close()
+        self.assertTrue(self.usocket.sockets[0].closed)
+        self.assertEqual(urequests._pool, {})
+
+    def test_chunked(self):
+        self.usocket.next_responses = [
+                b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+                b"3\r\nabc\r\n4;ext=1\r\ndefg\r\n0\r\n\r\n"]
+        resp = urequests.request("GET", "http://example.com/a", keep_alive=True)
+        self.assertEqual(resp.content, b"abcdefg")
+        self.assertEqual(len(urequests._pool), 1)
+
+    def test_retry_dead_pooled_connection(self):
+        self.usocket.next_responses = [response(b"one")]
+        urequests.request("GET", "http://example.com/a", keep_alive=True).content
+        # Server drops the idle connection
+        self.usocket.sockets[0].closed = True
+
+        self.usocket.next_responses = [response(b"two")]
+        resp = urequests.request("GET", "http://example.com/a", keep_alive=True)
+        self.assertEqual(resp.content, b"two")
+        self.assertEqual(len(self.usocket.sockets), 2)
+
+    def test_retry_streamed_body_before_started(self):
+        self.usocket.next_responses = [response(b"one")]
+        urequests.request("GET", "http://example.com/a", keep_alive=True).content
+        # Dead connection fails on the head write, before the body is taken
+        self.usocket.sockets[0].closed = True
+
+        self.usocket.next_responses = [response(b"two")]
+        body = iter([b"ab", b"cd"])
+        resp = urequests.request("PUT", "http://example.com/a", data=body,
+                headers={"Content-Length": "4"}, keep_alive=True)
+        self.assertEqual(resp.content, b"two")
+        self.assertTrue(self.usocket.sockets[1].sent.endswith(b"\r\n\r\nabcd"))
+
+    def test_no_retry_streamed_body_once_started(self):
+        self.usocket.next_responses = [response(b"one")]
+        urequests.request("GET", "http://example.com/a", keep_alive=True).content
+        sock = self.usocket.sockets[0]
+
+        def body():
+            yield b"ab"
+            # Connection dies mid-body
+            sock.closed = True
+            yield b"cd"
+        with self.assertRaises(OSError):
+            urequests.request("PUT", "http://example.com/a", data=body(),
+                    headers={"Content-Length": "4"}, keep_alive=True)
+        self.assertEqual(len(self.usocket.sockets), 1)
+
+    def test_idle_cap(self):
+        for host in ["a.com", "b.com", "c.com"]:
+            self.usocket.next_responses = [response(b"x")]
+            urequests.request("GET", "http://%s/" % host, keep_alive=True).content
+        self.assertEqual(len(urequests._pool), urequests.POOL_MAX_IDLE)
+        self.assertEqual(len([s for s in self.usocket.sockets if not s.closed]), urequests.POOL_MAX_IDLE)
+
+    def test_idle_timeout(self):
+        self.usocket.next_responses = [response(b"x")]
+        urequests.request("GET", "http://example.com/", keep_alive=True).content
+        key = list(urequests._pool.keys())[0]
+        s, released = urequests._pool[key]
+        urequests._pool[key] = (s, released - urequests.POOL_IDLE_MS - 1000)
+
+        self.usocket.next_responses = [response(b"y")]
+        urequests.request("GET", "http://example.com/", keep_alive=True).content
+        self.assertTrue(self.usocket.sockets[0].closed)
+        self.assertEqual(len(self.usocket.sockets), 2)
+
+class CountingFile(object):
+    """ Write-only file that keeps a count instead of the data """
+
+    def __init__(self, max_write=None):
+        self.nbytes = 0
+        self.max_write = max_write
+        self.mem_peak = 0
+
+    def write(self, b):
+        n = len(b) if self.max_write is None else min(len(b), self.max_write)
+        self.nbytes += n
+        if hasattr(gc, "mem_alloc"):
+            self.mem_peak = max(self.mem_peak, gc.mem_alloc())
+        return n
+
+class TestStreamingResponse(unittest.TestCase):
+
+    def setUp(self):
+        self.real_usocket = urequests.usocket
+        self.usocket = FakeUsocket()
+        urequests.usocket = self.usocket
+        urequests.close_pool()
+
+    def tearDown(self):
+        urequests.close_pool()
+        urequests.clear_dns_cache()
+        urequests.usocket = self.real_usocket
+
+    def test_readinto(self):
+        self.usocket.next_responses = [response(b"abcdefg")]
+        resp = urequests.request("GET", "http://example.com/a", keep_alive=True)
+        buf = bytearray(3)
+        got = []
+        while True:
+            n = resp.readinto(buf)
+            if not n: break
+            got.append(bytes(buf[:n]))
+        self.assertEqual(got, [b"abc", b"def", b"g"])
+        # Whole body read, connection goes back to the pool
+        self.assertEqual(len(urequests._pool), 1)
+
+    def test_readinto_chunked(self):
+        self.usocket.next_responses = [
+                b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+                b"5\r\nabcde\r\n2\r\nfg\r\n0\r\n\r\n"]
+        resp = urequests.request("GET", "http://example.com/a", keep_alive=True)
+        f = CountingFile()
+        self.assertEqual(resp.save_to(f, bytearray(4)), 7)
+        self.assertEqual(self.usocket.sockets[0].max_read, 4)
+        self.assertEqual(len(urequests._pool), 1)
+
+    def test_short_body(self):
+        self.usocket.next_responses = [response(b"abcdefg")[:-2]]
+        resp = urequests.request("GET", "http://example.com/a", keep_alive=True)
+        with self.assertRaises(OSError):
+            resp.save_to(CountingFile(), bytearray(4))
+        self.assertTrue(self.usocket.sockets[0].closed)
+        self.assertEqual(urequests._pool, {})
+
+    def test_short_writes(self):
+        self.usocket.next_responses = [response(b"x" * 100)]
+        resp = urequests.request("GET", "http://example.com/a")
+        f = CountingFile(max_write=7)
+        self.assertEqual(resp.save_to(f, bytearray(32)), 100)
+        self.assertEqual(f.nbytes, 100)
+
+    def test_content_range(self):
+        self.usocket.next_responses = [response(b"defg",
+            b"Content-Range: bytes 3-6/7\r\n", status=b"206 Partial Content")]
+        resp = urequests.request("GET", "http://example.com/a", headers={"Range": "bytes=3-"})
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp.range_start, 3)
+        self.assertEqual(resp.content, b"defg")
+
+    def test_memory_high_water(self):
+        body_size = 64 * 1024
+        buf_size = 1024
+        self.usocket.next_responses = [response(b"x" * body_size)]
+        resp = urequests.request("GET", "http://example.com/a")
+        buf = bytearray(buf_size)
+        f = CountingFile()
+
+        gc.collect()
+        if hasattr(gc, "mem_alloc"):
+            before = gc.mem_alloc()
+        self.assertEqual(resp.save_to(f, buf), body_size)
+
+        # Never asks the socket for more than one buffer at a time
+        self.assertEqual(self.usocket.sockets[0].max_read, buf_size)
+        # And the heap never grows by anything near the size of the body
+        if hasattr(gc, "mem_alloc"):
+            self.assertTrue(f.mem_peak - before < body_size // 4)
@@ -40,6 +40,63 @@ def days_in_month(yy, mo):
         yy += 1
     return mon_days[mo]
 
+# Closed-form conversions between dates and days since 1970-01-01 in the
+# proleptic Gregorian calendar (Howard Hinnant's days_from_civil and
+# civil_from_days). Years are counted from March, so that the leap day is
+# the last day of the year. An era is 400 years, 146097 days.
+
+def days_from_civil(yy, mo, dd):
+    yy -= mo <= 2
+    era = yy // 400
+    yoe = yy - era * 400
+    doy = (153 * (mo - 3 if mo > 2 else mo + 9) + 2) // 5 + dd - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+def civil_from_days(days):
+    days += 719468
+    era = days // 146097
+    doe = days - era * 146097
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy + 2) // 153
+    dd = doy - (153 * mp + 2) // 5 + 1
+    mo = mp + 3 if mp < 10 else mp - 9
+    return (yoe + era * 400 + (mo <= 2), mo, dd)
+
+# Days before the first of each month, in a common year
+_DAYS_BEFORE_MONTH = (None, 0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334)
+
+# [year, days] of the last year asked for.
+# Nearly every call in a wake is for the same year.
+_year_start = [1970, 0]
+
+def year_start(yy):
+    """ Days since 1970-01-01 of January 1 of the year """
+    if _year_start[0] != yy:
+        _year_start[1] = days_from_civil(yy, 1, 1)
+        _year_start[0] = yy
+    return _year_start[1]
+
+def utc_mktime(tt):
+    """ Like utime.mktime on the device: seconds since 1970, no time zone
+
+    Fields out of range roll over, e.g. minute 70 is 10 past the next hour.
+    """
+    yy, mo, dd, hh, mm, ss, *_ = tt
+    yy += (mo - 1) // 12
+    mo = (mo - 1) % 12 + 1
+    days = year_start(yy) + _DAYS_BEFORE_MONTH[mo] + (mo > 2 and isleapyear(yy))
+    return (days + dd - 1) * 86400 + hh * 3600 + mm * 60 + ss
+
+def utc_localtime(ts):
+    """ Like utime.localtime on the device: weekday 0 is Monday, yearday from 1 """
+    days, ts = divmod(ts, 86400)
+    yy, mo, dd = civil_from_days(days)
+    # 1970-01-01 was a Thursday
+    return (yy, mo, dd, ts // 3600, ts // 60 % 60, ts % 60,
+            (days + 3) % 7, days - year_start(yy) + 1)
+
 def mktime(tt):
     "Convert time tuple to seconds offset"
     if hasattr(time, "mktime"):
@@ -47,22 +104,7 @@ def mktime(tt):
         return time.mktime(tt)
     else:
         # Implement if not available (e.g. vanilla MicroPython's Unix port)
-        yy, mo, dd, hh, mm, ss, *_ = tt
-
-        epoch = 1970
-        ts = (yy-epoch) * 365 * 24 * 60 * 60
-        for year in range(epoch,yy):
-            if isleapyear(year):
-                ts += 24*60*60
-
-        for month in range(1,mo):
-            ts += days_in_month(yy,month) * 24 * 60 * 60
-
-        ts += (dd-1) * 24 * 60 * 60
-        ts += hh * 60 * 60
-        ts += mm * 60
-        ts += ss
-        return ts
+        return utc_mktime(tt)
 
 def localtime(ts):
     if hasattr(time, "mktime"):
@@ -73,35 +115,7 @@ def localtime(ts):
         # into account the system's time zone including DST.
         # If we want it to mirror the primitive implementation of mktime,
         # we have to write a matching primitive version of localtime
-        yy = 1970
-        while True:
-            yeardays = 366 if isleapyear(yy) else 365
-            yearsecs = yeardays * 24 * 60 * 60
-            if ts < yearsecs:
-                break
-            ts -= yearsecs
-            yy += 1
-
-        mo = 1
-        while True:
-            monsecs = days_in_month(yy, mo) * 24 * 60 * 60
-            if ts < monsecs:
-                break
-            ts -= monsecs
-            mo += 1
-
-        daysecs = 24 * 60 * 60
-        dd = 1 + ts // daysecs
-        ts = ts % daysecs
-
-        hoursecs = 60 * 60
-        hh = ts // hoursecs
-        ts = ts % hoursecs
-
-        mm = ts // 60
-        ss = ts % 60
-
-        return (yy, mo, dd, hh, mm, ss, 0, 0)
+        return utc_localtime(ts)
 
 def normalize(tt):
     return localtime(mktime(tt))
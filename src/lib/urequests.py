@@ -10,9 +10,107 @@
 #
 # - Changed getattrinfo call to be compatibile with Pycom firmware
 #   (2 arguments instead of 4)
+# - Accept an iterator of buffers as data, to stream a request body
+#   (caller must give Content-Length in headers)
+# - Close the socket on any exception while sending, not just OSError
+# - Send the request head with a single write
+# - Optional HTTP/1.1 keep-alive (keep_alive=True), with a small pool of idle
+#   connections and a DNS cache. Responses are read by Content-Length
+#   (or chunked encoding) so that the connection can be reused.
+# - Streaming responses: Response.readinto() and Response.save_to() read the
+#   body through a caller's buffer, without holding all of it in memory.
+#   Content-Range start is available as Response.range_start.
+# - A pooled connection that the server has closed is dropped before reuse.
+#   A request whose send fails on a pooled connection is retried once on a
+#   new one, if none of a streamed body has been taken yet.
 #
 
 import usocket
+import utime
+
+# Connection pool
+# --------------------------------------------------
+
+# Max number of idle connections to keep open
+POOL_MAX_IDLE = 2
+# Idle connections older than this are closed instead of reused
+POOL_IDLE_MS = 10000
+
+_dns_cache = {}     # (host, port) -> getaddrinfo entry
+_pool = {}          # (proto, host, port) -> (socket, ticks_ms when released)
+
+def _getaddr(host, port):
+    key = (host, port)
+    ai = _dns_cache.get(key)
+    if ai is None:
+        ai = usocket.getaddrinfo(host, port)[0]
+        _dns_cache[key] = ai
+    return ai
+
+def _connect(proto, host, port):
+    ai = _getaddr(host, port)
+    s = usocket.socket(ai[0], ai[1], ai[2])
+    try:
+        # Head and body go out in separate writes. On a reused connection,
+        # Nagle would hold the body back until the server ACKs the head.
+        nodelay = getattr(usocket, "TCP_NODELAY", None)
+        if nodelay is not None:
+            s.setsockopt(usocket.IPPROTO_TCP, nodelay, 1)
+        s.connect(ai[-1])
+        if proto == "https:":
+            import ussl
+            s = ussl.wrap_socket(s, server_hostname=host)
+    except:
+        s.close()
+        # Address may be stale
+        _dns_cache.pop((host, port), None)
+        raise
+    return s
+
+def _dropped(s):
+    """ True if an idle connection has something to read, i.e. the server closed it """
+    try:
+        import uselect
+        p = uselect.poll()
+        p.register(s, uselect.POLLIN)
+        return bool(p.poll(0))
+    except Exception:
+        # Cannot tell (e.g. no poll for this socket). The send will show.
+        return False
+
+def _take_pooled(key):
+    entry = _pool.pop(key, None)
+    if entry is None:
+        return None
+    s, released = entry
+    if utime.ticks_diff(utime.ticks_ms(), released) > POOL_IDLE_MS or _dropped(s):
+        s.close()
+        return None
+    return s
+
+def _release(key, s):
+    old = _pool.pop(key, None)
+    if old:
+        old[0].close()
+    while len(_pool) >= POOL_MAX_IDLE:
+        _, (other, _) = _pool.popitem()
+        other.close()
+    _pool[key] = (s, utime.ticks_ms())
+
+def close_pool():
+    """ Closes all idle connections, e.g. before the network goes down """
+    while _pool:
+        _, (s, _) = _pool.popitem()
+        try:
+            s.close()
+        except OSError:
+            pass
+
+def clear_dns_cache():
+    _dns_cache.clear()
+
+# Requests and responses
+# --------------------------------------------------
 
 class Response:
 
@@ -20,6 +118,15 @@ class Response:
         self.raw = f
         self.encoding = "utf-8"
         self._cached = None
+        # Set by request() from the response headers
+        self._length = None
+        self._chunked = False
+        self._persistent = False
+        self.range_start = None
+        # Where to return the connection after reading, if persistent
+        self._pool_key = None
+        # Body bytes not yet read: of the whole body, or of the current chunk
+        self._left = None
 
     def close(self):
         if self.raw:
@@ -27,16 +134,118 @@ class Response:
             self.raw = None
         self._cached = None
 
+    def _finish(self, complete):
+        if complete and self._pool_key:
+            _release(self._pool_key, self.raw)
+        else:
+            self.raw.close()
+        self.raw = None
+
+    def _read_exact(self, n):
+        parts = []
+        while n > 0:
+            part = self.raw.read(n)
+            if not part:
+                raise OSError("Connection closed with %d bytes left" % n)
+            parts.append(part)
+            n -= len(part)
+        return b"".join(parts)
+
+    def _chunk_size(self):
+        size = int(self.raw.readline().split(b";")[0].strip(), 16)
+        if size == 0:
+            # Trailers, if any, end with an empty line
+            while self.raw.readline() not in (b"\r\n", b""):
+                pass
+        return size
+
+    def _read_chunked(self):
+        parts = []
+        while True:
+            size = self._chunk_size()
+            if size == 0:
+                break
+            parts.append(self._read_exact(size))
+            self.raw.readline()
+        return b"".join(parts)
+
     @property
     def content(self):
         if self._cached is None:
+            done = False
             try:
-                self._cached = self.raw.read()
+                if self._chunked:
+                    self._cached = self._read_chunked()
+                elif self._length is not None:
+                    self._cached = self._read_exact(self._length)
+                else:
+                    self._cached = self.raw.read()
+                done = True
             finally:
-                self.raw.close()
-                self.raw = None
+                self._finish(done)
         return self._cached
 
+    def _readinto(self, mv):
+        if self._chunked:
+            if not self._left:
+                self._left = self._chunk_size()
+                if not self._left:
+                    return 0
+        elif self._length is not None:
+            if self._left is None:
+                self._left = self._length
+            if not self._left:
+                return 0
+        n = len(mv) if self._left is None else min(len(mv), self._left)
+        n = self.raw.readinto(mv[:n])
+        if not n:
+            if self._left is None:
+                return 0    # Body ends when the server closes
+            raise OSError("Connection closed with %d bytes left" % self._left)
+        if self._left is not None:
+            self._left -= n
+            if self._chunked and not self._left:
+                self.raw.readline()
+        return n
+
+    def readinto(self, buf):
+        """ Reads the next part of the body into buf, instead of content
+
+        Returns the number of bytes read, 0 at the end of the body.
+        Raises OSError if the connection closes before Content-Length bytes.
+        """
+        if self.raw is None:
+            return 0
+        done = False
+        try:
+            n = self._readinto(memoryview(buf))
+            done = True
+        finally:
+            if not done:
+                self._finish(False)
+        if not n:
+            self._finish(True)
+        return n
+
+    def save_to(self, f, buf, callback=None):
+        """ Writes the body to file f through buf, returns bytes written
+
+        Only one buffer of the body is in memory at a time.
+        callback, if given, is called after each write (e.g. to feed a watchdog).
+        """
+        mv = memoryview(buf)
+        total = 0
+        while True:
+            n = self.readinto(mv)
+            if not n:
+                return total
+            written = 0
+            while written < n:
+                written += f.write(mv[written:n])
+            total += n
+            if callback:
+                callback()
+
     @property
     def text(self):
         return str(self.content, self.encoding)
@@ -46,7 +255,90 @@ class Response:
         return ujson.loads(self.content)
 
 
-def request(method, url, data=None, json=None, headers={}, stream=None):
+def _send_and_read_head(s, method, host, path, data, json, headers, keep_alive):
+    # Build the head in one buffer and send it with one write, so that it
+    # goes out in as few packets as possible
+    head = b"%s /%s HTTP/1.%d\r\n" % (method, path, 1 if keep_alive else 0)
+    if not "Host" in headers:
+        head += b"Host: %s\r\n" % host
+    if keep_alive and not "Connection" in headers:
+        head += b"Connection: keep-alive\r\n"
+    # Iterate over keys to avoid tuple alloc
+    for k in headers:
+        head += b"%s: %s\r\n" % (k, headers[k])
+    if json is not None:
+        assert data is None
+        import ujson
+        data = ujson.dumps(json)
+        head += b"Content-Type: application/json\r\n"
+    # An iterator of buffers is streamed as-is, with the caller's Content-Length
+    streamed = data is not None and getattr(data, "__next__", None) is not None
+    if streamed:
+        assert "Content-Length" in headers, "Streamed data needs Content-Length"
+    elif data:
+        head += b"Content-Length: %d\r\n" % len(data)
+    head += b"\r\n"
+    s.write(head)
+    if streamed:
+        for chunk in data:
+            s.write(chunk)
+    elif data:
+        s.write(data)
+
+    l = s.readline()
+    if not l:
+        raise OSError("Connection closed before response")
+    #print(l)
+    l = l.split(None, 2)
+    status = int(l[1])
+    reason = ""
+    if len(l) > 2:
+        reason = l[2].rstrip()
+
+    resp = Response(s)
+    resp.status_code = status
+    resp.reason = reason
+    # HTTP/1.1 responses are persistent unless they say otherwise
+    persistent = keep_alive and l[0] == b"HTTP/1.1"
+
+    while True:
+        l = s.readline()
+        if not l or l == b"\r\n":
+            break
+        #print(l)
+        ll = l.lower()
+        if ll.startswith(b"transfer-encoding:"):
+            if b"chunked" in ll:
+                resp._chunked = True
+        elif ll.startswith(b"content-length:"):
+            resp._length = int(l[15:].strip())
+        elif ll.startswith(b"content-range:"):
+            # Content-Range: bytes <start>-<end>/<total>
+            rng = l[14:].strip().split(None, 1)[-1]
+            if rng[0:1] != b"*":
+                resp.range_start = int(rng.split(b"-", 1)[0])
+        elif ll.startswith(b"connection:"):
+            if b"close" in ll:
+                persistent = False
+            elif b"keep-alive" in ll and keep_alive:
+                persistent = True
+        elif ll.startswith(b"location:") and not 200 <= status <= 299:
+            raise NotImplementedError("Redirects not yet supported")
+
+    if method == "HEAD" or status == 204 or status == 304:
+        resp._length = 0
+    # Without a known length, the body ends when the server closes
+    if not resp._chunked and resp._length is None:
+        persistent = False
+    resp._persistent = persistent
+    return resp
+
+def _track_started(data, started):
+    for chunk in data:
+        started[0] = True
+        yield chunk
+
+def request(method, url, data=None, json=None, headers={}, stream=None, keep_alive=False):
     try:
         proto, dummy, host, path = url.split("/", 3)
     except ValueError:
@@ -55,7 +347,6 @@ def request(method, url, data=None, json=None, headers={}, stream=None):
     if proto == "http:":
         port = 80
     elif proto == "https:":
-        import ussl
         port = 443
     else:
         raise ValueError("Unsupported protocol: " + proto)
@@ -64,58 +355,34 @@ def request(method, url, data=None, json=None, headers={}, stream=None):
         host, port = host.split(":", 1)
         port = int(port)
 
-    ai = usocket.getaddrinfo(host, port)
-    ai = ai[0]
+    key = (proto, host, port)
+    s = _take_pooled(key) if keep_alive else None
+    retry = s is not None
+    # A streamed body can only be sent once. If the pooled connection fails
+    # after the first chunk was taken, the request cannot be retried.
+    started = [False]
+    if retry and getattr(data, "__next__", None) is not None:
+        data = _track_started(data, started)
 
-    s = usocket.socket(ai[0], ai[1], ai[2])
-    try:
-        s.connect(ai[-1])
-        if proto == "https:":
-            s = ussl.wrap_socket(s, server_hostname=host)
-        s.write(b"%s /%s HTTP/1.0\r\n" % (method, path))
-        if not "Host" in headers:
-            s.write(b"Host: %s\r\n" % host)
-        # Iterate over keys to avoid tuple alloc
-        for k in headers:
-            s.write(k)
-            s.write(b": ")
-            s.write(headers[k])
-            s.write(b"\r\n")
-        if json is not None:
-            assert data is None
-            import ujson
-            data = ujson.dumps(json)
-            s.write(b"Content-Type: application/json\r\n")
-        if data:
-            s.write(b"Content-Length: %d\r\n" % len(data))
-        s.write(b"\r\n")
-        if data:
-            s.write(data)
+    while True:
+        if s is None:
+            s = _connect(proto, host, port)
+        try:
+            resp = _send_and_read_head(s, method, host, path, data, json, headers, keep_alive)
+            break
+        except OSError:
+            s.close()
+            s = None
+            if not retry or started[0]:
+                raise
+            # Server probably closed the idle connection. Try once more.
+            retry = False
+        except Exception:
+            s.close()
+            raise
 
-        l = s.readline()
-        #print(l)
-        l = l.split(None, 2)
-        status = int(l[1])
-        reason = ""
-        if len(l) > 2:
-            reason = l[2].rstrip()
-        while True:
-            l = s.readline()
-            if not l or l == b"\r\n":
-                break
-            #print(l)
-            if l.startswith(b"Transfer-Encoding:"):
-                if b"chunked" in l:
-                    raise ValueError("Unsupported " + l)
-            elif l.startswith(b"Location:") and not 200 <= status <= 299:
-                raise NotImplementedError("Redirects not yet supported")
-    except OSError:
-        s.close()
-        raise
-
-    resp = Response(s)
-    resp.status_code = status
-    resp.reason = reason
+    if resp._persistent:
+        resp._pool_key = key
     return resp
 
 
@@ -17,6 +17,14 @@ Note that the hw object does not actually touch the hardware unless we start
 accessing its members.
 """
 
+import sys
+
+# Modules in /flash/lib win over those frozen into the firmware (make frozen),
+# so code updates take effect. Without frozen modules, it finds them sooner.
+if "/flash/lib" in sys.path:
+    sys.path.remove("/flash/lib")
+    sys.path.insert(0, "/flash/lib")
+
 import co2unit_main2 as main
 
 with main.MainWrapper():
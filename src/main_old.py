@@ -98,7 +98,9 @@ except Exception as e:
     # Attempt to record exception
     try:
         import co2unit_errors
+        import logging
         co2unit_errors.record_error(hw, e, "Uncaught exception at top level")
+        logging.flush()
     except Exception as e2:
         print("Error trying to record first exception...")
         sys.print_exception(e2)